@@ -0,0 +1,129 @@
+import os
+import gc
+import json
+import torch
+from logger import logger
+from instrument import instrument
+
+
+def is_oom(e):
+    return isinstance(e, torch.cuda.OutOfMemoryError) or 'out of memory' in str(e)
+
+
+def free_memory():
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def concat_outputs(outputs):
+    """
+    Concatenates the outputs of the parts of a split batch: tensors, tuples of tensors, or None.
+    """
+    if outputs[0] is None:
+        return None
+    if isinstance(outputs[0], tuple):
+        return tuple(concat_outputs(list(parts)) for parts in zip(*outputs))
+    return torch.cat(outputs, 0)
+
+
+class BatchTuner:
+    """
+    Finds the largest batch (in rows of `seq_len` tokens) that a stage, e.g. 'harvest', 'ablation_loss',
+    'gradient_loss' or 'occlusion', runs in on the device. The batch is doubled until the stage runs
+    out of memory and then bisected; the result, scaled by `autotune_margin`, is cached per (model,
+    hook point, stage, seq_len, device, dtype) in `autotune_cache` so that later runs skip the probe.
+    Batches that still run out of memory are split in halves and retried by `run_split`.
+    """
+    def __init__(self, cfg, model):
+        self.cfg = cfg
+        self.path = cfg['autotune_cache']
+        self.prefix = '{}|{}|{}|{}'.format(cfg['model_to_interpret'], cfg['act_name'], torch.cuda.get_device_name(cfg['device']), model.cfg.dtype)
+        self.sizes = dict()
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                self.sizes = json.load(f)
+
+    def key(self, stage, seq_len):
+        return '{}|{}|{}'.format(self.prefix, stage, seq_len)
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.sizes, f, indent=2)
+        os.replace(self.path + '.tmp', self.path)
+
+    def fits(self, fn, tokens, batch):
+        rows = tokens[torch.arange(batch) % tokens.shape[0]]
+        oom = False
+        try:
+            fn(rows)
+            torch.cuda.synchronize(self.cfg['device'])
+        except RuntimeError as e:
+            if not is_oom(e):
+                raise
+            oom = True
+        # outside of the except block, so that the traceback does not keep the activations alive
+        free_memory()
+        return not oom
+
+    def probe(self, stage, fn, tokens, start):
+        max_batch = self.cfg['autotune_max_batch']
+        good, bad = 0, max_batch + 1
+        batch = min(start, max_batch)
+        while True:
+            if self.fits(fn, tokens, batch):
+                good = batch
+            else:
+                bad = batch
+            if bad - good <= max(1, good // 8):
+                break
+            batch = min(batch * 2, max_batch) if bad > max_batch else (good + bad) // 2
+            if batch == good:
+                break
+        batch = max(1, int(good * self.cfg['autotune_margin']))
+        logger.info('Batch autotuner: {} fits {} rows of {} tokens, using {}'.format(stage, good, tokens.shape[1], batch))
+        return batch
+
+    def get_batch_size(self, stage, fn, tokens, default):
+        """
+        The cached batch size of `stage`, probed with the rows of `tokens` (repeated if needed) on a miss.
+        """
+        key = self.key(stage, tokens.shape[1])
+        if key not in self.sizes:
+            self.sizes[key] = self.probe(stage, fn, tokens, default)
+            self.save()
+        return self.sizes[key]
+
+    def run_split(self, stage, fn, tokens, seq_len=None):
+        """
+        `fn(tokens)`, or the concatenated outputs of `fn` on the two halves of `tokens` if it runs out
+        of memory. The cached batch size of the stage is lowered accordingly. `seq_len` is the row width
+        the stage was tuned at, if `tokens` can be narrower (length-bucketed batches); the batch is then
+        counted in rows of seq_len tokens.
+        """
+        try:
+            return fn(tokens)
+        except RuntimeError as e:
+            if not is_oom(e) or tokens.shape[0] <= 1:
+                raise
+        free_memory()
+        instrument.count('autotune/oom_splits')
+        if seq_len is None:
+            seq_len = tokens.shape[1]
+        rows = max(1, tokens.numel() // seq_len)
+        key = self.key(stage, seq_len)
+        if self.sizes.get(key, rows) >= rows:
+            self.sizes[key] = max(1, rows // 2)
+            self.save()
+        logger.warning('{} ran out of memory on {} rows, retrying in halves'.format(stage, tokens.shape[0]))
+        half = (tokens.shape[0] + 1) // 2
+        return concat_outputs([self.run_split(stage, fn, part, seq_len) for part in tokens.split(half, dim=0)])
+
+def get_tuner(cfg, model):
+    """
+    A BatchTuner if cfg['autotune_batch'] and the model runs on a GPU, else None.
+    """
+    if not cfg['autotune_batch'] or not str(cfg['device']).startswith('cuda'):
+        return None
+    return BatchTuner(cfg, model)
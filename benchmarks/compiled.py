@@ -0,0 +1,81 @@
+"""
+Compares the eager disturbed forward passes of the evaluators with the compiled one (--compile_forward)
+over many concepts, on CPU by default, e.g.
+    python -m benchmarks.compiled --shape tiny --concepts 32
+"""
+import sys
+import time
+import argparse
+import tempfile
+from functools import partial
+
+import torch
+
+from benchmarks.fixtures import MODEL_SHAPES, build_model
+from evaluators.base import BaseEvaluator
+from compiled import CompiledDisturbance
+
+
+def run_hooks(model, act_name, resume_layer, tokens, concept, activations, **kwargs):
+    hook = partial(BaseEvaluator.ablation_hook, concept=concept, activations=activations)
+    clean = model.run_with_hooks(tokens, **kwargs)
+    disturbed = model.run_with_hooks(tokens, fwd_hooks=[(act_name, hook)], **kwargs)
+    return clean, disturbed
+
+
+def run_resume(model, act_name, resume_layer, tokens, concept, activations, **kwargs):
+    hook = partial(BaseEvaluator.ablation_hook, concept=concept, activations=activations)
+    clean, cache = model.run_with_cache(tokens, names_filter=act_name, **kwargs)
+    disturbed = model(hook(cache[act_name], hook=None), start_at_layer=resume_layer, tokens=tokens, **kwargs)
+    return clean, disturbed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shape', choices=list(MODEL_SHAPES.keys()), default='tiny')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--layer', type=int, default=0)
+    parser.add_argument('--concepts', type=int, default=32)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--seq_len', type=int, default=64)
+    parser.add_argument('--mode', default='default', help='torch.compile mode')
+    parser.add_argument('--seed', type=int, default=49)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        model = build_model(args.shape, args.seq_len, args.device, tmp_dir, seed=args.seed)
+    act_name = 'blocks.{}.hook_resid_post'.format(args.layer)
+    resume_layer = args.layer + 1
+    generator = torch.Generator().manual_seed(args.seed)
+    tokens = torch.randint(0, model.cfg.d_vocab, (args.batch_size, args.seq_len), generator=generator).to(args.device)
+    concepts = torch.randn(args.concepts, model.cfg.d_model, generator=generator).to(args.device)
+    activations = torch.rand(args.concepts, args.batch_size * args.seq_len, generator=generator).to(args.device)
+    kwargs = {'return_type': 'loss', 'loss_per_token': True}
+
+    with torch.no_grad():
+        compiled = CompiledDisturbance(model, resume_layer, BaseEvaluator.ablation_hook, args.mode, **kwargs)
+        start = time.perf_counter()
+        compiled(tokens, concepts[0], activations[0])
+        print('compile  {:.2f}s (first call)'.format(time.perf_counter() - start), file=sys.stderr)
+
+        expected = run_hooks(model, act_name, resume_layer, tokens, concepts[0], activations[0], **kwargs)
+        output = compiled(tokens, concepts[0], activations[0])
+        max_diff = max((e - o).abs().max().item() for e, o in zip(expected, output))
+        print('max abs diff against the hooked forward: {:.3e}'.format(max_diff), file=sys.stderr)
+        assert max_diff < 1e-4, 'The compiled forward differs from the hooked forward.'
+
+        n_tokens = args.concepts * tokens.numel()
+        for name, run in [
+            ('hooks', partial(run_hooks, model, act_name, resume_layer)),
+            ('resume', partial(run_resume, model, act_name, resume_layer)),
+            ('compiled', lambda tokens, concept, acts, **kwargs: compiled(tokens, concept, acts)),
+        ]:
+            start = time.perf_counter()
+            for i in range(args.concepts):
+                run(tokens, concepts[i], activations[i], **kwargs)
+            seconds = time.perf_counter() - start
+            print('{:<8s} {:.4f}s per concept, {:.0f} tokens/s'.format(name, seconds / args.concepts, n_tokens / seconds), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
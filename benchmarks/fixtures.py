@@ -0,0 +1,99 @@
+import torch
+import datasets
+from transformer_lens import HookedTransformer, HookedTransformerConfig
+from transformers import AutoTokenizer, PreTrainedTokenizerFast
+from tokenizers import Tokenizer
+from tokenizers.models import WordLevel
+from tokenizers.pre_tokenizers import WhitespaceSplit
+
+from config import cfg as default_cfg
+from utils import process_cfg, set_seed
+
+# Randomly initialized models with the architecture of pythia-70m, so that no weights have to be downloaded.
+MODEL_SHAPES = {
+    'tiny': dict(n_layers=2, d_model=128, n_heads=4, d_head=32, d_mlp=512, rotary_dim=8, d_vocab=2048),
+    'pythia-70m': dict(n_layers=6, d_model=512, n_heads=8, d_head=64, d_mlp=2048, rotary_dim=16, d_vocab=50304),
+}
+
+SPECIAL_TOKENS = ['<unk>', '<bos>', '<eos>', '<pad>']
+
+
+def build_tokenizer(d_vocab, tokenizer_dir):
+    """
+    A word-level tokenizer over synthetic words 'w0', 'w1', ..., saved locally so that
+    transformer_lens can reload it without network access.
+    """
+    vocab = {tok: i for i, tok in enumerate(SPECIAL_TOKENS)}
+    for i in range(d_vocab - len(SPECIAL_TOKENS)):
+        vocab['w{}'.format(i)] = len(vocab)
+    tokenizer = Tokenizer(WordLevel(vocab, unk_token='<unk>'))
+    tokenizer.pre_tokenizer = WhitespaceSplit()
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        unk_token='<unk>',
+        bos_token='<bos>',
+        eos_token='<eos>',
+        pad_token='<pad>',
+    )
+    tokenizer.save_pretrained(tokenizer_dir)
+    return AutoTokenizer.from_pretrained(tokenizer_dir)
+
+
+def build_model(shape, seq_len, device, tokenizer_dir, seed=0):
+    model_shape = MODEL_SHAPES[shape]
+    model_cfg = HookedTransformerConfig(
+        n_layers=model_shape['n_layers'],
+        d_model=model_shape['d_model'],
+        n_heads=model_shape['n_heads'],
+        d_head=model_shape['d_head'],
+        d_mlp=model_shape['d_mlp'],
+        d_vocab=model_shape['d_vocab'],
+        n_ctx=max(seq_len, 128),
+        act_fn='gelu',
+        normalization_type='LN',
+        positional_embedding_type='rotary',
+        rotary_dim=model_shape['rotary_dim'],
+        parallel_attn_mlp=True,
+        original_architecture='GPTNeoXForCausalLM',
+        device=device,
+        seed=seed,
+    )
+    tokenizer = build_tokenizer(model_shape['d_vocab'], tokenizer_dir)
+    model = HookedTransformer(model_cfg, tokenizer=tokenizer).to(device)
+    model.eval()
+    return model
+
+
+def build_corpus(n_docs, seq_len, d_vocab, seed=0):
+    """
+    A pre-tokenized corpus in the format of the tokenized pile datasets.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    tokens = torch.randint(len(SPECIAL_TOKENS), d_vocab, (n_docs, seq_len), generator=generator)
+    return datasets.Dataset.from_dict({'tokens': tokens.tolist()})
+
+
+def build_cfg(model, output_dir, **overrides):
+    """
+    The default config scaled down to the benchmark model, with the same keys as a main.py run.
+    """
+    cfg = dict(default_cfg)
+    cfg.update({
+        'model_to_interpret': 'pythia-70m',
+        'extractor': 'ae',
+        'dataloader': 'ae',
+        'tokenized': True,
+        'output_dir': output_dir,
+        'layer': 0,
+        'site': 'resid_post',
+        'seq_len': 32,
+        'batch_size': 1024,
+        'buffer_mult': 8,
+        'dict_mult': 4,
+        'concept_eval_batchsize': 16,
+        'metric_eval_batchsize': 32,
+        'num_tokens': 1024 * 64,
+    })
+    cfg.update(overrides)
+    set_seed(cfg['seed'])
+    return process_cfg(cfg, model)
@@ -0,0 +1,62 @@
+"""
+Checks the micro-batch pipeline against a plain forward pass and times both. On CPU the stages are
+simulated by threads, so this runs without GPUs, e.g.
+    python -m benchmarks.pipeline --shape tiny --stages 2 --micro_batches 4
+"""
+import sys
+import time
+import argparse
+import tempfile
+from functools import partial
+
+import torch
+
+from benchmarks.fixtures import MODEL_SHAPES, build_model
+from evaluators.base import BaseEvaluator
+from pipeline import PipelineRunner
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shape', choices=list(MODEL_SHAPES.keys()), default='tiny')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--stages', type=int, default=2)
+    parser.add_argument('--micro_batches', type=int, default=4)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--seq_len', type=int, default=32)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=49)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        model = build_model(args.shape, args.seq_len, args.device, tmp_dir, seed=args.seed)
+    runner = PipelineRunner(model, args.stages, args.micro_batches)
+    generator = torch.Generator().manual_seed(args.seed)
+    tokens = torch.randint(0, model.cfg.d_vocab, (args.batch_size, args.seq_len), generator=generator).to(args.device)
+
+    # an ablation hook in the last stage, with per-token activations as the evaluators pass them
+    layer = runner.stages[-1][0]
+    concept = torch.randn(model.cfg.d_model, generator=generator).to(args.device)
+    activations = torch.rand(args.batch_size * args.seq_len, generator=generator).to(args.device)
+    fwd_hooks = [(
+        'blocks.{}.hook_resid_post'.format(layer),
+        partial(BaseEvaluator.ablation_hook, concept=concept, activations=activations),
+    )]
+
+    with torch.no_grad():
+        for return_type, kwargs in [('logits', {}), ('loss', {'loss_per_token': True})]:
+            expected = model.run_with_hooks(tokens, fwd_hooks=fwd_hooks, return_type=return_type, **kwargs)
+            output = runner.run_with_hooks(tokens, fwd_hooks=fwd_hooks, return_type=return_type, **kwargs)
+            max_diff = (expected - output).abs().max().item()
+            print('{:<8s} stages={} max abs diff: {:.3e}'.format(return_type, runner.stages, max_diff), file=sys.stderr)
+            assert max_diff < 1e-4, 'The pipeline output differs from the plain forward pass.'
+
+        for name, run in [('plain', model.run_with_hooks), ('pipeline', runner.run_with_hooks)]:
+            start = time.perf_counter()
+            for _ in range(args.repeats):
+                run(tokens, fwd_hooks=fwd_hooks)
+            print('{:<8s} {:.4f}s per forward'.format(name, (time.perf_counter() - start) / args.repeats), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
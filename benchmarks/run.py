@@ -0,0 +1,157 @@
+"""
+End-to-end benchmark of the extraction -> evaluation -> meta-evaluation pipeline on a randomly
+initialized pythia-70m-shaped model and a synthetic corpus.
+
+Run from the repository root, e.g.
+    python -m benchmarks.run --shape tiny --output bench.json
+"""
+import os
+import re
+import sys
+import json
+import time
+import logging
+import argparse
+import datetime
+import platform
+import tempfile
+import statistics
+import subprocess
+
+import torch
+import transformer_lens
+
+from benchmarks.fixtures import MODEL_SHAPES, build_model, build_corpus, build_cfg
+from dataloaders import dataloader_factory
+from extractors import extractor_factory
+from metric_evaluators import metric_evaluator_factory
+from main import get_eval_tokens, build_evaluators
+
+
+def synchronize(device):
+    if str(device).startswith('cuda'):
+        torch.cuda.synchronize(device)
+
+
+def time_stage(results, name, fn, args):
+    if args.stages and not re.search(args.stages, name):
+        return
+    for _ in range(args.warmup):
+        fn()
+    times = []
+    for _ in range(args.repeats):
+        synchronize(args.device)
+        start = time.perf_counter()
+        fn()
+        synchronize(args.device)
+        times.append(time.perf_counter() - start)
+    results[name] = {
+        'repeats': args.repeats,
+        'mean_s': statistics.mean(times),
+        'std_s': statistics.pstdev(times),
+        'min_s': min(times),
+    }
+    print('{:<48s} {:10.4f}s (min {:.4f}s)'.format(name, results[name]['mean_s'], results[name]['min_s']), file=sys.stderr)
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(args, tmp_dir):
+    results = dict()
+    model = build_model(args.shape, args.seq_len, args.device, os.path.join(tmp_dir, 'tokenizer'), seed=args.seed)
+    cfg = build_cfg(model, tmp_dir, device=args.device, seq_len=args.seq_len, seed=args.seed)
+    data = build_corpus(args.n_docs, cfg['seq_len'], model.cfg.d_vocab, seed=args.seed)
+
+    # extraction
+    dataloader = dataloader_factory(cfg, data, model)
+    time_stage(results, 'dataloader/refresh', dataloader.reinit, args)
+
+    extractor = extractor_factory(cfg, dataloader)
+    optimizer = torch.optim.Adam(extractor.parameters(), lr=cfg["lr"], betas=(cfg["beta1"], cfg["beta2"]))
+    activations = dataloader.buffer[:cfg['batch_size']]
+    time_stage(results, 'extractor/train_step', lambda: extractor.train_step(activations, optimizer), args)
+
+    # concept evaluation
+    concepts = extractor.get_concepts()
+    concept_idxs = list(range(args.n_concepts))
+    tokens, origin_tokens = get_eval_tokens(dataloader)
+    batch = tokens[:cfg['concept_eval_batchsize']]
+    time_stage(results, 'extractor/activation_func', lambda: extractor.activation_func(batch, model, concepts[0], 0), args)
+
+    evaluator_dict = build_evaluators(cfg, extractor, model)
+    for evaluator in evaluator_dict.values():
+        evaluator.update_concept(concepts[0], 0)
+    time_stage(results, 'evaluator/get_most_critical_tokens', lambda: evaluator_dict['itc_uci'].get_most_critical_tokens(batch, concepts[0], 0), args)
+    for name, evaluator in evaluator_dict.items():
+        time_stage(results, 'evaluator/' + name, lambda: evaluator.get_metric(batch), args)
+
+    # meta evaluation
+    meta_evaluator_dict = {name: evaluator_dict[name] for name in args.meta_evaluators.split(',')}
+    for code in ['rc', 'rs', 'vr']:
+        meta_cfg = dict(cfg, metric_evaluator=code)
+        metric_evaluator = metric_evaluator_factory(meta_cfg)
+        time_stage(results, 'metric_evaluator/' + code, lambda: metric_evaluator.get_metric(
+            tokens,
+            meta_evaluator_dict,
+            concepts=concepts[concept_idxs],
+            concept_idxs=concept_idxs,
+            origin_tokens=origin_tokens,
+        ), args)
+
+    meta = {
+        'timestamp': datetime.datetime.now().isoformat(),
+        'git_commit': get_git_commit(),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'transformer_lens': getattr(transformer_lens, '__version__', None),
+        'device': args.device,
+        'shape': args.shape,
+        'model': MODEL_SHAPES[args.shape],
+        'n_docs': args.n_docs,
+        'n_concepts': args.n_concepts,
+        'cfg': {k: cfg[k] for k in [
+            'seq_len', 'batch_size', 'buffer_mult', 'dict_size', 'act_name',
+            'concept_eval_batchsize', 'metric_eval_batchsize', 'return_type', 'topic_len',
+        ]},
+        'n_eval_tokens': list(tokens.shape),
+    }
+    return {'meta': meta, 'stages': results}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shape', choices=list(MODEL_SHAPES.keys()), default='tiny')
+    parser.add_argument('--device', default='cuda:0' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--seq_len', type=int, default=32)
+    parser.add_argument('--n_docs', type=int, default=1024)
+    parser.add_argument('--n_concepts', type=int, default=2)
+    parser.add_argument('--meta_evaluators', default='ablation_loss,itc_emb_cos,otc_emb_cos')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=49)
+    parser.add_argument('--stages', default='', help='Only run the stages matching this regex.')
+    parser.add_argument('--output', default='', help='Where to write the JSON results, stdout if empty.')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.getLogger('logger').setLevel(logging.WARNING)
+    torch.set_default_dtype(torch.float32)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        report = run_benchmarks(args, tmp_dir)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
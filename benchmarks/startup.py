@@ -0,0 +1,72 @@
+"""
+Measures the startup cost of the CLI entry point and the import cost of every registered component,
+each in a fresh interpreter.
+
+Run from the repository root, e.g.
+    python -m benchmarks.startup --output startup.json
+"""
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+REGISTRIES = {
+    'models': 'MODELS',
+    'datasets_': 'DATASETS',
+    'dataloaders': 'DATALOADERS',
+    'extractors': 'EXTRACTORS',
+    'evaluators': 'EVALUATORS',
+    'metric_evaluators': 'METRICEVALUATORS',
+}
+
+SNIPPET = """
+import time
+start = time.perf_counter()
+{setup}
+setup_time = time.perf_counter() - start
+{stmt}
+print(time.perf_counter() - start - setup_time)
+"""
+
+
+def measure(stmt, setup='', repeats=3):
+    times = []
+    for _ in range(repeats):
+        out = subprocess.check_output([sys.executable, '-c', SNIPPET.format(setup=setup, stmt=stmt)])
+        times.append(float(out.decode().strip().splitlines()[-1]))
+    return {'median_s': statistics.median(times), 'min_s': min(times), 'repeats': repeats}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--output', default='', help='Where to write the JSON results, stdout if empty.')
+    args = parser.parse_args()
+
+    results = {'import main': measure('import main', repeats=args.repeats)}
+    print('{:<48s} {:8.3f}s'.format('import main', results['import main']['median_s']), file=sys.stderr)
+    for package, registry in REGISTRIES.items():
+        setup = 'import main\nfrom {} import {} as registry'.format(package, registry)
+        codes = json.loads(subprocess.check_output([
+            sys.executable, '-c', 'import json\nfrom {} import {} as r\nprint(json.dumps(list(r.keys())))'.format(package, registry)
+        ]).decode())
+        for code in codes:
+            name = '{}/{}'.format(package, code)
+            try:
+                results[name] = measure('registry[{!r}]'.format(code), setup=setup, repeats=args.repeats)
+            except subprocess.CalledProcessError:
+                results[name] = None
+                print('{:<48s} failed to import'.format(name), file=sys.stderr)
+                continue
+            print('{:<48s} {:8.3f}s'.format(name, results[name]['median_s']), file=sys.stderr)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
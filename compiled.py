@@ -0,0 +1,64 @@
+import torch
+from logger import logger
+
+
+class CompiledDisturbance:
+    """
+    The clean and the disturbed outputs of the model as one function of (tokens, concept, activations),
+    compiled once with torch.compile and reused for every concept. The model is split at the residual
+    stream layer `resume_layer`: the prefix runs once, `disturb(residual, None, concept=concept,
+    activations=activations)` is applied to its output directly, and the suffix runs on the clean and
+    on the disturbed residual. There are no hooks and no per-call partials, so the concept and the
+    activations are ordinary tensor inputs of the compiled graph; a new concept of the same shape
+    does not trigger a recompilation.
+    """
+    def __init__(self, model, resume_layer, disturb, mode='default', **kwargs):
+        self.model = model
+        self.resume_layer = resume_layer
+        self.disturb = disturb
+        self.kwargs = kwargs
+        self.forward = torch.compile(self.run, mode=mode, dynamic=False)
+
+    def run(self, tokens, concept, activations):
+        residual = self.model(tokens, stop_at_layer=self.resume_layer)
+        clean = self.model(residual, start_at_layer=self.resume_layer, tokens=tokens, **self.kwargs)
+        disturbed = self.model(
+            self.disturb(residual, None, concept=concept, activations=activations),
+            start_at_layer=self.resume_layer,
+            tokens=tokens,
+            **self.kwargs,
+        )
+        return clean, disturbed
+
+    def __call__(self, tokens, concept, activations):
+        return self.forward(tokens, concept, activations)
+
+
+class CompiledForwards:
+    """
+    The CompiledDisturbance of every (disturbance, output kwargs) an evaluator asks for, built on first use.
+    """
+    def __init__(self, model, resume_layer, mode='default'):
+        self.model = model
+        self.resume_layer = resume_layer
+        self.mode = mode
+        self.functions = dict()
+
+    def get(self, disturb, **kwargs):
+        key = (disturb, tuple(sorted(kwargs.items())))
+        if key not in self.functions:
+            logger.info('Compiling the disturbed forward pass ({}, {})'.format(disturb.__name__, kwargs))
+            self.functions[key] = CompiledDisturbance(self.model, self.resume_layer, disturb, self.mode, **kwargs)
+        return self.functions[key]
+
+
+def get_compiled_forwards(cfg, model, resume_layer):
+    """
+    CompiledForwards if cfg['compile_forward'] and the hooked site is on the residual stream, else None.
+    """
+    if not cfg['compile_forward']:
+        return None
+    if resume_layer is None:
+        logger.warning('compile_forward needs a residual stream site (and resume_from_layer without pipelining), {} runs eagerly'.format(cfg['act_name']))
+        return None
+    return CompiledForwards(model, resume_layer, cfg['compile_mode'])
@@ -8,6 +8,7 @@ cfg = {
         "model_to_interpret": "pythia-70m", # choose from ["llama-2-7b-chat", "pythia-70m"]
         "load_path": "./best_reconstruct",#"{The path where you save checkpoints, e.g. /user/data/outputs/AE/best_reconstruct}",
         "load_extractor": False,
+        "async_save": True, # Save extractor artifacts on a background thread
 
         ## AutoEncoder
         "dict_mult": 8,
@@ -23,6 +24,7 @@ cfg = {
         'remove_parallel': 1,
         'tied_enc_dec': 0,
         "epoch": 1,
+        'sweep': '', # Hyperparameters of the autoencoders trained together by extractors/multi_ae.py, e.g. "l1_coeff=0.1,0.5;dict_mult=4,8"
         'use_bias_d': 1,
         'tied_enc_dec': 0,
 
@@ -37,16 +39,70 @@ cfg = {
         "batch_size": 8192,
         "l1_coeff": 0.5,
         "n_devices": 1, # For a relatively large model that requires multiple GPUs to load, load it onto 'n_devices' GPUs starting from 'device'.
+        'pipeline_stages': 0, # Number of pipeline stages the layers are split into, 0 for one per device
+        'pipeline_micro_batches': 1, # If > 1, evaluation forwards are cut into this many micro-batches that flow through the stages concurrently
         
         ## Concept Evaluating
         'evaluator': 'itc',
         'concept_eval_batchsize': 128,
         'return_type': 'weighted',
+        'faithfulness_log_every': 0, # If > 0, show the running faithfulness estimate every this many minibatches
+        'activation_gated_ablation': False, # Only ablate the sequences where the concept activates, the others cannot change the final faithfulness metric
+        'resume_from_layer': True, # Disturbed forward passes on a residual stream site resume after the hooked layer instead of rerunning the clean prefix
+        'compile_forward': False, # Run the clean and disturbed passes of a residual stream site as one torch.compile'd function of the concept tensors
+        'compile_mode': 'default', # torch.compile mode: default / reduce-overhead (CUDA graphs) / max-autotune
+        'eval_precision': 'fp32', # fp32 / bf16 / fp16 / int8 (weight-only), applied to the model, the hooks and the extractor before evaluation
+        'precision_drift_concepts': 0, # If > 0 and eval_precision is not fp32, report the metric drift against fp32 (the model is upcast for the reference) on this many concepts
         'topic_len': 20,
+        'dedupe_threshold': 0., # Skip concepts whose cosine similarity to an earlier evaluated concept is at least this, 0 to evaluate all of them
+        'concept_index_mode': 'exact', # exact / ivfpq, see extractors/concept_index.py
         
         ## Metric Evaluating
         'metric_evaluator': 'rc',
         'metric_eval_batchsize': 128 * 5,
+        'rc_adaptive': False, # Evaluate the rc sub-datasets one at a time and stop each metric once its consistency has converged
+        'rc_min_subdatasets': 3,
+        'rc_ci_tolerance': 0.05, # Width of the bootstrap confidence interval at which a metric has converged
+        'rc_ci_level': 0.95,
+        'rc_bootstrap': 1000, # Bootstrap resamplings of the sub-datasets
+        'result_store': False, # Persist per-concept metrics under save_dir so that interrupted runs can be resumed
+        'result_store_name': 'results.sqlite',
+        'arena_dir': '', # Where per-token metrics waiting for 'replace-ablation' evaluators are spilled, '' for the system temp dir
+        'arena_dtype': 'float16',
+        
+        'n_concepts': 200, # Evaluate the first n_concepts concepts of the extractor
+        
+        ## Distributed metric evaluation (rc only)
+        'distributed_role': '', # '' to evaluate in this process, 'coordinator' to split the evaluation into tasks, 'worker' to evaluate tasks
+        'queue_dir': './output/queue', # Task queue shared by the coordinator and the workers, bound to one evaluation set (the coordinator refuses a queue of another one)
+        'local_workers': 0, # Workers the coordinator starts on this host
+        'concepts_per_task': 16,
+        'subdatasets_per_task': 1,
+        'task_lease': 3600., # Seconds after which a claimed task that is not done is given to another worker
+        'queue_poll': 1.,
+        
+        ## Evaluation server (server.py)
+        'server_host': '127.0.0.1',
+        'server_port': 8765,
+        'server_eval_batches': 1, # Model batches of evaluation tokens the server keeps
+        'batch_window_ms': 20., # How long the scheduler waits for more requests to coalesce with the first one
+        'max_batch_requests': 64,
+        'server_cache_size': 100000, # Scored (concept, evaluator) cells kept in memory
+        
+        ## Max-activating example index (extractors/example_index.py)
+        'index_path': './output/example_index',
+        'index_top_k': 20, # Examples kept per concept
+        'index_window': 16, # Tokens of context kept before (and including) every example position
+        'index_n_bins': 40, # Log-spaced activation histogram bins between index_hist_min and index_hist_max
+        'index_hist_min': 1e-3,
+        'index_hist_max': 1e3,
+        'index_max_docs': 0, # Documents to index, 0 for the whole corpus
+        
+        ## Batch autotuning (autotune.py)
+        'autotune_batch': False, # Probe the largest batch of every stage on the GPU and split batches that still run out of memory
+        'autotune_cache': './output/batch_sizes.json', # Probed batch sizes per (model, hook point, stage, seq_len, device, dtype)
+        'autotune_max_batch': 1024, # Largest batch the tuner tries, in rows of seq_len tokens
+        'autotune_margin': 0.8, # Fraction of the largest batch that fits which is used, as headroom for fragmentation
         
         ## Buffer in AE_Dataloader
         "buffer_size": None,
@@ -54,11 +110,18 @@ cfg = {
         "act_size": None,
         "buffer_batches": None,
         "model_batch_size":64,
+        'buffer_dtype': 'bf16', # bf16 / int8 / fp8, the 1-byte formats store every buffer row with its own scale
+        'buffer_center': False, # Subtract a running mean of the activations before compressing the buffer rows
+        'max_batch_tokens': 0, # Token budget of a length-bucketed forward pass over raw text, 0 for model_batch_size * seq_len
         
         ## dataset
         "num_tokens": int(1363348000), # How many tokens do you want to use for training
         "seq_len": 128,
         "tokenized":False, # Whether the training data has been tokenized
+        'pack_sequences': False, # Concatenate untokenized documents with BOS separators into dense seq_len windows when filling the AE buffer
+        'drop_pad_acts': False, # Keep padding and BOS/separator positions out of the AE buffer
+        'harvest_layers': '', # Comma-separated layers (or 'all') whose activations the AE dataloader caches in the same forward pass, '' for only 'layer'
+        'harvest_sites': '', # Comma-separated sites cached for every harvested layer, e.g. 'resid_post,mlp_post', '' for only 'site'
         "data_from_hf":True, # Whether the dataset is downloaded from huggingface
         'dataloader': 'ae',
         
@@ -91,4 +154,8 @@ cfg = {
         "show_charts":False,
         "selection_criterion": "log_likelihood", # accuracy / log_likelihood / mi
         'log_wandb': False, # to use wandb
+
+        ## instrumentation
+        'instrument': False, # Time every stage and count forward/backward passes, a summary table is printed at the end
+        'profile_trace_dir': '', # If set (and instrument is on), a torch.profiler chrome trace of the metric evaluation is saved here
 }
\ No newline at end of file
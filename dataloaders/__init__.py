@@ -1,16 +1,17 @@
-from .tcav import TCAVDataloader
-from .ae import AEDataloader
-from .conceptx import ConceptXDataloader
-from .conceptx_naive import ConceptXNaiveDataloader
+from registry import LazyRegistry
 
 
-DATALOADERS = {
-    "neuron": AEDataloader,
-    AEDataloader.code(): AEDataloader,
-    ConceptXDataloader.code(): ConceptXDataloader,
-    TCAVDataloader.code(): TCAVDataloader,
-    ConceptXNaiveDataloader.code(): ConceptXNaiveDataloader,
-}
+DATALOADERS = LazyRegistry(__name__, {
+    "neuron": '.ae:AEDataloader',
+    'ae': '.ae:AEDataloader',
+    'conceptx': '.conceptx:ConceptXDataloader',
+    'tcav': '.tcav:TCAVDataloader',
+    'conceptx_ori': '.conceptx_naive:ConceptXNaiveDataloader',
+})
+
+
+def __getattr__(name):
+    return DATALOADERS.get_class(name)
 
 
 def dataloader_factory(cfg, data, model):
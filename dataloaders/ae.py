@@ -1,24 +1,49 @@
 from .base import AbstractDataloader
+from .batching import tokenize_bucketed, pack_documents, get_max_batch_tokens
+from .buffer import ActivationBuffer
 
 import torch
+import torch.nn.functional as F
 from logger import logger
+from instrument import instrument
+from autotune import get_tuner
+from utils import get_harvest_sites
 
 
 class AEDataloader(AbstractDataloader):
     """
     This is a dataloader used to generate minibatch data for concept extraction or concept evaluation.
     There's a built-in buffer to scramble the activation vector, which may be helpful for training Autoencoder.
+    If cfg['harvest_layers'] or cfg['harvest_sites'] name more sites, all of them are cached by the same
+    forward pass into one buffer per site, shuffled with the same permutation; `buffer` is the one of act_name.
     """
     def __init__(self, cfg, data, model):
         super().__init__()
         self.cfg = cfg
-        self.buffer = torch.zeros((cfg["buffer_size"], cfg["act_size"]), dtype=torch.bfloat16, requires_grad=False)
+        self.sites = get_harvest_sites(cfg, model.cfg.n_layers)
+        self.act_names = [act_name for _, _, act_name in self.sites]
+        self.buffers = {
+            act_name: ActivationBuffer(cfg["buffer_size"], cfg["d_mlp"] if site == 'mlp_post' else cfg["d_model"], cfg['buffer_dtype'], cfg['buffer_center'])
+            for _, site, act_name in self.sites
+        }
+        self.buffer = self.buffers[cfg["act_name"]]
         self.cfg = cfg
         self.token_pointer = 0
+        self.pack_remainder = None
+        self.pending_batches = []
+        self.leftover_acts = None
         self.data = data
         self.model = model
         self.tokenizer = model.tokenizer
         self.empty_flag = 0
+        self.model_batch_size = cfg['model_batch_size']
+        self.tuner = get_tuner(cfg, model)
+        if self.tuner is not None:
+            # probed on full seq_len rows, the widest batches a refresh harvests, whatever the padding of the sample
+            tokens = self.get_processed_random_batch()[0]
+            tokens = F.pad(tokens, (0, cfg['seq_len'] - tokens.shape[1]), value=self.tokenizer.bos_token_id)
+            with torch.autocast("cuda", torch.float16), torch.no_grad():
+                self.model_batch_size = self.tuner.get_batch_size('harvest', self.harvest, tokens, self.model_batch_size)
         self.refresh()
         
         
@@ -36,41 +61,113 @@ class AEDataloader(AbstractDataloader):
         if self.pointer > self.buffer.shape[0] - self.cfg["batch_size"]:
             self.refresh()
         return out
+
+    @torch.no_grad()
+    def next_sites(self):
+        """
+        The same rows of every harvested site, {act_name: minibatch}.
+        """
+        out = {act_name: buffer[self.pointer:self.pointer+self.cfg["batch_size"]] for act_name, buffer in self.buffers.items()}
+        self.pointer += self.cfg["batch_size"]
+        if self.pointer > self.buffer.shape[0] - self.cfg["batch_size"]:
+            self.refresh()
+        return out
     
     def reinit(self):
         self.token_pointer = 0
+        self.pack_remainder = None
+        self.pending_batches = []
+        self.leftover_acts = None
         self.empty_flag = 0
         self.refresh()
         
+    def iter_model_batches(self, pool_batches=8):
+        """
+        Yields the (tokens, inserted) batches that fill the buffer, starting from token_pointer.
+        Untokenized text is read `pool_batches` model batches at a time and either regrouped by length
+        under the token budget of one forward pass, or, if cfg['pack_sequences'], concatenated into
+        dense seq_len windows. `inserted` masks the padding and BOS separators the batching added, and
+        is None when every position holds a token of the text.
+        The batches of a pool that are not consumed yet stay in `pending_batches` and are yielded first
+        by the next call, so stopping early does not skip any text.
+        """
+        while True:
+            while len(self.pending_batches) > 0:
+                yield self.pending_batches.pop(0)
+            if self.cfg['tokenized']:
+                if self.token_pointer+self.model_batch_size > len(self.data):
+                    break
+                tokens = self.data[self.token_pointer:self.token_pointer+self.model_batch_size]['tokens']
+                self.token_pointer += self.model_batch_size
+                self.pending_batches.append((torch.tensor(tokens)[:, :self.cfg['seq_len']], None))
+            else:
+                if self.token_pointer >= len(self.data):
+                    break
+                pool_size = self.model_batch_size * pool_batches
+                sentences = self.data[self.token_pointer:self.token_pointer+pool_size]
+                self.token_pointer += pool_size
+                if self.cfg['pack_sequences']:
+                    windows, inserted, self.pack_remainder = pack_documents(self.tokenizer, sentences, self.cfg['seq_len'], self.pack_remainder)
+                    self.pending_batches.extend(zip(windows.split(self.model_batch_size, dim=0), inserted.split(self.model_batch_size, dim=0)))
+                else:
+                    for _, tokens, attention_mask in tokenize_bucketed(self.tokenizer, sentences, self.cfg['seq_len'], get_max_batch_tokens(self.cfg, self.model_batch_size)):
+                        self.pending_batches.append((tokens, attention_mask == 0))
+        self.empty_flag = 1
+
+    def harvest(self, tokens):
+        """
+        The activations of every harvested site, in the order of act_names.
+        """
+        _, cache = self.model.run_with_cache(tokens, names_filter=self.act_names, remove_batch_dim=False)
+        return tuple(cache[act_name].reshape(-1, self.buffers[act_name].shape[1]) for act_name in self.act_names)
+
+    def fill(self, site_acts):
+        """
+        Writes the activations of every site into the buffers from `pointer` on. Returns the rows that
+        did not fit, or None.
+        """
+        n_rows = min(site_acts[0].shape[0], self.buffer.shape[0] - self.pointer)
+        for act_name, acts in zip(self.act_names, site_acts):
+            # copied to the host by the buffer, after compression if it compresses
+            self.buffers[act_name][self.pointer: self.pointer+n_rows] = acts[:n_rows]
+        self.pointer += n_rows
+        if n_rows < site_acts[0].shape[0]:
+            return tuple(acts[n_rows:] for acts in site_acts)
+        return None
+
+    @instrument.timed('dataloader/refresh')
     def refresh(self):
         logger.info("buffer refreshing...\n")
         self.pointer = 0
+        for buffer in self.buffers.values():
+            buffer.begin_fill()
+        # the rows of the last batch of the previous refresh that did not fit come first
+        if self.leftover_acts is not None:
+            self.leftover_acts = self.fill(self.leftover_acts)
         with torch.autocast("cuda", torch.float16):
-            num_batches = self.cfg["buffer_batches"]
             with torch.no_grad():
-                for _ in range(0, num_batches, self.cfg["model_batch_size"]):
-                    if self.token_pointer+self.cfg["model_batch_size"] <= len(self.data):
-                        if self.cfg['tokenized']:
-                            tokens = self.data[self.token_pointer:self.token_pointer+self.cfg["model_batch_size"]]['tokens']
-                            tokens = torch.tensor(tokens)
-                        else:    
-                            sentences = self.data[self.token_pointer:self.token_pointer+self.cfg["model_batch_size"]]
-                            inputs = self.tokenizer(sentences, max_length=128, truncation=True, padding=True,return_tensors="pt")
-                            inputs = inputs.to('cpu')
-                            tokens = inputs['input_ids']
-                        # print(tokens.dtype)
-                        tokens = tokens[:, :self.cfg['seq_len']]
-                        print(tokens.shape[0])
-                        tokens[:, 0] = self.model.tokenizer.bos_token_id
-                        _, cache = self.model.run_with_cache(tokens, names_filter=self.cfg["act_name"], remove_batch_dim=False)
-                        acts = cache[self.cfg["act_name"]].reshape(-1, self.cfg["act_size"])
-                        self.buffer[self.pointer: self.pointer+acts.shape[0]] = acts.cpu()
-                        self.pointer += acts.shape[0]
-                        self.token_pointer += self.cfg["model_batch_size"]
+                batches = self.iter_model_batches() if self.pointer < self.buffer.shape[0] else []
+                for tokens, inserted in batches:
+                    tokens[:, 0] = self.model.tokenizer.bos_token_id
+                    if self.tuner is None:
+                        site_acts = self.harvest(tokens)
                     else:
-                        self.empty_flag = 1
+                        site_acts = self.tuner.run_split('harvest', self.harvest, tokens, self.cfg['seq_len'])
+                    if self.cfg['drop_pad_acts']:
+                        # only keep the activations of the text, not of the padding, separators or leading BOS
+                        # that were inserted; BOS ids in the text (e.g. Pythia, where BOS is EOS) are kept
+                        keep = torch.ones_like(tokens, dtype=torch.bool) if inserted is None else ~inserted
+                        keep[:, 0] = False
+                        keep = keep.reshape(-1)
+                        site_acts = tuple(acts[keep.to(acts.device)] for acts in site_acts)
+                    self.leftover_acts = self.fill(site_acts)
+                    if self.pointer >= self.buffer.shape[0]:
+                        break
         self.pointer = 0
-        self.buffer = self.buffer[torch.randperm(self.buffer.shape[0])]
+        perm = torch.randperm(self.buffer.shape[0])
+        for act_name in self.act_names:
+            self.buffers[act_name].permute_(perm)
+            self.buffers[act_name].log_fill(act_name)
         
     @torch.no_grad()
     def get_random_batch(self):
@@ -119,4 +216,27 @@ class AEDataloader(AbstractDataloader):
         tokens = self.get_batch()
         tokens = tokens[:, :self.cfg['seq_len']]
         tokens[:, 0] = self.model.tokenizer.bos_token_id
-        return tokens
\ No newline at end of file
+        return tokens
+
+class SiteDataloader:
+    """
+    The buffer of one harvested site of an AEDataloader, for the extractor of that site. The minibatches
+    of all sites are drawn together with `AEDataloader.next_sites`.
+    """
+    def __init__(self, dataloader, act_name):
+        self.dataloader = dataloader
+        self.act_name = act_name
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    @property
+    def buffer(self):
+        return self.dataloader.buffers[self.act_name]
+
+    @property
+    def empty_flag(self):
+        return self.dataloader.empty_flag
+
+    def get_processed_random_batch(self):
+        return self.dataloader.get_processed_random_batch()
@@ -0,0 +1,84 @@
+import torch
+
+
+def bucket_by_length(lengths, max_tokens, max_rows=None):
+    """
+    Groups sequence indices into batches of similar length. A batch grows until padding it to its
+    longest sequence would exceed `max_tokens` (or it has `max_rows` rows).
+    Returns a list of index lists.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    batches = []
+    batch = []
+    for i in order:
+        # the order is ascending, so the new sequence is the longest one of the batch
+        if len(batch) > 0 and ((len(batch) + 1) * lengths[i] > max_tokens or (max_rows is not None and len(batch) >= max_rows)):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+
+def pad_sequences(seqs, pad_id):
+    """
+    Right-pads a list of token id lists. Returns the tokens and the attention mask.
+    """
+    maxlen = max(len(seq) for seq in seqs)
+    tokens = torch.full((len(seqs), maxlen), pad_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(seqs), maxlen), dtype=torch.long)
+    for i, seq in enumerate(seqs):
+        tokens[i, :len(seq)] = torch.tensor(seq, dtype=torch.long)
+        attention_mask[i, :len(seq)] = 1
+    return tokens, attention_mask
+
+
+def tokenize_bucketed(tokenizer, sentences, max_length, max_tokens, max_rows=None):
+    """
+    Tokenizes `sentences` without padding and yields (indices, tokens, attention_mask) for batches of
+    similar length that each fit in `max_tokens`, so that little compute is spent on pad tokens.
+    The attention mask is 0 exactly at the pad positions, whatever the id of the pad token.
+    """
+    input_ids = tokenizer(sentences, max_length=max_length, truncation=True)['input_ids']
+    pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    for idxs in bucket_by_length([len(ids) for ids in input_ids], max_tokens, max_rows):
+        tokens, attention_mask = pad_sequences([input_ids[i] for i in idxs], pad_id)
+        yield idxs, tokens, attention_mask
+
+
+def get_max_batch_tokens(cfg, model_batch_size=None):
+    """
+    The token budget of one forward pass, a full batch of `model_batch_size` x `seq_len` by default.
+    """
+    if cfg['max_batch_tokens'] > 0:
+        return cfg['max_batch_tokens']
+    if model_batch_size is None:
+        model_batch_size = cfg['model_batch_size']
+    return model_batch_size * cfg['seq_len']
+
+
+def pack_documents(tokenizer, sentences, seq_len, remainder=None):
+    """
+    Concatenates the documents into one stream separated by BOS tokens and cuts it into dense windows
+    of `seq_len` tokens, each of which starts with BOS. Returns the windows, the mask of the BOS tokens
+    the packing inserted (separators and window starts, as opposed to tokens of the text), and the tail
+    of the stream that did not fill a window, to be passed back as `remainder` with the next documents.
+    """
+    bos_id = tokenizer.bos_token_id
+    stream, inserted = ([], []) if remainder is None else (list(remainder[0]), list(remainder[1]))
+    for ids in tokenizer(sentences, add_special_tokens=False)['input_ids']:
+        if len(stream) > 0:
+            stream.append(bos_id)
+            inserted.append(True)
+        stream.extend(ids)
+        inserted.extend([False] * len(ids))
+    width = seq_len - 1
+    n_windows = len(stream) // width
+    if n_windows == 0:
+        return torch.zeros((0, seq_len), dtype=torch.long), torch.zeros((0, seq_len), dtype=torch.bool), (stream, inserted)
+    body = torch.tensor(stream[:n_windows * width], dtype=torch.long).reshape(n_windows, width)
+    body_inserted = torch.tensor(inserted[:n_windows * width], dtype=torch.bool).reshape(n_windows, width)
+    windows = torch.cat([torch.full((n_windows, 1), bos_id, dtype=torch.long), body], 1)
+    windows_inserted = torch.cat([torch.ones((n_windows, 1), dtype=torch.bool), body_inserted], 1)
+    return windows, windows_inserted, (stream[n_windows * width:], inserted[n_windows * width:])
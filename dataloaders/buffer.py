@@ -0,0 +1,144 @@
+import torch
+from logger import logger
+
+# largest magnitude of the code of every compressed format
+CODE_MAX = {
+    'int8': 127.,
+    'fp8': 448., # float8_e4m3fn
+}
+
+
+class ActivationBuffer:
+    """
+    The shuffle buffer of the AE dataloader, n_rows * width activations. With dtype 'bf16' the rows are
+    stored as they are; with 'int8' or 'fp8' every row is stored as 1-byte codes and a float32 scale
+    (its absolute maximum over the largest code), optionally after subtracting a running mean of the
+    activations (`center`). Every refill centers its rows on the running mean so far; the rows it does
+    not overwrite keep the index of the mean they were encoded with. Rows are decoded to bfloat16 when
+    they are read, and the relative squared error the compression adds is measured while the buffer is filled.
+    """
+    def __init__(self, n_rows, width, dtype='bf16', center=False):
+        assert dtype == 'bf16' or dtype in CODE_MAX, 'Unknown buffer dtype {}, please choose from: {}.'.format(dtype, ['bf16'] + list(CODE_MAX.keys()))
+        self.dtype = dtype
+        self.center = center
+        if dtype == 'bf16':
+            self.data = torch.zeros((n_rows, width), dtype=torch.bfloat16)
+        else:
+            self.data = torch.zeros((n_rows, width), dtype=torch.int8 if dtype == 'int8' else torch.float8_e4m3fn)
+            self.scales = torch.zeros(n_rows, dtype=torch.float32)
+        # the means the rows are centered on, the index of the one of every row and of the one new rows use,
+        # and the running mean over everything written so far
+        self.means = torch.zeros((1, width), dtype=torch.float32)
+        self.mean_idx = torch.zeros(n_rows, dtype=torch.long)
+        self.current_mean = 0
+        self.running_mean = None
+        self.n_seen = 0
+        self.reset_error()
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def reset_error(self):
+        self.error_sum = 0.
+        self.norm_sum = 0.
+
+    def begin_fill(self):
+        """
+        Called before the buffer is refilled: the new rows are centered on the running mean so far. The
+        means no row refers to any more are dropped.
+        """
+        self.reset_error()
+        if self.center and self.running_mean is not None:
+            used = torch.unique(self.mean_idx)
+            self.mean_idx = torch.searchsorted(used, self.mean_idx)
+            self.means = torch.cat([self.means[used], self.running_mean.unsqueeze(0)])
+            self.current_mean = self.means.shape[0] - 1
+
+    def update_mean(self, acts):
+        batch_mean = acts.float().mean(0).cpu()
+        if self.running_mean is None:
+            self.running_mean = batch_mean
+            if self.center:
+                # the first fill is centered on its first rows
+                self.means[self.current_mean] = batch_mean
+        else:
+            self.running_mean += (batch_mean - self.running_mean) * acts.shape[0] / (self.n_seen + acts.shape[0])
+        self.n_seen += acts.shape[0]
+
+    def encode(self, acts):
+        acts = acts.float()
+        if self.center:
+            acts = acts - self.means[self.current_mean].to(acts.device)
+        scales = acts.abs().amax(-1).clamp(min=1e-8) / CODE_MAX[self.dtype]
+        codes = acts / scales.unsqueeze(-1)
+        if self.dtype == 'int8':
+            codes = codes.round().clamp(-127, 127).to(torch.int8)
+        else:
+            codes = codes.to(torch.float8_e4m3fn)
+        return codes, scales
+
+    def decode(self, codes, scales, means=None):
+        """
+        `means` are the means the rows were centered on, the one of the current fill by default.
+        """
+        acts = codes.float() * scales.unsqueeze(-1).to(codes.device)
+        if self.center:
+            if means is None:
+                means = self.means[self.current_mean]
+            acts = acts + means.to(codes.device)
+        return acts
+
+    def __setitem__(self, idx, acts):
+        if acts.shape[0] == 0:
+            return
+        if self.center:
+            self.update_mean(acts)
+        if self.dtype == 'bf16':
+            self.data[idx] = acts.to(self.data.device, torch.bfloat16)
+            return
+        # encoded on the device of the activations, only the codes are copied to the host
+        codes, scales = self.encode(acts)
+        error, norm = torch.stack([
+            (self.decode(codes, scales) - acts.float()).pow(2).sum(),
+            acts.float().pow(2).sum(),
+        ]).tolist()
+        self.error_sum += error
+        self.norm_sum += norm
+        self.data[idx] = codes.cpu()
+        self.scales[idx] = scales.cpu()
+        self.mean_idx[idx] = self.current_mean
+
+    def __getitem__(self, idx):
+        if self.dtype == 'bf16':
+            return self.data[idx]
+        return self.decode(self.data[idx], self.scales[idx], self.means[self.mean_idx[idx]]).to(torch.bfloat16)
+
+    def permute_(self, perm):
+        self.data = self.data[perm]
+        if self.dtype != 'bf16':
+            self.scales = self.scales[perm]
+            self.mean_idx = self.mean_idx[perm]
+        return self
+
+    def get_error(self):
+        """
+        ||decoded - acts||^2 / ||acts||^2 over the rows written since the last fill began.
+        """
+        return self.error_sum / self.norm_sum if self.norm_sum > 0 else 0.
+
+    def get_nbytes(self):
+        nbytes = self.data.numel() * self.data.element_size()
+        if self.dtype != 'bf16':
+            nbytes += self.scales.numel() * self.scales.element_size()
+        if self.center and self.dtype != 'bf16':
+            nbytes += self.mean_idx.numel() * self.mean_idx.element_size() + self.means.numel() * self.means.element_size()
+        return nbytes
+
+    def log_fill(self, name):
+        if self.dtype != 'bf16':
+            logger.info('{} buffer ({}, {:.1f} MB): relative reconstruction error {:.3e}'.format(
+                name, self.dtype, self.get_nbytes() / 2**20, self.get_error()))
@@ -1,14 +1,14 @@
-from .pile import PileDataset
-from .harmful_qa import HarmFulQADataset
-from .conceptx_data import ConceptXData
-from .conceptx_naive import ConceptXNaiveDataset
+from registry import LazyRegistry
 
-DATASETS = {
-    PileDataset.code(): PileDataset,
-    HarmFulQADataset.code(): HarmFulQADataset,
-    ConceptXData.code(): ConceptXData,
-    ConceptXNaiveDataset.code(): ConceptXNaiveDataset,
-}
+DATASETS = LazyRegistry(__name__, {
+    'pile': '.pile:PileDataset',
+    'HarmfulQA': '.harmful_qa:HarmFulQADataset',
+    'conceptx': '.conceptx_data:ConceptXData',
+    'conceptx_naive': '.conceptx_naive:ConceptXNaiveDataset',
+})
+
+def __getattr__(name):
+    return DATASETS.get_class(name)
 
 def dataset_factory(cfg):
     dataset = DATASETS[cfg['dataset_name']]
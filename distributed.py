@@ -0,0 +1,219 @@
+import os
+import sys
+import json
+import time
+import glob
+import hashlib
+import subprocess
+import torch
+from logger import logger
+
+EVAL_SET_NAME = 'eval_set.pt'
+RUN_NAME = 'run.json'
+
+
+class FileQueue:
+    """
+    A task queue in a directory that every worker can reach (a local or a shared file system).
+    Tasks are JSON files that move from pending/ to claimed/ to done/; a claim is an atomic rename,
+    so every task is evaluated by exactly one worker at a time. Claims that are older than
+    `lease` seconds are considered lost and put back into pending/.
+    """
+    def __init__(self, root, lease=3600.):
+        self.root = root
+        self.lease = lease
+        for d in ['pending', 'claimed', 'done']:
+            os.makedirs(os.path.join(root, d), exist_ok=True)
+
+    def path(self, state, task_id):
+        return os.path.join(self.root, state, task_id + '.json')
+
+    def task_ids(self, state):
+        return sorted(os.path.basename(p)[:-len('.json')] for p in glob.glob(os.path.join(self.root, state, '*.json')))
+
+    def write(self, path, obj):
+        with open(path + '.tmp', 'w') as f:
+            json.dump(obj, f)
+        os.replace(path + '.tmp', path)
+
+    def put(self, task):
+        self.write(self.path('pending', task['task_id']), task)
+
+    def claim(self):
+        for task_id in self.task_ids('pending'):
+            try:
+                os.rename(self.path('pending', task_id), self.path('claimed', task_id))
+            except FileNotFoundError:
+                # another worker was faster
+                continue
+            # the mtime of the claim is the start of the lease
+            os.utime(self.path('claimed', task_id))
+            with open(self.path('claimed', task_id), 'r') as f:
+                return json.load(f)
+        return None
+
+    def complete(self, task, result):
+        self.write(self.path('done', task['task_id']), dict(task, result=result))
+        if os.path.exists(self.path('claimed', task['task_id'])):
+            os.remove(self.path('claimed', task['task_id']))
+
+    def requeue_expired(self):
+        for task_id in self.task_ids('claimed'):
+            path = self.path('claimed', task_id)
+            try:
+                expired = time.time() - os.path.getmtime(path) > self.lease
+                if expired:
+                    os.rename(path, self.path('pending', task_id))
+                    logger.info('Requeued task {} after its lease expired'.format(task_id))
+            except FileNotFoundError:
+                continue
+
+    def bind_run(self, run_hash):
+        """
+        Ties the queue to the evaluation identified by `run_hash`, so that the done tasks of another
+        evaluation (e.g. on another random evaluation set) are never merged into this one.
+        """
+        path = os.path.join(self.root, RUN_NAME)
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                previous = json.load(f)['run_hash']
+        elif any(len(self.task_ids(state)) > 0 for state in ['pending', 'claimed', 'done']):
+            previous = None
+        else:
+            self.write(path, {'run_hash': run_hash})
+            return
+        if previous != run_hash:
+            raise RuntimeError('{} holds the tasks of another evaluation (evaluation set, concepts, evaluators or task split), please use a fresh --queue_dir or remove it.'.format(self.root))
+
+    def is_drained(self):
+        return len(self.task_ids('pending')) == 0 and len(self.task_ids('claimed')) == 0
+
+
+def split_tasks(n_subdatasets, n_concepts, subdatasets_per_task, concepts_per_task):
+    """
+    Cuts the (sub-dataset, concept) grid into blocks. All evaluators of a cell are kept in the same task,
+    as the 'replace-ablation' evaluators reuse the per-token metrics of 'ablation' and 'replace'.
+    """
+    tasks = []
+    for i in range(0, n_subdatasets, subdatasets_per_task):
+        for j in range(0, n_concepts, concepts_per_task):
+            tasks.append({
+                'task_id': 'task-{:06d}-{:06d}'.format(i, j),
+                'subdataset_idxs': list(range(i, min(i + subdatasets_per_task, n_subdatasets))),
+                'concept_positions': list(range(j, min(j + concepts_per_task, n_concepts))),
+            })
+    return tasks
+
+
+def get_run_hash(cfg, metric_evaluator, tokens, origin_tokens, evaluator_names, concepts, concept_idxs):
+    """
+    Identifies what the tasks of a queue evaluate: the evaluation set and the metric settings (as in the
+    result store), the concepts, the evaluators and the task split.
+    """
+    settings = {
+        'eval_hash': metric_evaluator.get_eval_hash(origin_tokens, tokens, concepts),
+        'evaluators': list(evaluator_names),
+        'concept_idxs': [int(i) for i in concept_idxs],
+        'split': [cfg[key] for key in ['metric_eval_batchsize', 'subdatasets_per_task', 'concepts_per_task']],
+    }
+    return hashlib.sha1(json.dumps(settings).encode()).hexdigest()
+
+
+def save_eval_set(queue_dir, tokens, origin_tokens, concepts, concept_idxs):
+    path = os.path.join(queue_dir, EVAL_SET_NAME)
+    torch.save({
+        'tokens': tokens.cpu(),
+        'origin_tokens': origin_tokens.cpu(),
+        'concepts': concepts.detach().cpu(),
+        'concept_idxs': list(concept_idxs),
+    }, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def load_eval_set(queue_dir, device, timeout=3600., poll=1.):
+    """
+    The evaluation tokens and concepts published by the coordinator, so that every worker evaluates the same cells.
+    """
+    path = os.path.join(queue_dir, EVAL_SET_NAME)
+    start = time.time()
+    while not os.path.exists(path):
+        if time.time() - start > timeout:
+            raise TimeoutError('No evaluation set was published in {}'.format(queue_dir))
+        time.sleep(poll)
+    eval_set = torch.load(path)
+    return eval_set['tokens'], eval_set['origin_tokens'], eval_set['concepts'].to(device), eval_set['concept_idxs']
+
+
+def spawn_local_workers(n_workers):
+    """
+    Starts `n_workers` workers on this host, with the command line of the coordinator.
+    """
+    return [
+        subprocess.Popen([sys.executable] + sys.argv + ['--distributed_role', 'worker'])
+        for _ in range(n_workers)
+    ]
+
+
+def run_coordinator(cfg, metric_evaluator, tokens, origin_tokens, evaluator_names, concepts, concept_idxs):
+    """
+    Splits the rc evaluation into tasks, waits for the workers and merges their results into the
+    n_metrics * n_minibatch * n_concepts tensor `get_consistency` expects.
+    """
+    assert cfg['metric_evaluator'] == 'rc', "Distributed evaluation is only supported for the 'rc' metric evaluator."
+    queue = FileQueue(cfg['queue_dir'], cfg['task_lease'])
+    queue.bind_run(get_run_hash(cfg, metric_evaluator, tokens, origin_tokens, evaluator_names, concepts, concept_idxs))
+    n_subdatasets = metric_evaluator.get_n_subdatasets(tokens)
+    tasks = split_tasks(n_subdatasets, len(concept_idxs), cfg['subdatasets_per_task'], cfg['concepts_per_task'])
+    done = set(queue.task_ids('done'))
+    for task in tasks:
+        if task['task_id'] not in done:
+            queue.put(task)
+    # published after the tasks, a worker that sees the evaluation set also sees a non-empty queue
+    save_eval_set(cfg['queue_dir'], tokens, origin_tokens, concepts, concept_idxs)
+    logger.info('Submitted {} tasks to {} ({} already done)'.format(len(tasks) - len(done), cfg['queue_dir'], len(done)))
+
+    assert cfg['load_extractor'], "Workers load the extractor from 'load_path', please run the coordinator with --load_extractor."
+    workers = spawn_local_workers(cfg['local_workers'])
+    while not queue.is_drained():
+        queue.requeue_expired()
+        if len(workers) > 0 and all(w.poll() is not None for w in workers) and not queue.is_drained():
+            raise RuntimeError('All local workers exited before the queue was drained.')
+        time.sleep(cfg['queue_poll'])
+    for w in workers:
+        w.wait()
+
+    separate_metrics = torch.full((len(evaluator_names), n_subdatasets, len(concept_idxs)), float('nan'))
+    for task in tasks:
+        with open(queue.path('done', task['task_id']), 'r') as f:
+            result = torch.tensor(json.load(f)['result']) # n_metrics, n_task_subdatasets, n_task_concepts
+        rows = torch.tensor(task['subdataset_idxs'])
+        cols = torch.tensor(task['concept_positions'])
+        separate_metrics[:, rows.unsqueeze(1), cols.unsqueeze(0)] = result
+    return metric_evaluator.get_consistency(separate_metrics, evaluator_names)
+
+
+def run_worker(cfg, metric_evaluator, tokens, evaluator_dict, concepts, concept_idxs):
+    """
+    Evaluates tasks until the queue is drained.
+    """
+    assert cfg['load_extractor'], "Workers load the extractor from 'load_path', please run them with --load_extractor."
+    queue = FileQueue(cfg['queue_dir'], cfg['task_lease'])
+    n_tasks = 0
+    while True:
+        task = queue.claim()
+        if task is None:
+            if queue.is_drained():
+                break
+            time.sleep(cfg['queue_poll'])
+            continue
+        positions = task['concept_positions']
+        result = metric_evaluator.get_separate_metrics(
+            tokens,
+            evaluator_dict,
+            concepts[positions],
+            [concept_idxs[p] for p in positions],
+            subdataset_idxs=task['subdataset_idxs'],
+        )
+        queue.complete(task, result.tolist())
+        n_tasks += 1
+    logger.info('Worker {} evaluated {} tasks'.format(os.getpid(), n_tasks))
@@ -1,13 +1,14 @@
-from .itc import InputTopicCoherenceEvaluator
-from .otc import OutputTopicCoherenceEvaluator
-from .faithfulness import FaithfulnessEvaluator
+from registry import LazyRegistry
 
-EVALUATORS = {
-    InputTopicCoherenceEvaluator.code(): InputTopicCoherenceEvaluator,
-    OutputTopicCoherenceEvaluator.code(): OutputTopicCoherenceEvaluator,
-    FaithfulnessEvaluator.code(): FaithfulnessEvaluator,
-}
+EVALUATORS = LazyRegistry(__name__, {
+    'itc': '.itc:InputTopicCoherenceEvaluator',
+    'otc': '.otc:OutputTopicCoherenceEvaluator',
+    'faithfulness': '.faithfulness:FaithfulnessEvaluator',
+})
+
+def __getattr__(name):
+    return EVALUATORS.get_class(name)
 
 def evaluator_factory(cfg, activation_func, model, **kwargs):
     evaluator = EVALUATORS[cfg['evaluator']]
-    return evaluator(cfg, activation_func, model, **kwargs)
\ No newline at end of file
+    return evaluator(cfg, activation_func, model, **kwargs)
@@ -1,12 +1,14 @@
 from abc import *
+import re
 import torch
 import numpy as np
-import pandas as pd
 from tqdm import tqdm
 from logger import logger
+from instrument import instrument
+from pipeline import get_pipeline
+from autotune import get_tuner
+from compiled import get_compiled_forwards
 from functools import partial
-from sklearn.cluster import KMeans
-from sklearn import metrics
 from utils import *
 import torch.nn.functional as F
 
@@ -21,6 +23,9 @@ class BaseEvaluator(metaclass=ABCMeta):
         self.activation_func = activation_func
         self.cfg = cfg
         self.model = model
+        self.pipeline = get_pipeline(cfg, model)
+        self.tuner = get_tuner(cfg, model)
+        self.compiled = get_compiled_forwards(cfg, model, self.get_resume_layer())
 
     @classmethod
     @abstractmethod
@@ -44,6 +49,65 @@ class BaseEvaluator(metaclass=ABCMeta):
     def update_concept(self):
         pass
     
+    def run_with_hooks(self, tokens, fwd_hooks=[], **kwargs):
+        """
+        `model.run_with_hooks`, streamed through the micro-batch pipeline if the model is split into stages.
+        """
+        if self.pipeline is None:
+            return self.model.run_with_hooks(tokens, fwd_hooks=fwd_hooks, **kwargs)
+        return self.pipeline.run_with_hooks(tokens, fwd_hooks=fwd_hooks, **kwargs)
+    
+    def split_eval_tokens(self, eval_tokens, stage, fn):
+        """
+        The minibatches of the evaluation corpus, of the size the batch tuner picked for `stage` if
+        cfg['autotune_batch'], else of concept_eval_batchsize rows.
+        """
+        minibatch = self.cfg['concept_eval_batchsize']
+        if self.tuner is not None:
+            minibatch = self.tuner.get_batch_size(stage, fn, eval_tokens, minibatch)
+        return eval_tokens.split(minibatch, dim=0)
+
+    def run_minibatch(self, stage, fn, tokens):
+        """
+        `fn(tokens)`, split and retried in halves if it runs out of memory and autotuning is on.
+        """
+        if self.tuner is None:
+            return fn(tokens)
+        return self.tuner.run_split(stage, fn, tokens)
+    
+    def get_resume_layer(self):
+        """
+        The layer a disturbed forward pass can resume from, if the hooked activation is the residual
+        stream between two blocks. None if the whole model has to be rerun with the hook.
+        """
+        if not self.cfg['resume_from_layer'] or self.pipeline is not None:
+            return None
+        match = re.fullmatch(r'blocks\.(\d+)\.hook_resid_(pre|post)', self.cfg['act_name'])
+        if match is None:
+            return None
+        layer = int(match.group(1))
+        return layer + 1 if match.group(2) == 'post' else layer
+
+    def run_clean_and_disturbed(self, tokens, hook, concept, activations, **kwargs):
+        """
+        The outputs of the clean and of the disturbed forward pass, `hook` being called with `concept` and
+        `activations`. When possible, the clean residual at act_name is captured by the clean pass, disturbed
+        by `hook` directly, and the disturbed pass resumes from the next layer instead of recomputing the
+        identical prefix. With cfg['compile_forward'] this runs as one compiled function of the tensors.
+        """
+        if self.compiled is not None:
+            return self.compiled.get(hook, **kwargs)(tokens, concept, activations)
+        hook = partial(hook, concept=concept, activations=activations)
+        resume_layer = self.get_resume_layer()
+        if resume_layer is None:
+            clean = self.run_with_hooks(tokens, **kwargs)
+            disturbed = self.run_with_hooks(tokens, fwd_hooks=[(self.cfg["act_name"], hook)], **kwargs)
+            return clean, disturbed
+        clean, cache = self.model.run_with_cache(tokens, names_filter=self.cfg["act_name"], **kwargs)
+        residual = hook(cache[self.cfg["act_name"]], hook=None)
+        disturbed = self.model(residual, start_at_layer=resume_layer, tokens=tokens, **kwargs)
+        return clean, disturbed
+    
     @staticmethod
     def ablation_hook(
         hidden_states, 
@@ -51,7 +115,7 @@ class BaseEvaluator(metaclass=ABCMeta):
         activations,
         concept, 
     ):
-        output = hidden_states - (activations.squeeze().unsqueeze(1) @ concept.unsqueeze(0)).reshape(hidden_states.shape)
+        output = hidden_states - (activations.reshape(-1, 1).to(hidden_states.dtype) @ concept.unsqueeze(0).to(hidden_states.dtype)).reshape(hidden_states.shape)
         return output
     
     @staticmethod
@@ -63,7 +127,7 @@ class BaseEvaluator(metaclass=ABCMeta):
         origin_mean = hidden_states.mean(dim=-1, keepdim=True)
         origin_std = hidden_states.std(dim=-1, keepdim=True)
         concept_renormed = (concept - concept.mean(dim=-1, keepdim=True)) / concept.std(dim=-1, keepdim=True)
-        output = concept_renormed * origin_std + origin_mean
+        output = concept_renormed.to(hidden_states.dtype) * origin_std + origin_mean
         return output
     
     def get_loss_diff(
@@ -73,22 +137,15 @@ class BaseEvaluator(metaclass=ABCMeta):
         hook,
         concept_act,
     ):
-        loss = self.model.run_with_hooks(
+        loss, loss_disturbed = self.run_clean_and_disturbed(
             tokens, 
+            hook, 
+            concept, 
+            concept_act,
             return_type='loss',
-            loss_per_token=True
-        )
-        
-        loss_disturbed = self.model.run_with_hooks(
-            tokens, 
-            return_type='loss', 
             loss_per_token=True,
-            fwd_hooks=[(
-                self.cfg["act_name"], 
-                partial(hook, concept=concept,activations=concept_act)
-            )]
         )
-        return (loss_disturbed - loss).cpu().numpy()
+        return (loss_disturbed - loss).float()
     
     def get_class_logit_diff(
         self, 
@@ -99,13 +156,11 @@ class BaseEvaluator(metaclass=ABCMeta):
         concept_act,
     ):
         # class_idx = -1 means the next token's idx
-        logits = self.model.run_with_hooks(tokens)
-        logits_disturbed = self.model.run_with_hooks(
+        logits, logits_disturbed = self.run_clean_and_disturbed(
             tokens, 
-            fwd_hooks=[(
-                self.cfg["act_name"], 
-                partial(hook, concept=concept,activations=concept_act))
-            ]
+            hook, 
+            concept, 
+            concept_act,
         )
         logits = logits[:,:-1,:]
         logits_disturbed = logits_disturbed[:,:-1,:]
@@ -124,7 +179,7 @@ class BaseEvaluator(metaclass=ABCMeta):
             logit_disturbed = logits_disturbed[:,:,class_idx]
         
         
-        return (logit_disturbed - logit).cpu().numpy()
+        return (logit_disturbed - logit).float()
     
     def get_loss_gradient(self, tokens):
         _, cache = self.model.run_with_cache(
@@ -133,13 +188,12 @@ class BaseEvaluator(metaclass=ABCMeta):
             incl_bwd=True, 
             names_filter=self.cfg["act_name"]
         )
-        grad = cache[self.cfg['act_name']+'_grad'].cpu().numpy()
-        hidden_state = cache[self.cfg['act_name']].cpu().numpy()
+        instrument.count('backward_passes')
+        grad = cache[self.cfg['act_name']+'_grad'].float()
+        hidden_state = cache[self.cfg['act_name']].float()
         return grad, hidden_state
     
     def get_class_logit_gradient(self, tokens, class_idx, concept_act):
-        grads = []
-        hidden_states = []
         _, cache = run_with_cache_top1logit_bkwd(
             tokens=tokens, 
             model=self.model,
@@ -148,10 +202,9 @@ class BaseEvaluator(metaclass=ABCMeta):
             concept_act=concept_act,
             cfg=self.cfg,
         )
-        grads.append(cache[self.cfg['act_name']+'_grad'].cpu().numpy())
-        hidden_states.append(cache[self.cfg['act_name']].cpu().numpy())
-        grad = np.array(grads)[0]
-        hidden_state = np.array(hidden_states)[0]
+        instrument.count('backward_passes')
+        grad = cache[self.cfg['act_name']+'_grad'].float()
+        hidden_state = cache[self.cfg['act_name']].float()
         return grad, hidden_state
 
     
@@ -209,13 +262,11 @@ class BaseEvaluator(metaclass=ABCMeta):
         corr_func='pearson',
         concept_act=None,
     ):
-        origin_logits = self.model.run_with_hooks(tokens)
-        disturbed_logits = self.model.run_with_hooks(
+        origin_logits, disturbed_logits = self.run_clean_and_disturbed(
             tokens, 
-            fwd_hooks=[(
-                self.cfg["act_name"], 
-                partial(hook, concept=concept,activations=concept_act)
-                )]
+            hook, 
+            concept, 
+            concept_act,
         )
         if topk != None:
             origin_values, origin_indices = torch.topk(
@@ -244,14 +295,14 @@ class BaseEvaluator(metaclass=ABCMeta):
             corr = 1 - (distributed_softmax - origin_softmax).square().mean(-1) / torch.var(origin_softmax, dim=-1)
         else:
             assert False, "Correlation type not supported yet. please choose from: ['pearson', 'KL_div', 'openai_var']."
-        return corr.cpu().numpy()
+        return corr.float()
     
     def get_preferred_predictions_of_concept(
         self, 
         tokens, 
         concept,
     ):
-        logits = self.model.run_with_hooks(
+        logits = self.run_with_hooks(
             tokens[:2], 
             fwd_hooks=[(
                 self.cfg["act_name"], 
@@ -266,9 +317,11 @@ class BaseEvaluator(metaclass=ABCMeta):
         return top_logits, most_preferred_tokens, topk_indices.detach().cpu().numpy()
     
     def get_silhouette_score(self, token_indices):
+        from sklearn.cluster import KMeans
+        from sklearn import metrics
         token_indices_unique = np.unique(token_indices)
-        X = self.model.embed.W_E.detach().cpu().numpy()[token_indices]
-        X_unique = self.model.embed.W_E.detach().cpu().numpy()[token_indices_unique]
+        X = self.model.embed.W_E.detach().cpu().float().numpy()[token_indices]
+        X_unique = self.model.embed.W_E.detach().cpu().float().numpy()[token_indices_unique]
         if X_unique.shape[0] == 0:
             best_num = 1. 
             best_score = 2. - X_unique.shape[0]
@@ -291,75 +344,59 @@ class BaseEvaluator(metaclass=ABCMeta):
         logger.info('Best number of clusters: {}, best silhouette score: {:.4f}'.format(best_num, best_score))
         return best_num, best_score
     
+    @instrument.timed('evaluator/get_most_critical_tokens')
     def get_most_critical_tokens(self, eval_tokens, concept=None, concept_idx=-1):   
+        import pandas as pd
              
         _, maxlen = eval_tokens.shape[0], eval_tokens.shape[1]
-        minibatch = self.cfg['concept_eval_batchsize']
-        eval_tokens = eval_tokens.split(minibatch, dim=0)
-            
-        results = []
-        for tokens in tqdm(eval_tokens, desc='Searching the corpus for the most critical token for the current concept'):
-            num_tokens = tokens.shape[0] * maxlen
-            concept_acts = self.activation_func(tokens, self.model, concept, concept_idx) # minibatch * maxlen
-            origin_acts = concept_acts # minibatch * maxlen
+        
+        # the running max importance of every vocabulary item over the whole corpus
+        token_imps = torch.full((self.model.cfg.d_vocab,), float('-inf'), device=self.cfg['device'])
+        padding_id = self.model.tokenizer.unk_token_id
+        
+        def search(tokens):
+            # only max-reductions into token_imps, so a minibatch can safely be rerun or split
+            origin_acts = self.activation_func(tokens, self.model, concept, concept_idx).float().reshape(tokens.shape[0], maxlen) # minibatch * maxlen
+            token_ids = tokens.to(origin_acts.device)
             
-            print('concept_acts.shape:',concept_acts.shape)
-
-            most_imp_actis = np.zeros([num_tokens])
-            most_imp_pos = np.zeros([num_tokens])
-            most_imp_tokens = np.zeros([num_tokens])
-            imp_this_token = np.zeros([num_tokens])
-
-            padding_id = self.model.tokenizer.unk_token_id
+            # for every position, the largest activation change caused by occluding another token, and that token
+            most_imp_actis = torch.zeros_like(origin_acts)
+            most_imp_tokens = torch.zeros_like(token_ids)
             for padding_position in range(maxlen):
                 tmp_tokens = tokens.clone()
                 tmp_tokens[:,padding_position] = padding_id
-                concept_acts = self.activation_func(tmp_tokens, self.model, concept, concept_idx) # minibatch * maxlen
+                concept_acts = self.activation_func(tmp_tokens, self.model, concept, concept_idx).float().reshape(tokens.shape[0], maxlen) # minibatch * maxlen
                 
                 acti_diff = origin_acts - concept_acts
-                acti_diff = acti_diff.detach().cpu().numpy()
-
-                mask = np.ones((tokens.shape[0], maxlen))
-                mask[:, padding_position] = 0
-                mask = mask.reshape((tokens.shape[0] * maxlen))
-                imp_this_token = np.where(mask == 0, acti_diff , imp_this_token)
                 
-                acti_diff =  acti_diff * mask
+                # importance of the occluded token for its own position
+                token_imps.scatter_reduce_(0, token_ids[:, padding_position].to(token_imps.device), acti_diff[:, padding_position].to(token_imps.device), reduce='amax')
+                acti_diff[:, padding_position] = 0.
                 
-                now_pos = np.array([padding_position for _ in range(tokens.shape[0] * maxlen)])
-                padding_token_id = np.tile(tokens[:,padding_position].unsqueeze(1).cpu().numpy(), [1, maxlen])
-                padding_token_id = padding_token_id.reshape((tokens.shape[0] * maxlen))
-
                 indices = most_imp_actis > acti_diff
-                most_imp_pos = np.where(indices, most_imp_pos , now_pos)
-                most_imp_tokens = np.where(indices, most_imp_tokens , padding_token_id)
-                most_imp_actis = np.where(indices, most_imp_actis , acti_diff)
-
-            tokens_reshaped = tokens.reshape((-1)).cpu().numpy()
-            df = pd.DataFrame(data=self.model.to_str_tokens(tokens_reshaped.astype(np.int32)), columns=["token"])
-            df_ctxt = pd.DataFrame(data=self.model.to_str_tokens(most_imp_tokens.astype(np.int32)), columns=["token"])
+                most_imp_tokens = torch.where(indices, most_imp_tokens, token_ids[:, padding_position].unsqueeze(1))
+                most_imp_actis = torch.where(indices, most_imp_actis, acti_diff)
             
-            df["token_idx"] = tokens_reshaped
-            df_ctxt["token_idx"] = most_imp_tokens
-            df["imp"] = imp_this_token
-            df_ctxt["imp"] = most_imp_actis
-            df_agg = df.groupby('token').agg('max').sort_values(by=['imp'],ascending=False)
-            df_ctxt_agg = df_ctxt.groupby('token').agg('max').sort_values(by=['imp'],ascending=False)
-
-            result = pd.concat([df_agg, df_ctxt_agg]).sort_values(by=['imp'],ascending=False).reset_index()
-            result = result.drop_duplicates(subset=['token'])
-            results.append(result[:50])
+            # importance of the occluded tokens for their context
+            token_imps.scatter_reduce_(0, most_imp_tokens.reshape(-1).to(token_imps.device), most_imp_actis.reshape(-1).to(token_imps.device), reduce='amax')
+        
+        for tokens in tqdm(self.split_eval_tokens(eval_tokens, 'occlusion', search), desc='Searching the corpus for the most critical token for the current concept'):
+            self.run_minibatch('occlusion', search, tokens)
         
-        df_final = pd.concat(results).groupby('token').agg('max').sort_values(by=['imp'],ascending=False).reset_index()[['token','imp','token_idx']]
-        df_final_show = df_final[:self.cfg['topic_len']]
-        df_final_show['token'] = df_final_show['token'].apply(lambda x:repr(x))
-        print('df_final:\n', df_final_show)
-        df_final = df_final[:self.cfg['topic_len']]
-        origin_df = df_final
-        df_most_critical_tokens = df_final['token'].apply(lambda x:x.lower()).values
+        # only the winners are decoded to strings
+        topic_len = min(self.cfg['topic_len'], int((token_imps > float('-inf')).sum()))
+        top_imps, top_idxs = torch.topk(token_imps, k=topic_len, sorted=True)
+        df_most_critical_token_idxs = top_idxs.cpu().numpy().astype('int32')
+        top_tokens = self.model.to_str_tokens(top_idxs.cpu()) if topic_len > 0 else []
+        origin_df = pd.DataFrame({
+            'token': top_tokens, 
+            'imp': top_imps.cpu().float().numpy(), 
+            'token_idx': df_most_critical_token_idxs,
+        })
+        logger.debug('df_final:\n{}'.format(origin_df.assign(token=[repr(t) for t in top_tokens])))
+        df_most_critical_tokens = np.array([t.lower() for t in top_tokens], dtype=str)
         
-        stripped_critical_tokens = np.array([t.strip() for t in df_most_critical_tokens])
-        df_most_critical_token_idxs = df_final['token_idx'].astype('int32').values
+        stripped_critical_tokens = np.array([t.strip() for t in df_most_critical_tokens], dtype=str)
         most_critical_token_idxs = df_most_critical_token_idxs.astype('int32')
         most_critical_tokens = np.where(stripped_critical_tokens != '', stripped_critical_tokens, df_most_critical_tokens)
         logger.info('The most critical tokens(after removing the spaces and changing to lower case): \n{}'.format(' '.join([repr(t) for t in most_critical_tokens])))
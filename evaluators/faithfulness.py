@@ -3,8 +3,72 @@ from .base import BaseEvaluator
 import torch
 import torch.nn as nn
 from logger import logger
+from instrument import instrument
 import numpy as np
 from tqdm import tqdm
+from utils import to_numpy
+from functools import partial
+
+# the aggregates a faithfulness evaluator can return, all of them only depend on the tokens where the concept is active
+RETURN_TYPES = ['avg_0max', 'weighted', 'weighted_normed', 'weighted_softmax']
+# the ablation measures whose disturbed forwards can be stacked over several concepts
+BATCHED_MEASURE_OBJS = ['loss', 'next_logit', 'pred_logit']
+
+class FaithfulnessAccumulator:
+    """
+    Running aggregates of the per-token metrics and concept activations, updated minibatch by
+    minibatch on the device in float64, so that a corpus of any size is evaluated in constant memory.
+    The softmax weights are tracked with an online log-sum-exp: the sums are kept relative to the
+    running maximum activation and rescaled whenever it grows.
+    """
+    def __init__(self):
+        self.sums = None
+
+    def update(self, metric, concept_act):
+        metric = metric.double()
+        concept_act = concept_act.double()
+        if self.sums is None:
+            # n_cells, n_pos, pos_sum, nonpos_sum, weighted_sum, origin_sum, act_l1
+            self.sums = torch.zeros(7, dtype=torch.float64, device=metric.device)
+            self.max_act = torch.zeros((), dtype=torch.float64, device=metric.device)
+            self.lse_max = torch.full((), -float('inf'), dtype=torch.float64, device=metric.device)
+            # sum of exp(act - lse_max) and of metric * exp(act - lse_max) over the active tokens
+            self.exp_sums = torch.zeros(2, dtype=torch.float64, device=metric.device)
+        pos = concept_act > 0
+        pos_act = concept_act * pos
+        self.sums += torch.stack([
+            metric.new_tensor(float(metric.numel())),
+            pos.sum(),
+            (metric * pos).sum(),
+            (metric * ~pos).sum(),
+            (metric * pos_act).sum(),
+            (metric * concept_act).sum(),
+            pos_act.sum(),
+        ])
+        self.max_act = torch.maximum(self.max_act, pos_act.max())
+
+        lse_max = torch.maximum(self.lse_max, concept_act.masked_fill(~pos, -float('inf')).max())
+        scale = torch.where(torch.isinf(self.lse_max), torch.zeros_like(lse_max), torch.exp(self.lse_max - lse_max))
+        weights = torch.exp(concept_act - lse_max).masked_fill(~pos, 0.)
+        self.exp_sums = self.exp_sums * scale + torch.stack([weights.sum(), (weights * metric).sum()])
+        self.lse_max = lse_max
+
+    def get_results(self):
+        """
+        The current estimate of every aggregate, with a single copy to the host.
+        """
+        n_cells, n_pos, pos_sum, nonpos_sum, weighted_sum, origin_sum, act_l1 = self.sums
+        results = torch.stack([
+            pos_sum / n_pos,
+            nonpos_sum / (n_cells - n_pos),
+            weighted_sum / n_cells,
+            origin_sum / n_cells,
+            weighted_sum / act_l1,
+            torch.where(self.exp_sums[0] > 0, self.exp_sums[1] / self.exp_sums[0], torch.zeros_like(self.exp_sums[0])),
+            self.max_act,
+        ]).tolist()
+        return dict(zip(['avg_0max', 'avg_0min', 'weighted', 'weighted_origin', 'weighted_normed', 'weighted_softmax', 'max_act'], results))
+
 
 class FaithfulnessEvaluator(nn.Module, BaseEvaluator):
     def __init__(
@@ -30,6 +94,9 @@ class FaithfulnessEvaluator(nn.Module, BaseEvaluator):
         self.class_idx = class_idx
         self.logits_corr_topk = logits_corr_topk
         self.return_type = cfg['return_type']
+        assert self.return_type in RETURN_TYPES, 'Unknown return_type {}, please choose from: {}.'.format(self.return_type, RETURN_TYPES)
+        # with gated ablation the metrics of the sequences where the concept is inactive are left at 0
+        self.gated = cfg['activation_gated_ablation'] and disturb != 'gradient'
         
     @classmethod
     def code(cls):
@@ -39,123 +106,243 @@ class FaithfulnessEvaluator(nn.Module, BaseEvaluator):
         self.concept = concept
         self.concept_idx = concept_idx
     
+    def get_ablation_metric(self, tokens, concept_act):
+        if self.measure_obj == 'logits':
+            metric = -self.get_logit_distribution_corr(
+                tokens, 
+                concept=self.concept, 
+                hook=self.ablation_hook, 
+                topk=self.logits_corr_topk, 
+                corr_func=self.corr_func,
+                concept_act=concept_act,
+            ) # minibatch * maxlen
+        elif self.measure_obj == 'loss':
+            metric = self.get_loss_diff(
+                tokens, 
+                concept=self.concept,
+                hook=self.ablation_hook,
+                concept_act=concept_act,
+            ) # minibatch * (maxlen-1)
+        elif self.measure_obj == 'next_logit':
+            metric = -self.get_class_logit_diff(
+                tokens,
+                concept=self.concept,
+                class_idx=-2,
+                hook=self.ablation_hook,
+                concept_act=concept_act,
+            ) # minibatch * maxlen
+        elif self.measure_obj == 'pred_logit':
+            metric = -self.get_class_logit_diff(
+                tokens,
+                concept=self.concept,
+                class_idx=-1,
+                hook=self.ablation_hook,
+                concept_act=concept_act,
+            ) # minibatch * maxlen
+        return metric
+
+    def get_gated_ablation_metric(self, tokens, concept_act):
+        """
+        Same as `get_ablation_metric`, but only the sequences where the concept is active somewhere are
+        disturbed. Every aggregate in RETURN_TYPES only reads the metrics where the activation is positive,
+        so the skipped sequences (whose metrics are left at 0) do not change the final metric; the
+        aggregates over inactive tokens (avg_0min, weighted_origin) are not reported.
+        """
+        concept_act = concept_act.reshape(tokens.shape[0], -1)
+        width = tokens.shape[1] if self.measure_obj == 'logits' else tokens.shape[1] - 1
+        metric = torch.zeros((tokens.shape[0], width), dtype=torch.float32, device=concept_act.device)
+        rows = torch.nonzero((concept_act > 0).any(-1)).squeeze(1)
+        instrument.count('gated_ablation/skipped_sequences', tokens.shape[0] - rows.shape[0])
+        if rows.shape[0] > 0:
+            active_metric = self.get_ablation_metric(tokens[rows.to(tokens.device)], concept_act[rows].reshape(-1))
+            metric[rows] = active_metric.float().reshape(rows.shape[0], width).to(metric.device)
+        return metric
+    
+    def get_minibatch_metric(self, tokens):
+        """
+        The per-token metrics and concept activations of one minibatch.
+        """
+        concept_act = self.activation_func(tokens, self.model, self.concept, self.concept_idx) # minibatch * maxlen
+        concept_act = concept_act.detach().float().reshape(tokens.shape[0], tokens.shape[1])
+        
+        if self.disturb == 'gradient':
+            if self.measure_obj == 'logits':
+                assert False, "When the disturbance type is 'gradient', the measurement object must be one of ['loss', 'class_logit']."
+            elif self.measure_obj == 'loss':
+                grads, hidden_state = self.get_loss_gradient(tokens)
+                metric = -(grads @ self.concept.float().to(grads.device)) # minibatch * maxlen
+            elif self.measure_obj == 'pred_logit':
+                grads, hidden_state = self.get_class_logit_gradient(tokens, -1, concept_act)
+                metric = grads @ self.concept.float().to(grads.device) # minibatch * maxlen
+            elif self.measure_obj == 'next_logit':
+                grads, hidden_state = self.get_class_logit_gradient(tokens, -2, concept_act)
+                metric = grads @ self.concept.float().to(grads.device) # minibatch * maxlen
+                
+            metric = metric[:,:-1]
+            self.model.zero_grad(set_to_none=True)
+            
+        elif self.disturb == 'ablation':
+            with torch.no_grad():
+                if self.cfg['activation_gated_ablation']:
+                    metric = self.get_gated_ablation_metric(tokens, concept_act)
+                else:
+                    metric = self.get_ablation_metric(tokens, concept_act)
+        metric = metric.detach().float().reshape(tokens.shape[0], -1)
+        return metric, concept_act
+
+    def can_batch_concepts(self):
+        """
+        Whether `get_concepts_metric` can evaluate several concepts with stacked disturbed forwards.
+        """
+        return self.disturb == 'ablation' and self.measure_obj in BATCHED_MEASURE_OBJS
+
+    @torch.no_grad()
+    def get_concept_acts(self, eval_tokens, concept, concept_idx):
+        """
+        The activations of one concept on the evaluation corpus, n_rows * maxlen.
+        """
+        return torch.cat([
+            self.activation_func(tokens, self.model, concept, concept_idx).detach().float().reshape(tokens.shape[0], -1)
+            for tokens in eval_tokens.split(self.cfg['concept_eval_batchsize'], dim=0)
+        ])
+
+    def get_token_measure(self, tokens, logits, pred_indices=None):
+        """
+        The per-token loss, or the logit of the true (next_logit) or of the predicted (pred_logit) next token.
+        """
+        logits = logits[:, :-1]
+        next_tokens = tokens[:, 1:].to(logits.device)
+        if self.measure_obj == 'loss':
+            return -logits.log_softmax(dim=-1).gather(-1, next_tokens.unsqueeze(-1)).squeeze(-1).float()
+        index = next_tokens if self.measure_obj == 'next_logit' else pred_indices
+        return logits.gather(-1, index.unsqueeze(-1)).squeeze(-1).float()
+
+    @torch.no_grad()
+    def get_clean_outputs(self, eval_tokens):
+        """
+        What `get_concepts_metric` needs from the clean forward pass, computed once for an evaluation corpus:
+        the clean per-token measure, the predicted next tokens for pred_logit, and the clean residual at
+        act_name if the disturbed forward can resume from it.
+        """
+        resume_layer = self.get_resume_layer()
+        clean = dict(measure=[], pred=[], residual=[])
+        for tokens in eval_tokens.split(self.cfg['concept_eval_batchsize'], dim=0):
+            if resume_layer is None:
+                logits = self.run_with_hooks(tokens)
+            else:
+                logits, cache = self.model.run_with_cache(tokens, names_filter=self.cfg['act_name'])
+                clean['residual'].append(cache[self.cfg['act_name']])
+            pred_indices = logits[:, :-1].argmax(dim=-1)
+            clean['measure'].append(self.get_token_measure(tokens, logits, pred_indices))
+            clean['pred'].append(pred_indices)
+        return {k: torch.cat(v) for k, v in clean.items() if len(v) > 0}
+
+    @staticmethod
+    def subtraction_hook(
+        hidden_states,
+        hook,
+        activations,
+    ):
+        return hidden_states - activations.reshape(hidden_states.shape).to(hidden_states.dtype)
+
+    def get_pairs_metric(self, eval_tokens, rows, concepts, concept_acts, clean):
+        """
+        The per-token metrics of (concept, sequence) pairs, all disturbed in one forward pass.
+        """
+        tokens = eval_tokens[rows.to(eval_tokens.device)]
+        dtype = self.model.cfg.dtype
+        # pairs * maxlen * d, the ablation of every pair by its own concept
+        delta = concept_acts.to(dtype).unsqueeze(-1) * concepts.to(dtype).unsqueeze(1)
+        if 'residual' in clean:
+            residual = clean['residual'][rows.to(clean['residual'].device)]
+            logits = self.model(residual - delta.to(residual.device), start_at_layer=self.get_resume_layer(), tokens=tokens)
+        else:
+            hook = partial(self.subtraction_hook, activations=delta.reshape(-1, delta.shape[-1]))
+            logits = self.run_with_hooks(tokens, fwd_hooks=[(self.cfg['act_name'], hook)])
+        rows = rows.to(clean['measure'].device)
+        metric = self.get_token_measure(tokens, logits, clean['pred'][rows].to(logits.device)) - clean['measure'][rows].to(logits.device)
+        return metric if self.measure_obj == 'loss' else -metric
+
+    @torch.no_grad()
+    def get_concepts_metric(self, eval_tokens, concepts, concept_acts, clean):
+        """
+        The final metrics of several concepts, the same as `update_concept` and `get_metric` for each of them.
+        The (concept, sequence) pairs are disturbed concept_eval_batchsize at a time, each concept ablated from
+        its own sequences, and compared to the clean outputs of `get_clean_outputs`. With gated ablation the
+        pairs where the concept is inactive are skipped.
+        """
+        n_concepts, n_rows = concept_acts.shape[0], concept_acts.shape[1]
+        pairs = torch.arange(n_concepts * n_rows, device=concept_acts.device)
+        if self.cfg['activation_gated_ablation']:
+            pairs = pairs[(concept_acts > 0).any(-1).reshape(-1)]
+            instrument.count('gated_ablation/skipped_sequences', n_concepts * n_rows - pairs.shape[0])
+        metrics = torch.zeros((n_concepts, n_rows, eval_tokens.shape[1] - 1), dtype=torch.float32, device=concept_acts.device)
+        concepts = concepts.to(concept_acts.device)
+        for chunk in pairs.split(self.cfg['concept_eval_batchsize']):
+            concept_ids, rows = chunk // n_rows, chunk % n_rows
+            metric = self.get_pairs_metric(eval_tokens, rows, concepts[concept_ids], concept_acts[concept_ids, rows], clean)
+            metrics[concept_ids, rows] = metric.to(metrics.device)
+        results = []
+        for metric, concept_act in zip(metrics, concept_acts):
+            accumulator = FaithfulnessAccumulator()
+            accumulator.update(metric, concept_act[:, :metric.shape[1]])
+            results.append(accumulator.get_results()[self.return_type])
+        return results
+
+    @instrument.timed('evaluator/faithfulness')
     def get_metric(self, eval_tokens, pre_metrics=None, pre_concept_acts=None, return_metric_and_acts=False,**kwargs):
         
-        _, maxlen = eval_tokens.shape[0], eval_tokens.shape[1]
-        minibatch = self.cfg['concept_eval_batchsize']
-        eval_tokens = eval_tokens.split(minibatch, dim=0)
+        n_rows, maxlen = eval_tokens.shape[0], eval_tokens.shape[1]
+        accumulator = FaithfulnessAccumulator()
             
-        metrics = []
-        concept_acts = []
         if pre_metrics is None:
-            params = self.model.parameters()
-            optimizer = torch.optim.Adam(params, lr=0.001)
-            for tokens in tqdm(eval_tokens, desc='Traverse the evaluation corpus to calculate metrics'):            
-                
-                concept_act = self.activation_func(tokens, self.model, self.concept, self.concept_idx) # minibatch * maxlen
-                concept_acts.append(concept_act.cpu().reshape(tokens.shape[0], maxlen).numpy())
+            stage = '{}_{}'.format(self.disturb, self.measure_obj)
+            # the per-token results are only kept (on the device, copied to the host once) if the caller needs them
+            metrics = None
+            concept_acts = None
+            row = 0
+            progress = tqdm(self.split_eval_tokens(eval_tokens, stage, self.get_minibatch_metric), desc='Traverse the evaluation corpus to calculate metrics')
+            for i, tokens in enumerate(progress):            
+                metric, concept_act = self.run_minibatch(stage, self.get_minibatch_metric, tokens)
+                accumulator.update(metric, concept_act[:, :metric.shape[1]].to(metric.device))
+                if self.cfg['faithfulness_log_every'] > 0 and (i + 1) % self.cfg['faithfulness_log_every'] == 0:
+                    progress.set_postfix({self.return_type: '{:.4E}'.format(accumulator.get_results()[self.return_type])})
                 
-                if self.disturb == 'gradient':
-                    if self.measure_obj == 'logits':
-                        assert False, "When the disturbance type is 'gradient', the measurement object must be one of ['loss', 'class_logit']."
-                    elif self.measure_obj == 'loss':
-                        grads, hidden_state = self.get_loss_gradient(tokens)
-                        metric = -(grads @ self.concept.cpu().numpy().T).squeeze() # minibatch * maxlen
-                    elif self.measure_obj == 'pred_logit':
-                        grads, hidden_state = self.get_class_logit_gradient(tokens, -1, concept_act)
-                        metric = (grads @ self.concept.cpu().numpy().T).squeeze() # minibatch * maxlen
-                    elif self.measure_obj == 'next_logit':
-                        grads, hidden_state = self.get_class_logit_gradient(tokens, -2, concept_act)
-                        metric = (grads @ self.concept.cpu().numpy().T).squeeze() # minibatch * maxlen
-                        
-                    metric = metric[:,:-1]
-                    optimizer.zero_grad()
-                    
-                elif self.disturb == 'ablation':
-                    with torch.no_grad():
-                        if self.measure_obj == 'logits':
-                            metric = -self.get_logit_distribution_corr(
-                                tokens, 
-                                concept=self.concept, 
-                                hook=self.ablation_hook, 
-                                topk=self.logits_corr_topk, 
-                                corr_func=self.corr_func,
-                                concept_act=concept_act,
-                            ) # minibatch * maxlen
-                        elif self.measure_obj == 'loss':
-                            metric = self.get_loss_diff(
-                                tokens, 
-                                concept=self.concept,
-                                hook=self.ablation_hook,
-                                concept_act=concept_act,
-                            ) # minibatch * (maxlen-1)
-                        elif self.measure_obj == 'next_logit':
-                            metric = -self.get_class_logit_diff(
-                                tokens,
-                                concept=self.concept,
-                                class_idx=-2,
-                                hook=self.ablation_hook,
-                                concept_act=concept_act,
-                            ) # minibatch * maxlen
-                        elif self.measure_obj == 'pred_logit':
-                            metric = -self.get_class_logit_diff(
-                                tokens,
-                                concept=self.concept,
-                                class_idx=-1,
-                                hook=self.ablation_hook,
-                                concept_act=concept_act,
-                            ) # minibatch * maxlen
-                metrics.append(metric)
-            concept_acts = np.concatenate(concept_acts, axis=0)
-            metrics = np.concatenate(metrics, axis=0)
+                if return_metric_and_acts:
+                    if metrics is None:
+                        metrics = torch.empty((n_rows, metric.shape[1]), dtype=torch.float32, device=metric.device)
+                        concept_acts = torch.empty((n_rows, maxlen), dtype=torch.float32, device=concept_act.device)
+                    metrics[row:row + tokens.shape[0]] = metric
+                    concept_acts[row:row + tokens.shape[0]] = concept_act
+                row += tokens.shape[0]
+            if return_metric_and_acts:
+                metrics, concept_acts = to_numpy(metrics, concept_acts)
+                concept_acts = concept_acts[:,:metrics.shape[1]]
+                concept_acts = concept_acts * (concept_acts > 0.)
         else:
             metrics = pre_metrics
-            concept_acts = pre_concept_acts
-        
-        
-        concept_acts = concept_acts[:,:metrics.shape[1]]
+            concept_acts = pre_concept_acts[:,:metrics.shape[1]]
+            accumulator.update(torch.as_tensor(np.asarray(metrics)), torch.as_tensor(np.asarray(concept_acts)))
         
-        origin_acts = concept_acts
-        concept_acts = concept_acts * (concept_acts > 0.)
-        
-        pos_act_metric = metrics[concept_acts>0].mean()
-        
-        pos_act_metric_0min = metrics[concept_acts<=0*concept_acts.max()].mean()
-        
-        weighted_metric = (metrics * concept_acts).mean()
-        
-        weighted_origin_metric = (metrics * origin_acts).mean()
-    
-        normed_concept_acts = concept_acts / torch.tensor(concept_acts).norm(p=1, keepdim=True).numpy()
-        weighted_normed_metric = (metrics * normed_concept_acts).sum()
-            
-        softmax_concept_acts = torch.softmax(torch.tensor(concept_acts[concept_acts>0]), dim=-1).numpy()
-        weighted_softmax_metric = (metrics[concept_acts>0] * softmax_concept_acts).sum()
-            
+        results = accumulator.get_results()
         logger.info('Faithfulness Metrics ({} {} {} logits_corr_topk={})'.format(
             self.disturb, 
             self.measure_obj, 
             self.corr_func, 
             self.logits_corr_topk
         ))    
-        logger.info('avg where concept activation < 0: {:4E}'.format(pos_act_metric_0min))    
-        logger.info('max activation: {:4E}'.format(concept_acts.max()))    
-        logger.info('weighted avg by concept activation: {:4E}'.format(weighted_metric))    
-        logger.info('weighted avg by origin concept activation: {:4E}'.format(weighted_origin_metric))  
-        logger.info('weighted sum by 1-normed concept activation: {:4E}'.format(weighted_normed_metric))  
-        logger.info('weighted sum by softmaxed concept activation: {:4E}'.format(weighted_softmax_metric))
-        if self.return_type == 'avg_0max':
-            final_metric = pos_act_metric
-        elif self.return_type == 'weighted':
-            final_metric = weighted_metric
-        elif self.return_type == 'weighted_normed':
-            final_metric = weighted_normed_metric
-        elif self.return_type == 'weighted_softmax':
-            final_metric = weighted_softmax_metric
+        if not self.gated:
+            logger.info('avg where concept activation < 0: {:4E}'.format(results['avg_0min']))    
+        logger.info('max activation: {:4E}'.format(results['max_act']))    
+        logger.info('weighted avg by concept activation: {:4E}'.format(results['weighted']))    
+        if not self.gated:
+            logger.info('weighted avg by origin concept activation: {:4E}'.format(results['weighted_origin']))  
+        logger.info('weighted sum by 1-normed concept activation: {:4E}'.format(results['weighted_normed']))  
+        logger.info('weighted sum by softmaxed concept activation: {:4E}'.format(results['weighted_softmax']))
+        final_metric = results[self.return_type]
         logger.info('final metric: {:4E}'.format(final_metric))     
         
         if return_metric_and_acts:
             return final_metric, metrics, concept_acts
         else:
             return final_metric 
-            
\ No newline at end of file
@@ -1,6 +1,7 @@
 from .base import BaseEvaluator
 import torch.nn as nn
 from logger import logger
+from instrument import instrument
 import numpy as np
 
 class InputTopicCoherenceEvaluator(nn.Module, BaseEvaluator):
@@ -32,6 +33,7 @@ class InputTopicCoherenceEvaluator(nn.Module, BaseEvaluator):
         self.pmi_type = pmi_type
         
     
+    @instrument.timed('evaluator/itc')
     def get_metric(self, eval_tokens, topic_tokens=None, topic_idxs=None, origin_topic_idxs=None, return_tokens=False, **kwargs):
         if topic_tokens is None:
             most_critical_tokens, most_critical_token_idxs, origin_df, origin_critical_token_idxs = self.get_most_critical_tokens(eval_tokens, self.concept, self.concept_idx)
@@ -3,6 +3,7 @@ from .base import BaseEvaluator
 import torch
 import torch.nn as nn
 from logger import logger
+from instrument import instrument
 import numpy as np
 
 class OutputTopicCoherenceEvaluator(nn.Module, BaseEvaluator):
@@ -34,6 +35,7 @@ class OutputTopicCoherenceEvaluator(nn.Module, BaseEvaluator):
         self.concept = concept
         self.concept_idx = concept_idx
     
+    @instrument.timed('evaluator/otc')
     def get_metric(self, eval_tokens, return_tokens=False, **kwargs):
         _, most_preferred_tokens, topk_indices = self.get_preferred_predictions_of_concept(eval_tokens, self.concept)
         topk_indices = topk_indices[most_preferred_tokens != '\ufffd']
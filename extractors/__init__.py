@@ -1,19 +1,18 @@
-from .ae import AutoEncoder
-from .tcav import TCAVExtractor
-from .conceptx import ConceptX
-from .neuron import Neuron
-from .conceptx_ori import ConceptXOri
+from registry import LazyRegistry
 
-EXTRACTORS = {
-    AutoEncoder.code(): AutoEncoder,
-    TCAVExtractor.code(): TCAVExtractor,
-    ConceptX.code(): ConceptX,
-    Neuron.code(): Neuron,
-    ConceptXOri.code(): ConceptXOri,
-}
+EXTRACTORS = LazyRegistry(__name__, {
+    'ae': '.ae:AutoEncoder',
+    'tcav': '.tcav:TCAVExtractor',
+    'conceptx': '.conceptx:ConceptX',
+    'neuron': '.neuron:Neuron',
+    'conceptx_ori': '.conceptx_ori:ConceptXOri',
+})
+
+def __getattr__(name):
+    return EXTRACTORS.get_class(name)
 
 def extractor_factory(cfg, dataloader):
     extractor = EXTRACTORS[cfg['extractor']]
     if cfg['load_extractor']:
         return extractor
-    return extractor(cfg, dataloader).to(cfg['device'])
\ No newline at end of file
+    return extractor(cfg, dataloader).to(cfg['device'])
@@ -1,11 +1,12 @@
 from .base import BaseExtractor
+from .artifact import is_artifact, load_artifact, load_manifest
 from functools import partial
 from collections import OrderedDict
 
 import torch
+from instrument import instrument
 import torch.nn as nn
 import torch.nn.functional as F
-import json
 import pprint
 from logger import logger
 import os
@@ -80,24 +81,27 @@ class AutoEncoder(nn.Module, BaseExtractor):
 
     def save(self, ckpt_name=None):
         if ckpt_name is None:
-            torch.save(self.state_dict(), os.path.join(self.cfg['save_dir'], "model.pt"))
-            with open(os.path.join(self.cfg['save_dir'], "cfg.json"), "w") as f:
-                json.dump(self.cfg, f)
-        else:
-            torch.save(self.state_dict(), os.path.join(self.cfg['save_dir'], ckpt_name + ".pt"))
-            with open(os.path.join(self.cfg['save_dir'], ckpt_name+".json"), "w") as f:
-                json.dump(self.cfg, f)
+            ckpt_name = "model"
+        self.save_artifact(ckpt_name, self.state_dict())
     
     @classmethod
     def load_from_file(cls, dataloader, path=None, cfg=None):
         """
         Loads the saved autoencoder from file.
+        Artifacts are memory-mapped onto cfg['device'], legacy '.pt' checkpoints are still supported.
         """
         if cfg == None:
-            cfg = json.load(open(path + ".json", "r"))
+            cfg = load_manifest(path)['cfg']
         if path == None:
             path = cfg['load_path']
         pprint.pprint(cfg)
+        if is_artifact(path):
+            # the loaded tensors replace the parameters, so there is no point in initializing them
+            with torch.device('meta'):
+                self = cls(cfg=cfg, dataloader=dataloader)
+            state_dict, _ = load_artifact(path, cfg['device'])
+            self.load_state_dict(state_dict, assign=True)
+            return self
         self = cls(cfg=cfg, dataloader=dataloader)
         state_dict = torch.load(path + ".pt")
         new_state_dict = OrderedDict()
@@ -107,6 +111,24 @@ class AutoEncoder(nn.Module, BaseExtractor):
         self.load_state_dict(new_state_dict)
         return self
 
+    @instrument.timed('extractor/train_step')
+    def train_step(self, activations, optimizer):
+        """
+        One optimization step on a minibatch of activations.
+        """
+        activations = activations.to(self.cfg["device"])
+        acti_reconstruct, mid_acts = self.forward(activations)
+        l2_loss =  (acti_reconstruct.float() - activations.float()).pow(2).sum(-1).mean()
+        l1_loss = self.cfg['l1_coeff'] * (mid_acts.float().abs().sum(-1).mean())
+        loss = l2_loss + l1_loss
+        loss.backward()
+        instrument.count('backward_passes')
+        if self.cfg['remove_parallel']:
+            self.remove_parallel_component_of_grads()
+        optimizer.step()
+        optimizer.zero_grad()
+        return {"AE_loss": loss.item(), "l2_loss": l2_loss.item(), "l1_loss": l1_loss.item()}
+
     def extract_concepts(self, model):
         """
         Returns:
@@ -126,17 +148,7 @@ class AutoEncoder(nn.Module, BaseExtractor):
                 if self.dataloader.empty_flag == 1:
                     logger.info('All training data in dataloader has been passed through.')
                     break
-                activations = activations.to(self.cfg["device"])
-                acti_reconstruct, mid_acts = self.forward(activations)
-                l2_loss =  (acti_reconstruct.float() - activations.float()).pow(2).sum(-1).mean()
-                l1_loss = self.cfg['l1_coeff'] * (mid_acts.float().abs().sum(-1).mean())
-                loss = l2_loss + l1_loss
-                loss.backward()
-                if self.cfg['remove_parallel']:
-                    self.remove_parallel_component_of_grads()
-                optimizer.step()
-                optimizer.zero_grad()
-                loss_dict = {"AE_loss": loss.item(), "l2_loss": l2_loss.item(), "l1_loss": l1_loss.item()}
+                loss_dict = self.train_step(activations, optimizer)
                 
                 if (iter + 1) % self.cfg['val_freq'] == 0:
                     time_end=time.time()
@@ -158,13 +170,17 @@ class AutoEncoder(nn.Module, BaseExtractor):
                     if self.cfg['reinit'] == 1:
                         to_be_reset = (freqs<10**(-5.5))
                         self.re_init(self, to_be_reset)
-                del loss, acti_reconstruct, mid_acts, l2_loss, l1_loss
             self.save(ckpt_name="Iteration" + str(iter) + "_Epoch" + str(epoch+1))
+        self.wait_for_saves()
         self.concepts = self.W_dec.clone().detach()
     
     def get_concepts(self):
         self.concepts = self.W_dec.clone().detach()
         return self.concepts
+
+    @torch.no_grad()
+    def get_dictionary_activations(self, tokens, model):
+        return self.activation_func(tokens, model)
     
     @staticmethod
     def replacement_hook(mlp_post, hook, encoder):
@@ -220,6 +236,7 @@ class AutoEncoder(nn.Module, BaseExtractor):
             l0_norm = sum(l0_norms) / len(l0_norms)
             return l0_norm
         
+    @instrument.timed('extractor/activation_func')
     @torch.no_grad()
     def activation_func(self, tokens, model, concept=None, concept_idx=None):
         _, cache = model.run_with_cache(tokens, stop_at_layer=self.cfg["layer"]+1, names_filter=self.cfg["act_name"])
@@ -233,6 +250,8 @@ class AutoEncoder(nn.Module, BaseExtractor):
         else: 
             hidden_states = hidden_states.reshape(-1, self.cfg['d_model'])
             
+        # the encoder runs in the dtype it was cast to by the evaluation precision
+        hidden_states = hidden_states.to(self.W_enc.dtype)
         if concept_idx == None:
             results = self.forward(hidden_states)[1]
         else:
@@ -0,0 +1,117 @@
+import os
+import json
+import queue
+import threading
+import torch
+from safetensors.torch import save_file, load_file
+from logger import logger
+
+ARTIFACT_FORMAT = 'extractor-artifact'
+ARTIFACT_VERSION = 1
+
+
+def is_artifact(path):
+    return os.path.exists(path + '.safetensors')
+
+
+def load_manifest(path):
+    """
+    Reads `<path>.json`. Legacy checkpoints stored the bare cfg there, it is wrapped into a manifest.
+    """
+    with open(path + '.json', 'r') as f:
+        manifest = json.load(f)
+    if manifest.get('format') != ARTIFACT_FORMAT:
+        manifest = {'cfg': manifest}
+    return manifest
+
+
+def save_artifact(path, tensors, manifest):
+    """
+    Saves an extractor as `<path>.safetensors` (the tensors) and `<path>.json` (the manifest).
+    Both files are written to a temporary name first, so a reader never sees a partial artifact.
+    """
+    tensors = {k: v.detach().cpu().contiguous() for k, v in tensors.items()}
+    manifest = dict(
+        manifest,
+        format=ARTIFACT_FORMAT,
+        version=ARTIFACT_VERSION,
+        tensors={k: {'shape': list(v.shape), 'dtype': str(v.dtype)} for k, v in tensors.items()},
+    )
+    save_file(tensors, path + '.safetensors.tmp')
+    with open(path + '.json.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(path + '.safetensors.tmp', path + '.safetensors')
+    os.replace(path + '.json.tmp', path + '.json')
+
+
+def load_artifact(path, device='cpu'):
+    """
+    Memory-maps `<path>.safetensors` and materializes the tensors directly on `device`.
+    """
+    tensors = load_file(path + '.safetensors', device=str(device))
+    return tensors, load_manifest(path)
+
+
+class AsyncArtifactWriter:
+    """
+    Writes artifacts on a background thread. The tensors are copied to (pinned) host memory when they
+    are submitted, so the caller can keep updating them while the disk write runs. At most `max_pending`
+    artifacts wait to be written; `submit` blocks beyond that, so checkpoints submitted faster than the
+    disk writes them do not pile up in memory.
+    """
+    def __init__(self, max_pending=2):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = None
+        self.error = None
+
+    @staticmethod
+    def snapshot(tensors):
+        """
+        Host copies of `tensors`, and the CUDA event after which the asynchronous copies are complete (or None).
+        """
+        snapshot = dict()
+        event = None
+        for k, v in tensors.items():
+            v = v.detach()
+            if v.is_cuda:
+                snapshot[k] = torch.empty(v.shape, dtype=v.dtype, pin_memory=True)
+                snapshot[k].copy_(v, non_blocking=True)
+                event = torch.cuda.Event()
+            else:
+                snapshot[k] = v.clone()
+        if event is not None:
+            event.record()
+        return snapshot, event
+
+    def submit(self, path, tensors, manifest):
+        snapshot, event = self.snapshot(tensors)
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        self.queue.put((path, snapshot, event, manifest))
+
+    def _run(self):
+        while True:
+            path, tensors, event, manifest = self.queue.get()
+            try:
+                if event is not None:
+                    event.synchronize()
+                save_artifact(path, tensors, manifest)
+            except Exception as e:
+                logger.exception('Failed to save {}'.format(path))
+                if self.error is None:
+                    self.error = e
+            finally:
+                self.queue.task_done()
+
+    def wait(self):
+        """
+        Blocks until every submitted artifact is on disk, and raises the first error of a failed write.
+        """
+        self.queue.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+writer = AsyncArtifactWriter()
@@ -1,4 +1,7 @@
 from abc import *
+import os
+import torch
+from .artifact import save_artifact, writer
 
 class BaseExtractor(metaclass=ABCMeta):
     def __init__(self):
@@ -8,19 +11,54 @@ class BaseExtractor(metaclass=ABCMeta):
     @abstractmethod
     def code(cls):
         pass
-    
+
     @abstractclassmethod
     def activation_func(self, **kwargs):
         pass
-    
+
     def load_from_file(*args,**kwargs):
         pass
-    
+
     @abstractclassmethod
     def extract_concepts(self):
         pass
-    
+
     @abstractclassmethod
     def get_concepts(self):
         pass
 
+    @torch.no_grad()
+    def get_dictionary_activations(self, tokens, model):
+        """
+        The activations of every concept at every position, n_tokens * n_concepts.
+        By default the hidden states are projected onto all concepts, as `activation_func` does for one.
+        """
+        _, cache = model.run_with_cache(tokens, stop_at_layer=self.cfg["layer"]+1, names_filter=self.cfg["act_name"])
+        hidden_states = cache[self.cfg["act_name"]].reshape(-1, self.cfg['act_size'])
+        concepts = self.get_concepts().to(hidden_states.device, hidden_states.dtype)
+        return hidden_states @ concepts.T / (concepts * concepts).sum(-1)
+
+    def save_artifact(self, name, tensors):
+        """
+        Saves `tensors` with a manifest of this extractor under save_dir, in the background if cfg['async_save'].
+        """
+        path = os.path.join(self.cfg['save_dir'], name)
+        manifest = {'extractor': self.code(), 'cfg': self.cfg}
+        if self.cfg['async_save']:
+            writer.submit(path, tensors, manifest)
+        else:
+            save_artifact(path, tensors, manifest)
+        return path
+
+    def wait_for_saves(self):
+        writer.wait()
+
+    def set_dtype(self, dtype):
+        """
+        Casts the parameters and concept tensors used by `activation_func` to `dtype`.
+        """
+        if isinstance(self, torch.nn.Module):
+            self.to(dtype)
+        for name, value in list(vars(self).items()):
+            if torch.is_tensor(value) and value.is_floating_point():
+                setattr(self, name, value.to(dtype))
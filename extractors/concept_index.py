@@ -0,0 +1,161 @@
+import torch
+import torch.nn.functional as F
+from logger import logger
+
+
+def kmeans(x, n_clusters, n_iter=20, spherical=False, batch_size=4096, seed=0):
+    """
+    Lloyd's k-means in torch. With spherical=True the centroids are kept on the unit sphere
+    and points are assigned by cosine similarity.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    n_clusters = min(n_clusters, x.shape[0])
+    centroids = x[torch.randperm(x.shape[0], generator=generator)[:n_clusters].to(x.device)].clone()
+    for _ in range(n_iter):
+        assign = assign_clusters(x, centroids, spherical, batch_size)
+        sums = torch.zeros_like(centroids).index_add_(0, assign, x)
+        counts = torch.bincount(assign, minlength=n_clusters).unsqueeze(1)
+        # empty clusters keep their previous centroid
+        centroids = torch.where(counts > 0, sums / counts.clamp(min=1), centroids)
+        if spherical:
+            centroids = F.normalize(centroids, dim=-1)
+    return centroids, assign_clusters(x, centroids, spherical, batch_size)
+
+
+def assign_clusters(x, centroids, spherical=False, batch_size=4096):
+    assign = []
+    for chunk in x.split(batch_size, dim=0):
+        if spherical:
+            assign.append((chunk @ centroids.T).argmax(-1))
+        else:
+            assign.append(torch.cdist(chunk, centroids).argmin(-1))
+    return torch.cat(assign, 0)
+
+
+class ConceptIndex:
+    """
+    A cosine-similarity index over the output of `get_concepts()`, for nearest-concept queries and
+    for finding near-duplicate concepts.
+
+    mode='exact' does batched brute-force top-k on the normalized vectors.
+    mode='ivfpq' is an approximate mode for very large dictionaries: concepts are clustered into
+    `n_lists` inverted lists, the residuals to the list centroids are product-quantized into
+    `n_subspaces` codes of `n_codes` entries, and a query only scores the `n_probe` closest lists.
+    """
+    def __init__(
+        self,
+        concepts,
+        mode='exact',
+        n_lists=None,
+        n_subspaces=8,
+        n_codes=256,
+        n_probe=8,
+        n_iter=20,
+        batch_size=4096,
+        seed=0,
+    ):
+        self.vectors = F.normalize(concepts.detach().float(), dim=-1)
+        self.mode = mode
+        self.batch_size = batch_size
+        self.n_probe = n_probe
+        if mode == 'ivfpq':
+            if n_lists is None:
+                n_lists = max(1, int(self.vectors.shape[0] ** 0.5))
+            self.train_ivfpq(n_lists, n_subspaces, n_codes, n_iter, seed)
+        elif mode != 'exact':
+            assert False, "Index mode not supported yet. please choose from: ['exact', 'ivfpq']."
+
+    def __len__(self):
+        return self.vectors.shape[0]
+
+    def train_ivfpq(self, n_lists, n_subspaces, n_codes, n_iter, seed):
+        d = self.vectors.shape[1]
+        assert d % n_subspaces == 0, "The concept dimension must be divisible by n_subspaces."
+        self.centroids, assign = kmeans(self.vectors, n_lists, n_iter, spherical=True, batch_size=self.batch_size, seed=seed)
+        self.lists = [torch.nonzero(assign == l).squeeze(1) for l in range(self.centroids.shape[0])]
+        residuals = (self.vectors - self.centroids[assign]).reshape(len(self), n_subspaces, d // n_subspaces)
+        codebooks = []
+        codes = []
+        for s in range(n_subspaces):
+            codebook, code = kmeans(residuals[:, s], n_codes, n_iter, batch_size=self.batch_size, seed=seed + s + 1)
+            codebooks.append(codebook)
+            codes.append(code)
+        self.codebooks = torch.stack(codebooks, 0) # n_subspaces, n_codes, d / n_subspaces
+        self.codes = torch.stack(codes, 1).to(torch.uint8 if self.codebooks.shape[1] <= 256 else torch.int32) # n_concepts, n_subspaces
+        logger.info('Built IVF-PQ concept index: {} lists, {} subspaces, {} codes'.format(
+            self.centroids.shape[0], n_subspaces, self.codebooks.shape[1]
+        ))
+
+    @torch.no_grad()
+    def search(self, queries, k=10):
+        """
+        Returns the cosine similarities and the indices of the k nearest concepts of every query direction.
+        """
+        queries = F.normalize(queries.detach().float().to(self.vectors.device).reshape(-1, self.vectors.shape[1]), dim=-1)
+        k = min(k, len(self))
+        if self.mode == 'ivfpq':
+            return self.search_ivfpq(queries, k)
+        sims, idxs = [], []
+        for chunk in queries.split(self.batch_size, dim=0):
+            top_sims, top_idxs = None, None
+            for start in range(0, len(self), self.batch_size):
+                block_sims = chunk @ self.vectors[start:start + self.batch_size].T
+                block_sims, block_idxs = torch.topk(block_sims, k=min(k, block_sims.shape[1]), dim=-1)
+                block_idxs = block_idxs + start
+                if top_sims is not None:
+                    block_sims = torch.cat([top_sims, block_sims], -1)
+                    block_idxs = torch.cat([top_idxs, block_idxs], -1)
+                top_sims, order = torch.topk(block_sims, k=min(k, block_sims.shape[1]), dim=-1)
+                top_idxs = block_idxs.gather(-1, order)
+            sims.append(top_sims)
+            idxs.append(top_idxs)
+        return torch.cat(sims, 0), torch.cat(idxs, 0)
+
+    def search_ivfpq(self, queries, k):
+        n_subspaces, _, d_sub = self.codebooks.shape
+        coarse = queries @ self.centroids.T
+        probes = torch.topk(coarse, k=min(self.n_probe, coarse.shape[1]), dim=-1).indices
+        # inner products between every query subvector and every code
+        luts = torch.einsum('qsd,scd->qsc', queries.reshape(-1, n_subspaces, d_sub), self.codebooks)
+        sims = torch.full((queries.shape[0], k), float('-inf'), device=queries.device)
+        idxs = torch.full((queries.shape[0], k), -1, dtype=torch.long, device=queries.device)
+        subspace_idxs = torch.arange(n_subspaces, device=queries.device)
+        for q in range(queries.shape[0]):
+            candidates = torch.cat([self.lists[l] for l in probes[q].tolist()])
+            if candidates.shape[0] == 0:
+                continue
+            list_ids = torch.cat([torch.full_like(self.lists[l], l) for l in probes[q].tolist()])
+            codes = self.codes[candidates].long()
+            scores = coarse[q, list_ids] + luts[q][subspace_idxs, codes].sum(-1)
+            top_scores, order = torch.topk(scores, k=min(k, scores.shape[0]))
+            sims[q, :order.shape[0]] = top_scores
+            idxs[q, :order.shape[0]] = candidates[order]
+        return sims, idxs
+
+    def near_duplicates(self, threshold=0.95, k=10):
+        """
+        Pairs (i, j, similarity) with i < j of concepts whose cosine similarity is at least `threshold`.
+        Only the k nearest neighbours of every concept are considered.
+        """
+        sims, idxs = self.search(self.vectors, k=k + 1)
+        rows = torch.arange(len(self), device=idxs.device).unsqueeze(1).expand_as(idxs)
+        mask = (sims >= threshold) & (idxs > rows)
+        return [
+            (i, j, s) for i, j, s in zip(rows[mask].tolist(), idxs[mask].tolist(), sims[mask].tolist())
+        ]
+
+    def dedupe(self, threshold=0.95, k=10):
+        """
+        Indices of the concepts to keep: every concept that is a near-duplicate of an earlier kept concept is dropped.
+        """
+        duplicates = dict()
+        for i, j, _ in self.near_duplicates(threshold, k):
+            duplicates.setdefault(i, []).append(j)
+        removed = set()
+        keep = []
+        for i in range(len(self)):
+            if i in removed:
+                continue
+            keep.append(i)
+            removed.update(duplicates.get(i, []))
+        return keep
@@ -1,9 +1,10 @@
 from .base import BaseExtractor
+from .artifact import is_artifact, load_artifact, load_manifest
 import torch
+from instrument import instrument
 import torch.nn as nn
 from sklearn.cluster import AgglomerativeClustering
 import numpy as np
-import json
 import pprint
 
 class ConceptX(nn.Module, BaseExtractor):
@@ -25,14 +26,19 @@ class ConceptX(nn.Module, BaseExtractor):
         """
         """
         if cfg == None:
-            cfg = json.load(open(path + ".json", "r"))
+            cfg = load_manifest(path)['cfg']
         if path == None:
             path = cfg['load_path']
         pprint.pprint(cfg)
         self = cls(cfg=cfg, dataloader=dataloader)
-        self.concepts = torch.tensor(torch.load("./data/conceptx_concepts.pt")).to(cfg['device'])
+        if is_artifact(path):
+            tensors, _ = load_artifact(path, cfg['device'])
+            self.concepts = tensors['concepts']
+        else:
+            self.concepts = torch.tensor(torch.load("./data/conceptx_concepts.pt")).to(cfg['device'])
         return self
 
+    @instrument.timed('extractor/activation_func')
     @torch.no_grad()
     def activation_func(self, tokens, model, concept=None, concept_idx=None):    
         _, cache = model.run_with_cache(tokens, stop_at_layer=self.cfg["layer"]+1, names_filter=self.cfg["act_name"])
@@ -88,7 +94,8 @@ class ConceptX(nn.Module, BaseExtractor):
             concepts.append(np.mean(hidden_states[indices], axis=0))
         concepts = np.array(concepts)   
         self.concepts = torch.tensor(concepts, device=self.cfg["device"])
-        torch.save(concepts, "./data/conceptx_concepts.pt")
+        self.save_artifact(self.code() + "_concepts", {'concepts': self.concepts})
+        self.wait_for_saves()
 
     def get_concepts(self):
         return self.concepts
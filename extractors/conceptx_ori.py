@@ -1,10 +1,11 @@
 from .base import BaseExtractor
+from .artifact import is_artifact, load_artifact, load_manifest
 from sklearn.cluster import AgglomerativeClustering
 import numpy as np
 import torch.nn as nn
 import torch
+from instrument import instrument
 import pprint
-import json
 
 class ConceptXOri(nn.Module, BaseExtractor):
     def __init__(self, cfg, dataloader):
@@ -20,6 +21,7 @@ class ConceptXOri(nn.Module, BaseExtractor):
     def code(cls):
         return "conceptx_ori"
 
+    @instrument.timed('extractor/activation_func')
     @torch.no_grad()
     def activation_func(self, tokens, model, concept=None, concept_idx=None):    
         _, cache = model.run_with_cache(tokens, stop_at_layer=self.cfg["layer"]+1, names_filter=self.cfg["act_name"])
@@ -44,19 +46,24 @@ class ConceptXOri(nn.Module, BaseExtractor):
         clustering = AgglomerativeClustering(n_clusters=self.k,compute_distances=True).fit(points)
         centroids = np.array([points[clustering.labels_ == j].mean(axis=0) for j in range(self.k)])
         self.concepts = torch.tensor(centroids, device=self.cfg["device"])
-        torch.save(centroids, "./data/conceptx_concepts.pt")
+        self.save_artifact(self.code() + "_concepts", {'concepts': self.concepts})
+        self.wait_for_saves()
         
     @classmethod
     def load_from_file(cls, dataloader, path=None, cfg=None):
         """
         """
         if cfg == None:
-            cfg = json.load(open(path + ".json", "r"))
+            cfg = load_manifest(path)['cfg']
         if path == None:
             path = cfg['load_path']
         pprint.pprint(cfg)
         self = cls(cfg=cfg, dataloader=dataloader)
-        self.concepts = torch.tensor(torch.load("./data/conceptx_concepts.pt")).to(cfg['device'])
+        if is_artifact(path):
+            tensors, _ = load_artifact(path, cfg['device'])
+            self.concepts = tensors['concepts']
+        else:
+            self.concepts = torch.tensor(torch.load("./data/conceptx_concepts.pt")).to(cfg['device'])
         return self
 
     def get_concepts(self):
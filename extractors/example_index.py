@@ -0,0 +1,220 @@
+"""
+An index of the corpus positions that activate every concept most, built in one streaming pass, e.g.
+
+    python -m extractors.example_index --load_extractor --extractor ae --load_path ./best_reconstruct --index_path ./output/example_index
+"""
+import math
+import argparse
+
+import torch
+import logging
+from logger import logger
+from instrument import instrument
+from dataloaders.batching import tokenize_bucketed, get_max_batch_tokens
+from .artifact import save_artifact, load_artifact
+
+
+def iter_corpus(dataloader, cfg, max_docs=0):
+    """
+    Yields (doc_idxs, tokens, attention_mask) over the documents of the dataloader in corpus order.
+    The first position of every row is BOS, as in the evaluation batches.
+    """
+    data = dataloader.data
+    n_docs = len(data) if max_docs <= 0 else min(max_docs, len(data))
+    bos_id = dataloader.model.tokenizer.bos_token_id
+    if cfg['tokenized']:
+        for start in range(0, n_docs, cfg['model_batch_size']):
+            end = min(start + cfg['model_batch_size'], n_docs)
+            tokens = torch.tensor(data[start:end]['tokens'])[:, :cfg['seq_len']]
+            tokens[:, 0] = bos_id
+            yield torch.arange(start, end), tokens, None
+    else:
+        pool_size = cfg['model_batch_size'] * 8
+        for start in range(0, n_docs, pool_size):
+            sentences = data[start:min(start + pool_size, n_docs)]
+            for idxs, tokens, attention_mask in tokenize_bucketed(dataloader.tokenizer, sentences, cfg['seq_len'], get_max_batch_tokens(cfg)):
+                tokens[:, 0] = bos_id
+                yield torch.tensor(idxs) + start, tokens, attention_mask
+
+
+class ExampleIndex:
+    """
+    The top-k (activation, doc, position) of every concept over a corpus, with the `window` tokens that
+    end at each position, plus a histogram of the positive activations on log-spaced bins and the firing
+    frequency of every concept. All statistics are updated batch by batch, so the memory is bounded by
+    the size of the dictionary and not by the size of the corpus.
+    """
+    def __init__(self, n_concepts, k=20, window=16, n_bins=40, hist_min=1e-3, hist_max=1e3, pad_id=0, device='cpu'):
+        self.n_concepts = n_concepts
+        self.k = k
+        self.window = window
+        self.pad_id = pad_id
+        self.device = device
+        self.top_values = torch.full((n_concepts, k), -math.inf, device=device)
+        self.top_docs = torch.full((n_concepts, k), -1, dtype=torch.long, device=device)
+        self.top_positions = torch.full((n_concepts, k), -1, dtype=torch.long, device=device)
+        self.top_contexts = torch.full((n_concepts, k, window), pad_id, dtype=torch.long, device=device)
+        # bin 0 and the last bin collect the activations below hist_min and above hist_max
+        self.bin_edges = torch.logspace(math.log10(hist_min), math.log10(hist_max), n_bins + 1, device=device)
+        self.histograms = torch.zeros((n_concepts, n_bins + 2), dtype=torch.long, device=device)
+        self.fire_counts = torch.zeros(n_concepts, dtype=torch.long, device=device)
+        self.act_sums = torch.zeros(n_concepts, dtype=torch.float64, device=device)
+        self.n_tokens = 0
+        self.n_docs = 0
+
+    @torch.no_grad()
+    def update(self, acts, doc_idxs, tokens, attention_mask=None):
+        """
+        Merges the n_tokens * n_concepts activations of a batch of rows of `tokens` into the index.
+        BOS and padding positions are ignored.
+        """
+        acts = acts.to(self.device).float().reshape(tokens.shape[0], tokens.shape[1], -1)
+        tokens = tokens.to(self.device)
+        keep = torch.ones(tokens.shape, dtype=torch.bool, device=self.device)
+        keep[:, 0] = False
+        if attention_mask is not None:
+            keep &= attention_mask.to(self.device).bool()
+        acts = (acts * keep.unsqueeze(-1)).reshape(-1, self.n_concepts)
+        self.n_tokens += int(keep.sum())
+        self.n_docs += tokens.shape[0]
+
+        positive = acts > 0
+        self.fire_counts += positive.sum(0)
+        self.act_sums += acts.sum(0, dtype=torch.float64)
+        bins = torch.bucketize(acts[positive], self.bin_edges)
+        concept_ids = positive.nonzero()[:, 1]
+        self.histograms.view(-1).scatter_add_(
+            0,
+            concept_ids * self.histograms.shape[1] + bins,
+            torch.ones_like(bins),
+        )
+
+        # the batch candidates of every concept, then a merge with the running top-k
+        k = min(self.k, acts.shape[0])
+        values, flat_idxs = acts.topk(k, dim=0) # k, n_concepts
+        values, flat_idxs = values.T, flat_idxs.T # n_concepts, k
+        rows = flat_idxs // tokens.shape[1]
+        positions = flat_idxs % tokens.shape[1]
+        offsets = torch.arange(-self.window + 1, 1, device=self.device)
+        context_positions = positions.unsqueeze(-1) + offsets
+        contexts = tokens[rows.unsqueeze(-1), context_positions.clamp(min=0)]
+        contexts = contexts.masked_fill(context_positions < 0, self.pad_id)
+        values = values.masked_fill(values <= 0, -math.inf)
+
+        all_values = torch.cat([self.top_values, values], 1)
+        all_docs = torch.cat([self.top_docs, doc_idxs.to(self.device)[rows]], 1)
+        all_positions = torch.cat([self.top_positions, positions], 1)
+        all_contexts = torch.cat([self.top_contexts, contexts], 1)
+        self.top_values, order = all_values.topk(self.k, dim=1)
+        self.top_docs = all_docs.gather(1, order)
+        self.top_positions = all_positions.gather(1, order)
+        self.top_contexts = all_contexts.gather(1, order.unsqueeze(-1).expand(-1, -1, self.window))
+
+    def get_examples(self, concept_idx, n=None):
+        """
+        The (activation, doc, position, context) of the top `n` examples of a concept, strongest first.
+        """
+        n = self.k if n is None else n
+        found = int(torch.isfinite(self.top_values[concept_idx]).sum())
+        n = min(n, found)
+        return (
+            self.top_values[concept_idx, :n],
+            self.top_docs[concept_idx, :n],
+            self.top_positions[concept_idx, :n],
+            self.top_contexts[concept_idx, :n],
+        )
+
+    def get_example_tokens(self, concept_idx, n=None, bos_id=None):
+        """
+        The contexts of the top examples as a batch of model inputs, with BOS prepended if `bos_id` is given.
+        The activating token is the last position of every row.
+        """
+        contexts = self.get_examples(concept_idx, n)[3]
+        if bos_id is not None:
+            contexts = torch.cat([torch.full((contexts.shape[0], 1), bos_id, dtype=contexts.dtype, device=contexts.device), contexts], 1)
+        return contexts
+
+    def get_frequencies(self):
+        return self.fire_counts.double() / max(self.n_tokens, 1)
+
+    def get_mean_activations(self):
+        return self.act_sums / max(self.n_tokens, 1)
+
+    def save(self, path, manifest=dict()):
+        save_artifact(path, {
+            'top_values': self.top_values,
+            'top_docs': self.top_docs,
+            'top_positions': self.top_positions,
+            'top_contexts': self.top_contexts,
+            'bin_edges': self.bin_edges,
+            'histograms': self.histograms,
+            'fire_counts': self.fire_counts,
+            'act_sums': self.act_sums,
+        }, dict(manifest, n_tokens=self.n_tokens, n_docs=self.n_docs, pad_id=self.pad_id))
+
+    @classmethod
+    def load(cls, path, device='cpu'):
+        tensors, manifest = load_artifact(path, device)
+        n_concepts, k, window = tensors['top_contexts'].shape
+        index = cls(n_concepts, k=k, window=window, pad_id=manifest['pad_id'], device=device)
+        for name, tensor in tensors.items():
+            setattr(index, name, tensor)
+        index.n_tokens = manifest['n_tokens']
+        index.n_docs = manifest['n_docs']
+        return index
+
+
+@instrument.timed('extractor/build_example_index')
+def build_example_index(cfg, extractor, model, dataloader):
+    """
+    Streams the corpus once through the extractor and indexes the activations of the whole dictionary.
+    """
+    tokenizer = model.tokenizer
+    pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    index = ExampleIndex(
+        extractor.get_concepts().shape[0],
+        k=cfg['index_top_k'],
+        window=cfg['index_window'],
+        n_bins=cfg['index_n_bins'],
+        hist_min=cfg['index_hist_min'],
+        hist_max=cfg['index_hist_max'],
+        pad_id=pad_id,
+        device=cfg['device'],
+    )
+    for i, (doc_idxs, tokens, attention_mask) in enumerate(iter_corpus(dataloader, cfg, cfg['index_max_docs'])):
+        acts = extractor.get_dictionary_activations(tokens.to(cfg['device']), model)
+        index.update(acts, doc_idxs, tokens, attention_mask)
+        if (i + 1) % 100 == 0:
+            logger.info('indexed {} documents, {} tokens'.format(index.n_docs, index.n_tokens))
+    return index
+
+
+def main():
+    from utils import set_seed, arg_parse_update_cfg, process_cfg
+    from config import cfg as default_cfg
+    from models import model_factory
+    from datasets_ import dataset_factory
+    from dataloaders import dataloader_factory
+    from extractors import extractor_factory
+
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO, force=True)
+    torch.set_default_dtype(torch.float32)
+    parser = argparse.ArgumentParser()
+    cfg, args = arg_parse_update_cfg(default_cfg, parser)
+    assert cfg['load_extractor'], "The index is built for a saved extractor, please pass --load_extractor and --load_path."
+    set_seed(cfg['seed'])
+    instrument.configure(cfg)
+
+    model = model_factory(cfg)
+    cfg = process_cfg(cfg, model)
+    dataloader = dataloader_factory(cfg, dataset_factory(cfg), model)
+    extractor = extractor_factory(cfg, dataloader).load_from_file(dataloader, cfg['load_path'], cfg).to(cfg['device'])
+    index = build_example_index(cfg, extractor, model, dataloader)
+    index.save(cfg['index_path'], {'extractor': cfg['extractor'], 'load_path': cfg['load_path'], 'layer': cfg['layer'], 'site': cfg['site']})
+    logger.info('Saved the example index of {} concepts over {} tokens to {}'.format(index.n_concepts, index.n_tokens, cfg['index_path']))
+    if instrument.enabled:
+        logger.info('Instrumentation summary:\n{}'.format(instrument.summary()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+"""
+Trains a sweep of autoencoders at once on one activation stream, e.g.
+
+    python -m extractors.multi_ae --sweep "l1_coeff=0.1,0.5,1.;dict_mult=4,8"
+
+Every member is saved as a regular 'ae' artifact under its own directory, which
+`--load_extractor --extractor ae --load_path <member dir>/best_reconstruct` evaluates.
+"""
+import os
+import json
+import time
+import itertools
+import argparse
+
+import torch
+import torch.nn.functional as F
+import logging
+from logger import logger
+from instrument import instrument
+from .ae import AutoEncoder
+
+SWEEP_KEYS = ['l1_coeff', 'dict_mult', 'init_type', 'lr', 'beta1', 'beta2', 'tied_enc_dec', 'use_bias_d', 'remove_parallel']
+
+
+def parse_sweep(sweep, cfg):
+    """
+    'l1_coeff=0.1,0.5;dict_mult=4,8' -> the list of overrides of every member, the cartesian product of the values.
+    """
+    names, values = [], []
+    for item in [item for item in sweep.split(';') if item.strip() != '']:
+        name, options = item.split('=')
+        name = name.strip()
+        assert name in SWEEP_KEYS, 'Cannot sweep {}, please choose from: {}.'.format(name, SWEEP_KEYS)
+        names.append(name)
+        values.append([type(cfg[name])(option.strip()) for option in options.split(',')])
+    return [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+
+def get_member_cfg(cfg, overrides, i):
+    member_cfg = dict(cfg, **overrides)
+    member_cfg['dict_size'] = member_cfg['act_size'] * member_cfg['dict_mult']
+    name = 'member{}'.format(i) + ''.join('_{}_{}'.format(k, v) for k, v in overrides.items())
+    member_cfg['save_dir'] = os.path.join(cfg['save_dir'], 'sweep', name)
+    os.makedirs(member_cfg['save_dir'], exist_ok=True)
+    return member_cfg
+
+
+class MultiAutoEncoder:
+    """
+    N autoencoders with stacked weights, W_enc n_members * d_out * d_hidden and so on, trained together on
+    the same minibatches with batched matrix products. Members with a smaller dictionary are padded to the
+    largest one and their padded latents are masked to 0, so they get neither activations nor gradients.
+    The Adam state is elementwise and the learning rate, betas, l1 coefficient and the other swept options
+    are per-member tensors, so every member is trained exactly as an AutoEncoder with its own cfg would be.
+    """
+    def __init__(self, cfg, dataloader, member_cfgs):
+        self.cfg = cfg
+        self.dataloader = dataloader
+        self.member_cfgs = member_cfgs
+        self.n_members = len(member_cfgs)
+        self.d_out = cfg['act_size']
+        self.d_hidden = max(member_cfg['dict_size'] for member_cfg in member_cfgs)
+        device = cfg['device']
+
+        W_enc = torch.zeros(self.n_members, self.d_out, self.d_hidden)
+        W_dec = torch.zeros(self.n_members, self.d_hidden, self.d_out)
+        self.latent_mask = torch.zeros(self.n_members, self.d_hidden)
+        for i, member_cfg in enumerate(member_cfgs):
+            # the same initialization as AutoEncoder, on the member's own shapes
+            init = getattr(torch.nn.init, member_cfg['init_type'] + '_')
+            h = member_cfg['dict_size']
+            W_enc[i, :, :h] = init(torch.empty(self.d_out, h))
+            W_dec[i, :h] = init(torch.empty(h, self.d_out))
+            self.latent_mask[i, :h] = 1.
+        W_dec = W_dec / W_dec.norm(dim=-1, keepdim=True).clamp(min=1e-12)
+        self.params = {
+            'W_enc': W_enc.to(device),
+            'W_dec': W_dec.to(device),
+            'b_enc': torch.zeros(self.n_members, self.d_hidden, device=device),
+            'b_dec': torch.zeros(self.n_members, self.d_out, device=device),
+        }
+        for param in self.params.values():
+            param.requires_grad_(True)
+        self.latent_mask = self.latent_mask.to(device)
+
+        def member_values(name, dtype=torch.float32):
+            return torch.tensor([float(member_cfg[name]) for member_cfg in member_cfgs], dtype=dtype, device=device)
+        self.l1_coeff = member_values('l1_coeff')
+        self.lr = member_values('lr')
+        self.beta1 = member_values('beta1')
+        self.beta2 = member_values('beta2')
+        self.tied = member_values('tied_enc_dec', torch.bool)
+        self.train_b_dec = member_values('use_bias_d')
+        self.remove_parallel = member_values('remove_parallel', torch.bool)
+        self.adam_step = 0
+        self.adam_state = {name: (torch.zeros_like(p), torch.zeros_like(p)) for name, p in self.params.items()}
+
+    def forward(self, x):
+        """
+        x: batch * d_out, shared by all members. Returns the n_members * batch * d_out reconstructions
+        and the n_members * batch * d_hidden latent activations.
+        """
+        W_enc = torch.where(self.tied[:, None, None], self.params['W_dec'].transpose(1, 2), self.params['W_enc'])
+        x_cent = x.unsqueeze(0) - self.params['b_dec'].unsqueeze(1)
+        acts = F.relu(torch.bmm(x_cent, W_enc) + self.params['b_enc'].unsqueeze(1)) * self.latent_mask.unsqueeze(1)
+        x_reconstruct = torch.bmm(acts, self.params['W_dec']) + self.params['b_dec'].unsqueeze(1)
+        return x_reconstruct, acts
+
+    def expand(self, values, param):
+        return values.reshape(-1, *([1] * (param.dim() - 1)))
+
+    @torch.no_grad()
+    def remove_parallel_component_of_grads(self):
+        W_dec = self.params['W_dec']
+        W_dec_normed = W_dec / W_dec.norm(dim=-1, keepdim=True).clamp(min=1e-12)
+        W_dec_grad_proj = (W_dec.grad * W_dec_normed).sum(-1, keepdim=True) * W_dec_normed
+        mask = self.expand(self.remove_parallel, W_dec)
+        W_dec.grad -= W_dec_grad_proj * mask
+        W_dec.data = torch.where(mask, W_dec_normed, W_dec)
+
+    @torch.no_grad()
+    def adam_step_(self, eps=1e-8):
+        """
+        torch.optim.Adam with per-member learning rates and betas.
+        """
+        self.adam_step += 1
+        for name, param in self.params.items():
+            m, v = self.adam_state[name]
+            beta1, beta2, lr = [self.expand(values, param) for values in (self.beta1, self.beta2, self.lr)]
+            m.mul_(beta1).add_((1 - beta1) * param.grad)
+            v.mul_(beta2).add_((1 - beta2) * param.grad * param.grad)
+            m_hat = m / (1 - beta1 ** self.adam_step)
+            v_hat = v / (1 - beta2 ** self.adam_step)
+            param -= lr * m_hat / (v_hat.sqrt() + eps)
+            param.grad = None
+
+    @instrument.timed('extractor/multi_train_step')
+    def train_step(self, activations):
+        """
+        One optimization step of every member on the same minibatch. Returns per-member losses and l0 norms.
+        """
+        activations = activations.to(self.cfg['device']).float()
+        acti_reconstruct, mid_acts = self.forward(activations)
+        l2_loss = (acti_reconstruct - activations.unsqueeze(0)).pow(2).sum(-1).mean(-1) # n_members
+        l1_loss = self.l1_coeff * mid_acts.abs().sum(-1).mean(-1) # n_members
+        loss = l2_loss + l1_loss
+        # the members share no parameters, so the gradient of the sum is the gradient of every member's loss
+        loss.sum().backward()
+        instrument.count('backward_passes')
+        self.params['b_dec'].grad *= self.train_b_dec.unsqueeze(1)
+        self.remove_parallel_component_of_grads()
+        self.adam_step_()
+        l0 = (mid_acts > 0).float().sum(-1).mean(-1)
+        return {
+            'AE_loss': loss.tolist(),
+            'l2_loss': l2_loss.tolist(),
+            'l1_loss': l1_loss.tolist(),
+            'l0': l0.tolist(),
+        }
+
+    @torch.no_grad()
+    def get_freqs(self, num_batches=25):
+        """
+        The firing frequency of the latents of every member, n_members * d_hidden, as AutoEncoder.get_freqs.
+        """
+        act_freq_scores = torch.zeros(self.n_members, self.d_hidden, dtype=torch.float32, device=self.cfg['device'])
+        total = 0
+        for _ in range(num_batches):
+            hidden_states = self.dataloader.buffer[torch.randperm(self.dataloader.buffer.shape[0])[:self.cfg['batch_size']]]
+            _, acts = self.forward(hidden_states.to(self.cfg['device']).float())
+            act_freq_scores += (acts > 0).sum(1)
+            total += acts.shape[1]
+        return act_freq_scores / total
+
+    @torch.no_grad()
+    def re_init(self, i, indices):
+        """
+        AutoEncoder.re_init of member i: new encoder and decoder weights and a zero bias for the latents `indices`.
+        """
+        member_cfg = self.member_cfgs[i]
+        h = member_cfg['dict_size']
+        indices = indices[:h]
+        init = getattr(torch.nn.init, member_cfg['init_type'] + '_')
+        new_W_enc = init(torch.zeros(self.d_out, h, device=self.cfg['device']))
+        new_W_dec = init(torch.zeros(h, self.d_out, device=self.cfg['device']))
+        self.params['W_enc'].data[i, :, :h][:, indices] = new_W_enc[:, indices]
+        self.params['W_dec'].data[i, :h][indices] = new_W_dec[indices]
+        self.params['b_enc'].data[i, :h][indices] = 0.
+
+    @torch.no_grad()
+    def get_member(self, i):
+        """
+        Member i as a regular AutoEncoder, cut from the stacked weights.
+        """
+        member_cfg = self.member_cfgs[i]
+        h = member_cfg['dict_size']
+        with torch.device('meta'):
+            member = AutoEncoder(cfg=member_cfg, dataloader=self.dataloader)
+        member.load_state_dict({
+            'W_enc': self.params['W_enc'][i, :, :h].clone(),
+            'W_dec': self.params['W_dec'][i, :h].clone(),
+            'b_enc': self.params['b_enc'][i, :h].clone(),
+            'b_dec': self.params['b_dec'][i].clone(),
+        }, assign=True)
+        return member
+
+    def extract_concepts(self, model):
+        """
+        The training loop of AutoEncoder.extract_concepts for every member: validation and best_reconstruct
+        checkpoints every val_freq iterations, periodic checkpoints and dead-latent re-initialization every
+        10000 iterations, and a checkpoint at the end of every epoch.
+        """
+        best_reconstruct = [0.] * self.n_members
+        history = [[] for _ in range(self.n_members)]
+        time_start = time.time()
+        for epoch in range(self.cfg['epoch']):
+            logger.info('epoch:{}'.format(epoch + 1))
+            if epoch > 0:
+                self.dataloader.reinit()
+            for iter in range(self.dataloader.__len__()):
+                activations = self.dataloader.next()
+                if self.dataloader.empty_flag == 1:
+                    logger.info('All training data in dataloader has been passed through.')
+                    break
+                loss_dict = self.train_step(activations)
+
+                if (iter + 1) % self.cfg['val_freq'] == 0:
+                    logger.info('Epoch: {} Iteration: {} Total time: {:.4f}s'.format(epoch+1, iter+1, time.time()-time_start))
+                    for i in range(self.n_members):
+                        member = self.get_member(i)
+                        logger.info('member {}: {}'.format(i, ' '.join(['{}: {:.4f}'.format(k, v[i]) for k, v in loss_dict.items()])))
+                        score = member.get_recons_loss(self.dataloader, model, self.member_cfgs[i], num_batches=5)[0]
+                        history[i].append(dict({k: v[i] for k, v in loss_dict.items()}, iteration=iter+1, epoch=epoch+1, reconstruction_score=float(score)))
+                        if score > best_reconstruct[i]:
+                            best_reconstruct[i] = score
+                            member.save(ckpt_name='best_reconstruct')
+
+                if (iter + 1) % 10000 == 0:
+                    logger.info('saved at:' + self.cfg['save_dir'])
+                    for i in range(self.n_members):
+                        self.get_member(i).save(ckpt_name='Iteration' + str(iter+1) + '_Epoch' + str(epoch+1))
+                    freqs = self.get_freqs(num_batches=25)
+                    for i, member_cfg in enumerate(self.member_cfgs):
+                        if member_cfg['reinit'] == 1:
+                            self.re_init(i, freqs[i] < 10**(-5.5))
+            for i in range(self.n_members):
+                self.get_member(i).save(ckpt_name='Iteration' + str(iter) + '_Epoch' + str(epoch+1))
+        for i, member_cfg in enumerate(self.member_cfgs):
+            with open(os.path.join(member_cfg['save_dir'], 'metrics.json'), 'w') as f:
+                json.dump(history[i], f, indent=2)
+        self.get_member(0).wait_for_saves()
+
+
+def main():
+    from utils import set_seed, arg_parse_update_cfg, process_cfg
+    from config import cfg as default_cfg
+    from models import model_factory
+    from datasets_ import dataset_factory
+    from dataloaders import dataloader_factory
+
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO, force=True)
+    torch.set_default_dtype(torch.float32)
+    parser = argparse.ArgumentParser()
+    cfg, args = arg_parse_update_cfg(default_cfg, parser)
+    set_seed(cfg['seed'])
+    instrument.configure(cfg)
+
+    model = model_factory(cfg)
+    cfg = process_cfg(cfg, model)
+    dataloader = dataloader_factory(cfg, dataset_factory(cfg), model)
+    member_cfgs = [get_member_cfg(cfg, overrides, i) for i, overrides in enumerate(parse_sweep(cfg['sweep'], cfg))]
+    logger.info('Training {} autoencoders on one activation stream'.format(len(member_cfgs)))
+    trainer = MultiAutoEncoder(cfg, dataloader, member_cfgs)
+    with instrument.timer('extractor/extract_concepts'):
+        trainer.extract_concepts(model)
+    if instrument.enabled:
+        logger.info('Instrumentation summary:\n{}'.format(instrument.summary()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Trains one autoencoder per harvested site on activations cached by a single forward pass, e.g.
+
+    python -m extractors.multi_site --harvest_layers all --harvest_sites resid_post,mlp_post
+
+Every extractor is saved under the save_dir of its own layer and site.
+"""
+import time
+import argparse
+
+import torch
+import logging
+from logger import logger
+from instrument import instrument
+from dataloaders.ae import SiteDataloader
+from .ae import AutoEncoder
+
+
+def extract_site_concepts(cfg, dataloader, model):
+    """
+    Trains the autoencoder of every site of `dataloader` on the same rows of the shared buffers.
+    """
+    from utils import get_site_cfg
+    extractors = dict()
+    optimizers = dict()
+    for layer, site, act_name in dataloader.sites:
+        site_cfg = get_site_cfg(cfg, layer, site, act_name)
+        extractors[act_name] = AutoEncoder(site_cfg, SiteDataloader(dataloader, act_name)).to(cfg['device'])
+        optimizers[act_name] = torch.optim.Adam(extractors[act_name].parameters(), lr=cfg["lr"], betas=(cfg["beta1"], cfg["beta2"]))
+    logger.info('Training {} autoencoders on one activation stream: {}'.format(len(extractors), list(extractors.keys())))
+
+    best_reconstruct = {act_name: 0 for act_name in extractors}
+    time_start = time.time()
+    for epoch in range(cfg['epoch']):
+        logger.info('epoch:{}'.format(epoch + 1))
+        if epoch > 0:
+            dataloader.reinit()
+        for iter in range(len(dataloader)):
+            batches = dataloader.next_sites()
+            if dataloader.empty_flag == 1:
+                logger.info('All training data in dataloader has been passed through.')
+                break
+            loss_dicts = {act_name: extractor.train_step(batches[act_name], optimizers[act_name]) for act_name, extractor in extractors.items()}
+
+            if (iter + 1) % cfg['val_freq'] == 0:
+                logger.info('Epoch: {} Iteration: {} Total time: {:.4f}s'.format(epoch+1, iter+1, time.time()-time_start))
+                for act_name, extractor in extractors.items():
+                    logger.info('{}: {}'.format(act_name, ' '.join(['{}: {:.4f}'.format(k, v) for k, v in loss_dicts[act_name].items()])))
+                    score = extractor.get_recons_loss(extractor.dataloader, model, extractor.cfg, num_batches=5)[0]
+                    if score > best_reconstruct[act_name]:
+                        best_reconstruct[act_name] = score
+                        extractor.save(ckpt_name='best_reconstruct')
+        for extractor in extractors.values():
+            extractor.save(ckpt_name='Iteration' + str(iter) + '_Epoch' + str(epoch+1))
+    for extractor in extractors.values():
+        extractor.wait_for_saves()
+    return extractors
+
+
+def main():
+    from utils import set_seed, arg_parse_update_cfg, process_cfg
+    from config import cfg as default_cfg
+    from models import model_factory
+    from datasets_ import dataset_factory
+    from dataloaders import dataloader_factory
+
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO, force=True)
+    torch.set_default_dtype(torch.float32)
+    parser = argparse.ArgumentParser()
+    cfg, args = arg_parse_update_cfg(default_cfg, parser)
+    set_seed(cfg['seed'])
+    instrument.configure(cfg)
+
+    model = model_factory(cfg)
+    cfg = process_cfg(cfg, model)
+    dataloader = dataloader_factory(cfg, dataset_factory(cfg), model)
+    with instrument.timer('extractor/extract_concepts'):
+        extract_site_concepts(cfg, dataloader, model)
+    if instrument.enabled:
+        logger.info('Instrumentation summary:\n{}'.format(instrument.summary()))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 from .base import BaseExtractor
 import torch
+from instrument import instrument
 import torch.nn as nn
 import torch.nn.functional as F
 
@@ -37,6 +38,7 @@ class Neuron(nn.Module, BaseExtractor):
     def get_concepts(self):
         return self.concepts
         
+    @instrument.timed('extractor/activation_func')
     @torch.no_grad()
     def activation_func(self, tokens, model, concept=None, concept_idx=None):    
         _, cache = model.run_with_cache(tokens, stop_at_layer=self.cfg["layer"]+1, names_filter=self.cfg["act_name"])
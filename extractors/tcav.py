@@ -1,6 +1,9 @@
 from .base import BaseExtractor
+from .artifact import is_artifact, load_artifact, load_manifest
+from dataloaders.batching import tokenize_bucketed, get_max_batch_tokens
 
 import torch
+from instrument import instrument
 import numpy as np
 import torch.nn as nn
 from utils import *
@@ -8,7 +11,6 @@ from sklearn.metrics import accuracy_score
 from sklearn.linear_model import LogisticRegression
 from sklearn.model_selection import train_test_split
 from logger import logger
-import json
 import pprint
 
 class TCAVExtractor(nn.Module, BaseExtractor):
@@ -28,13 +30,18 @@ class TCAVExtractor(nn.Module, BaseExtractor):
         return 'tcav'
     
     def get_reps(self, concept_examples):
+        """
+        The representations of the last token of every example. Examples are batched by length under
+        the token budget of cfg['max_batch_tokens'] instead of being padded to the longest one.
+        """
+        concept_repres = [None] * len(concept_examples)
         with torch.no_grad():
-            inputs = self.tokenizer(concept_examples, max_length=128, truncation=True, padding=True,return_tensors="pt")
-            inputs = inputs.to('cpu')
-            _, cache = self.model.run_with_cache(inputs['input_ids'], names_filter=[self.act_name])
-            concept_repres = cache[self.act_name].cpu().detach().numpy()
-            concept_repres = concept_repres[np.arange(concept_repres.shape[0]),(inputs['attention_mask'].sum(-1)-1),:]
-        return concept_repres
+            for idxs, tokens, attention_mask in tokenize_bucketed(self.tokenizer, concept_examples, 128, get_max_batch_tokens(self.cfg)):
+                _, cache = self.model.run_with_cache(tokens, names_filter=[self.act_name])
+                reps = cache[self.act_name][torch.arange(tokens.shape[0]), attention_mask.sum(-1) - 1, :].cpu().numpy()
+                for i, rep in zip(idxs, reps):
+                    concept_repres[i] = rep
+        return np.stack(concept_repres, 0)
     
     def get_token_reps(self, tokens):
         with torch.no_grad():
@@ -43,6 +50,7 @@ class TCAVExtractor(nn.Module, BaseExtractor):
             concept_repres = concept_repres[np.arange(concept_repres.shape[0]), :, :]
         return concept_repres
     
+    @instrument.timed('extractor/activation_func')
     @torch.no_grad()
     def activation_func(self, tokens, model, concept=None, concept_idx=None):    
         _, cache = model.run_with_cache(tokens, stop_at_layer=self.cfg["layer"]+1, names_filter=self.cfg["act_name"])
@@ -86,8 +94,13 @@ class TCAVExtractor(nn.Module, BaseExtractor):
 
         self.concept = torch.tensor(cav).unsqueeze(0)
         logger.info('Acc in training set: {:.2f}, in val set: {:.2f}'.format(np.mean(accuracy_train), np.mean(accuracy_val)))
-        torch.save(cav, "./data/tcav_concept.pt")
-        torch.save(self.classifier, "./data/tcav_classifier.pt")
+        self.save_artifact(self.code(), {
+            'concept': self.concept, 
+            'coef': torch.tensor(self.coef_), 
+            'intercept': torch.tensor(self.intercept_), 
+            'classes': torch.tensor(self.classifier.classes_),
+        })
+        self.wait_for_saves()
         return self.concept, accuracy_val
     
     def get_concepts(self):
@@ -104,11 +117,22 @@ class TCAVExtractor(nn.Module, BaseExtractor):
         """
         """
         if cfg == None:
-            cfg = json.load(open(path + ".json", "r"))
+            cfg = load_manifest(path)['cfg']
         if path == None:
             path = cfg['load_path']
         pprint.pprint(cfg)
         self = cls(cfg=cfg, dataloader=dataloader)
-        self.concept = torch.tensor(torch.load("./data/tcav_concept.pt")).unsqueeze(0).to(cfg['device'])
-        self.classifier = torch.load("./data/tcav_classifier.pt")
+        if not is_artifact(path):
+            self.concept = torch.tensor(torch.load("./data/tcav_concept.pt")).unsqueeze(0).to(cfg['device'])
+            self.classifier = torch.load("./data/tcav_classifier.pt")
+            return self
+        tensors, _ = load_artifact(path, cfg['device'])
+        self.concept = tensors['concept']
+        # the classifier is rebuilt from its parameters instead of being unpickled
+        self.coef_ = tensors['coef'].cpu().numpy()
+        self.intercept_ = tensors['intercept'].cpu().numpy()
+        self.classifier = LogisticRegression(solver='saga', max_iter=10000)
+        self.classifier.coef_ = self.coef_
+        self.classifier.intercept_ = self.intercept_
+        self.classifier.classes_ = tensors['classes'].cpu().numpy()
         return self
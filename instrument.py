@@ -0,0 +1,123 @@
+import os
+import time
+import resource
+import functools
+import contextlib
+from collections import OrderedDict, Counter
+import torch
+from logger import logger
+
+
+class Instrument:
+    """
+    Lightweight per-stage instrumentation: wall-clock timers, counters of forward/backward passes
+    and processed tokens, peak memory sampling and optional torch.profiler traces.
+    Everything is a no-op unless it is enabled through cfg['instrument'].
+    """
+    def __init__(self):
+        self.enabled = False
+        self.device = 'cpu'
+        self.trace_dir = ''
+        self.reset()
+
+    def configure(self, cfg):
+        self.enabled = bool(cfg['instrument'])
+        self.device = cfg['device']
+        self.trace_dir = cfg['profile_trace_dir']
+        self.reset()
+
+    def reset(self):
+        self.timers = OrderedDict()
+        self.counters = Counter()
+        self.peak_device_memory = 0
+        self.peak_host_memory = 0
+
+    def synchronize(self):
+        if str(self.device).startswith('cuda') and torch.cuda.is_available():
+            torch.cuda.synchronize(self.device)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        if not self.enabled:
+            yield
+            return
+        self.synchronize()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.synchronize()
+            self.record(name, time.perf_counter() - start)
+            self.sample_memory()
+
+    def record(self, name, seconds):
+        if self.enabled:
+            calls, total = self.timers.get(name, (0, 0.))
+            self.timers[name] = (calls + 1, total + seconds)
+
+    def timed(self, name):
+        """
+        Decorator version of `timer`.
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] += int(n)
+
+    def sample_memory(self):
+        if str(self.device).startswith('cuda') and torch.cuda.is_available():
+            self.peak_device_memory = max(self.peak_device_memory, torch.cuda.max_memory_allocated(self.device))
+        # ru_maxrss is in KB on Linux
+        self.peak_host_memory = max(self.peak_host_memory, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+
+    def watch_model(self, model):
+        """
+        Counts the forward passes through `model` and the tokens they process.
+        """
+        if not self.enabled:
+            return
+
+        def hook(module, args):
+            self.count('forward_passes')
+            if len(args) > 0 and torch.is_tensor(args[0]) and not args[0].is_floating_point():
+                self.count('tokens', args[0].numel())
+
+        model.register_forward_pre_hook(hook)
+
+    @contextlib.contextmanager
+    def trace(self, name='trace'):
+        """
+        Records a torch.profiler trace of the enclosed block if a trace directory is configured.
+        """
+        if not self.enabled or self.trace_dir == '':
+            yield
+            return
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        with torch.profiler.profile(activities=activities, record_shapes=True) as prof:
+            yield
+        os.makedirs(self.trace_dir, exist_ok=True)
+        path = os.path.join(self.trace_dir, name + '.json')
+        prof.export_chrome_trace(path)
+        logger.info('Saved profiler trace to {}'.format(path))
+
+    def summary(self):
+        lines = ['{:<56s} {:>8s} {:>12s} {:>12s}'.format('stage', 'calls', 'total (s)', 'mean (s)')]
+        for name, (calls, total) in sorted(self.timers.items(), key=lambda x: -x[1][1]):
+            lines.append('{:<56s} {:>8d} {:>12.4f} {:>12.4f}'.format(name, calls, total, total / calls))
+        for name, value in self.counters.items():
+            lines.append('{:<56s} {:>8d}'.format(name, value))
+        lines.append('peak device memory: {:.1f} MB'.format(self.peak_device_memory / 2**20))
+        lines.append('peak host memory: {:.1f} MB'.format(self.peak_host_memory / 2**20))
+        return '\n'.join(lines)
+
+
+instrument = Instrument()
@@ -1,9 +1,15 @@
+import time
+start_time = time.perf_counter()
 import argparse
 from utils import *
+from instrument import instrument
+from precision import apply_precision, measure_precision_drift, format_drift
+from distributed import run_coordinator, run_worker, load_eval_set
 from config import cfg as default_cfg
 import logging
 from dataloaders import dataloader_factory
 from extractors import extractor_factory
+from extractors.concept_index import ConceptIndex
 from datasets_ import dataset_factory
 from models import model_factory
 from evaluators import evaluator_factory
@@ -11,54 +17,26 @@ from metric_evaluators import metric_evaluator_factory
 import json
 
 
-def main():
+def get_eval_tokens(dataloader, n_batches=5):
     """
-    Here we take the process of concept extraction by autoencoder as an example.
+    Draws the evaluation corpus shared by all evaluators.
     """
-    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO, force=True)
-    logger = logging.getLogger('logger')
-
-
-    torch.set_default_dtype(torch.float32)
-
-    parser = argparse.ArgumentParser()
-    cfg, args = arg_parse_update_cfg(default_cfg, parser)
-    
-    set_seed(cfg['seed'])
-
-    model = model_factory(cfg)
-    
-    logger.info('loaded model...')
-    
-    cfg = process_cfg(cfg, model)
-    print(json.dumps(cfg, indent=2))
-    
-    train_data = dataset_factory(cfg)
-    dataloader = dataloader_factory(cfg, train_data, model)
-    extractor = extractor_factory(cfg, dataloader)
-    if cfg['load_extractor']:
-        logger.info('loading extractor...')
-        extractor = extractor.load_from_file(dataloader, cfg['load_path'], cfg).to(cfg['device'])
-    else:
-        logger.info('extract concepts...')
-        extractor.extract_concepts(model)
-        
-    concepts = extractor.get_concepts()
-    print('concept vectors:', concepts)
-    print('concepts.shape:', concepts.shape)
-    
-    concept_idxs = [i for i in range(200)]
-    
     token_list = []
     origin_token_list = []
-    print('\nconcept idxs:', concept_idxs)
-    for _ in range(5):
+    for _ in range(n_batches):
         tokens, origin_tokens = dataloader.get_processed_random_batch()
         token_list.append(tokens)
         origin_token_list.append(origin_tokens)
     tokens = torch.cat(token_list, 0)
     origin_tokens = torch.cat(origin_token_list, 0)
     print('len(origin_token_list):',len(origin_token_list))
+    return tokens, origin_tokens
+
+
+def build_evaluators(cfg, extractor, model):
+    """
+    Instantiates the concept evaluators whose metrics are compared by the metric evaluator.
+    """
     evaluator_dict = dict()
     
     cfg['evaluator'] = 'faithfulness'
@@ -155,18 +133,105 @@ def main():
         ),
         
     })
+    return evaluator_dict
 
 
+def main():
+    """
+    Here we take the process of concept extraction by autoencoder as an example.
+    """
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO, force=True)
+    logger = logging.getLogger('logger')
+
+
+    torch.set_default_dtype(torch.float32)
+
+    parser = argparse.ArgumentParser()
+    cfg, args = arg_parse_update_cfg(default_cfg, parser)
+    if cfg['distributed_role'] == 'worker':
+        # a worker that trained its own extractor would score different concepts than the others
+        assert cfg['load_extractor'], "Workers load the extractor from 'load_path', please run them with --load_extractor."
+    
+    set_seed(cfg['seed'])
+    instrument.configure(cfg)
+    startup_time = time.perf_counter() - start_time
+    instrument.record('startup', startup_time)
+    logger.info('startup took {:.3f}s'.format(startup_time))
+
+    model = model_factory(cfg)
+    instrument.watch_model(model)
+    
+    logger.info('loaded model...')
+    
+    cfg = process_cfg(cfg, model)
+    print(json.dumps(cfg, indent=2))
+    
+    train_data = dataset_factory(cfg)
+    dataloader = dataloader_factory(cfg, train_data, model)
+    extractor = extractor_factory(cfg, dataloader)
+    if cfg['load_extractor']:
+        logger.info('loading extractor...')
+        extractor = extractor.load_from_file(dataloader, cfg['load_path'], cfg).to(cfg['device'])
+    else:
+        logger.info('extract concepts...')
+        with instrument.timer('extractor/extract_concepts'):
+            extractor.extract_concepts(model)
+        
+    concepts = extractor.get_concepts()
+    print('concept vectors:', concepts)
+    print('concepts.shape:', concepts.shape)
+    
+    concept_idxs = [i for i in range(cfg['n_concepts'])]
+    if cfg['dedupe_threshold'] > 0:
+        index = ConceptIndex(concepts[concept_idxs], mode=cfg['concept_index_mode'])
+        keep = index.dedupe(cfg['dedupe_threshold'])
+        logger.info('dropped {} near-duplicate concepts'.format(len(concept_idxs) - len(keep)))
+        concept_idxs = [concept_idxs[i] for i in keep]
+    
+    if cfg['distributed_role'] == 'worker':
+        # the coordinator decides what is evaluated
+        tokens, origin_tokens, eval_concepts, concept_idxs = load_eval_set(cfg['queue_dir'], cfg['device'], poll=cfg['queue_poll'])
+    else:
+        tokens, origin_tokens = get_eval_tokens(dataloader)
+        eval_concepts = concepts[concept_idxs]
+    print('\nconcept idxs:', concept_idxs)
+    evaluator_dict = build_evaluators(cfg, extractor, model)
+    if cfg['eval_precision'] != 'fp32':
+        if cfg['precision_drift_concepts'] > 0:
+            n = cfg['precision_drift_concepts']
+            report = measure_precision_drift(model, extractor, evaluator_dict, tokens, eval_concepts[:n], concept_idxs[:n], cfg['eval_precision'], cfg['device'])
+            logger.info('Metric drift against fp32:\n{}'.format(format_drift(report, cfg['eval_precision'])))
+        else:
+            apply_precision(model, extractor, cfg['eval_precision'], cfg['device'])
+        eval_concepts = eval_concepts.to(model.cfg.dtype)
+
     metric_evaluator = metric_evaluator_factory(cfg)
-    metric_of_metrics = metric_evaluator.get_metric(
-        tokens, 
-        evaluator_dict, 
-        concepts=concepts[concept_idxs],
-        concept_idxs=concept_idxs,
-        origin_tokens=origin_tokens,
+    if cfg['distributed_role'] == 'worker':
+        run_worker(cfg, metric_evaluator, tokens, evaluator_dict, eval_concepts, concept_idxs)
+        return
+    with instrument.trace('metric_evaluation'):
+        if cfg['distributed_role'] == 'coordinator':
+            metric_of_metrics = run_coordinator(
+                cfg, 
+                metric_evaluator, 
+                tokens, 
+                origin_tokens, 
+                list(evaluator_dict.keys()), 
+                eval_concepts, 
+                concept_idxs,
+            )
+        else:
+            metric_of_metrics = metric_evaluator.get_metric(
+                tokens, 
+                evaluator_dict, 
+                concepts=eval_concepts,
+                concept_idxs=concept_idxs,
+                origin_tokens=origin_tokens,
 
-    )
+            )
     print('metric_of_metrics:\n',metric_of_metrics)
+    if instrument.enabled:
+        logger.info('Instrumentation summary:\n{}'.format(instrument.summary()))
     
 if __name__ == "__main__":
     print('Hello guys!')
@@ -1,13 +1,14 @@
-from .rc import ReliabilityConsistencyEvaluator
-from .rs import ReliabilityStabilityEvaluator
-from .vr import ValidityRelevanceEvaluator
+from registry import LazyRegistry
 
-METRICEVALUATORS = {
-    ReliabilityConsistencyEvaluator.code(): ReliabilityConsistencyEvaluator,
-    ReliabilityStabilityEvaluator.code(): ReliabilityStabilityEvaluator,
-    ValidityRelevanceEvaluator.code(): ValidityRelevanceEvaluator,
-}
+METRICEVALUATORS = LazyRegistry(__name__, {
+    'rc': '.rc:ReliabilityConsistencyEvaluator',
+    'rs': '.rs:ReliabilityStabilityEvaluator',
+    'vr': '.vr:ValidityRelevanceEvaluator',
+})
+
+def __getattr__(name):
+    return METRICEVALUATORS.get_class(name)
 
 def metric_evaluator_factory(cfg):
     evaluator = METRICEVALUATORS[cfg['metric_evaluator']]
-    return evaluator(cfg)
\ No newline at end of file
+    return evaluator(cfg)
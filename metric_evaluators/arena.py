@@ -0,0 +1,70 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+
+
+class SpillArena:
+    """
+    A spill-to-disk store for the per-token metrics and activations that the 'replace-ablation'
+    evaluators combine later. Arrays are written to memory-mapped files in a compact dtype and
+    deleted as soon as the last pending reader has taken them, so peak RAM does not grow with
+    the number of concepts.
+    """
+    def __init__(self, root='', dtype='float16'):
+        self.dir = tempfile.mkdtemp(prefix='arena-', dir=root if root != '' else None)
+        self.dtype = np.dtype(dtype)
+        self.entries = dict()
+        self.n_files = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def put(self, key, array, refs=1):
+        """
+        Stores `array` until it has been taken `refs` times. Nothing is kept when refs is 0.
+        """
+        if refs <= 0:
+            return
+        if key in self.entries:
+            self.release(key, self.entries[key][2])
+        array = np.asarray(array)
+        path = os.path.join(self.dir, '{}.bin'.format(self.n_files))
+        self.n_files += 1
+        mm = np.memmap(path, dtype=self.dtype, mode='w+', shape=array.shape)
+        mm[:] = array
+        mm.flush()
+        del mm
+        self.entries[key] = [path, array.shape, refs]
+
+    def get(self, key):
+        path, shape, _ = self.entries[key]
+        return np.asarray(np.memmap(path, dtype=self.dtype, mode='r', shape=shape), dtype=np.float32)
+
+    def take(self, key):
+        """
+        Returns the stored array as float32 and releases one reference to it.
+        """
+        array = self.get(key)
+        self.release(key)
+        return array
+
+    def release(self, key, n=1):
+        entry = self.entries[key]
+        entry[2] -= n
+        if entry[2] <= 0:
+            os.remove(entry[0])
+            del self.entries[key]
+
+    def close(self):
+        self.entries = dict()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
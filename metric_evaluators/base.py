@@ -1,17 +1,74 @@
 from abc import *
 from utils import *
+from .store import ResultStore, hash_tensors
+from .arena import SpillArena
+
+# the settings besides the evaluation set that change the per-concept metrics, part of the key of every stored cell
+METRIC_CFG_KEYS = ['model_to_interpret', 'act_name', 'eval_precision', 'return_type', 'topic_len', 'activation_gated_ablation']
 
 class BaseMetricEvaluator(metaclass=ABCMeta):
     def __init__(self, cfg):
         super().__init__()
         self.cfg = cfg
+        self.store = None
+        if cfg['result_store']:
+            self.store = ResultStore(os.path.join(cfg['save_dir'], cfg['result_store_name']))
+            logger.info('Using result store {} ({} cells cached)'.format(self.store.path, len(self.store)))
 
     @classmethod
     @abstractmethod
     def code(cls):
         pass
-    
+
     @abstractmethod
     def get_metric():
         pass
-    
\ No newline at end of file
+
+    def get_arena(self):
+        return SpillArena(self.cfg['arena_dir'], self.cfg['arena_dtype'])
+
+    def get_eval_hash(self, *tokens):
+        """
+        Identifies the evaluation set together with the settings that change the per-concept metrics:
+        the model and hook point (neuron concepts are the same one-hot vectors everywhere) and METRIC_CFG_KEYS.
+        """
+        return '-'.join([hash_tensors(*tokens)] + [str(self.cfg[key]) for key in METRIC_CFG_KEYS])
+
+    def get_cell_key(self, name, concept, concept_idx, eval_hash):
+        return ('{}:{}'.format(self.cfg['extractor'], hash_tensors(concept)), concept_idx, name, eval_hash)
+
+    @staticmethod
+    def get_dependents(name, evaluator_names):
+        """
+        The 'replace-ablation' evaluators that combine the metrics cached by evaluator `name`.
+        """
+        return [
+            n for n in evaluator_names if 'replace-ablation' in n
+            and name in [n.replace('replace-ablation', 'ablation'), n.replace('replace-ablation', 'replace')]
+        ]
+
+    def get_pending_dependents(self, name, evaluator_names, concept, concept_idx, eval_hash):
+        dependents = self.get_dependents(name, evaluator_names)
+        if self.store is None:
+            return dependents
+        return [
+            n for n in dependents
+            if self.store.get(*self.get_cell_key(n, concept, concept_idx, eval_hash)) is None
+        ]
+
+    def load_cell(self, name, evaluator_names, concept, concept_idx, eval_hash):
+        """
+        Returns the stored metric of a cell, or None if it has to be computed.
+        Cells whose per-token metrics are still needed by a pending 'replace-ablation' cell are recomputed.
+        """
+        if self.store is None:
+            return None
+        value = self.store.get(*self.get_cell_key(name, concept, concept_idx, eval_hash))
+        if value is not None and self.get_pending_dependents(name, evaluator_names, concept, concept_idx, eval_hash):
+            return None
+        return value
+
+    def save_cell(self, name, concept, concept_idx, eval_hash, value):
+        if self.store is not None:
+            self.store.put(*self.get_cell_key(name, concept, concept_idx, eval_hash), value)
+
@@ -3,6 +3,7 @@ from .base import BaseMetricEvaluator
 import torch
 import torch.nn as nn
 from logger import logger
+from instrument import instrument
 from audtorch.metrics.functional import pearsonr
 import torch.nn.functional as F
 
@@ -27,12 +28,34 @@ class ReliabilityConsistencyEvaluator(nn.Module, BaseMetricEvaluator):
         origin_imp_idxs=None,
         **kwargs
     ):            
+        if self.cfg['rc_adaptive']:
+            return self.get_adaptive_metric(eval_tokens, evaluator_dict, concepts, concept_idxs)
+        separate_metrics = self.get_separate_metrics(eval_tokens, evaluator_dict, concepts, concept_idxs)
+        return self.get_consistency(separate_metrics, list(evaluator_dict.keys()))
+
+    def get_n_subdatasets(self, eval_tokens):
+        return len(eval_tokens.split(self.cfg['metric_eval_batchsize'], dim=0))
+
+    def get_separate_metrics(
+        self, 
+        eval_tokens, 
+        evaluator_dict, 
+        concepts, 
+        concept_idxs, 
+        subdataset_idxs=None,
+    ):
+        """
+        The metric of every concept on every sub-dataset, n_metrics * n_minibatch * n_concepts.
+        `subdataset_idxs` restricts the evaluation to some of the sub-datasets (e.g. the ones of a distributed task).
+        """
         evaluator_names = list(evaluator_dict.keys())        
         minibatch = self.cfg['metric_eval_batchsize']
         origin_tokens = eval_tokens
         print('origin_tokens.shape:',origin_tokens.shape)
         eval_tokens = eval_tokens.split(minibatch, dim=0) 
         print('len(eval_tokens):',len(eval_tokens))
+        if subdataset_idxs is None:
+            subdataset_idxs = list(range(len(eval_tokens)))
           
         metric_list = []
         topic_tokens = [[None for i in range(len(concept_idxs))] for j in range(len(eval_tokens))]
@@ -42,43 +65,136 @@ class ReliabilityConsistencyEvaluator(nn.Module, BaseMetricEvaluator):
         origin_dfs = [[None for i in range(len(concept_idxs))] for j in range(len(eval_tokens))]
         most_preferred_tokens = [[None for i in range(len(concept_idxs))] for j in range(len(eval_tokens))]
    
-        pre_metrics = dict()
-        pre_concept_acts = dict()
-        for i, tokens in enumerate(eval_tokens):
-            logger.info('Metric evaluation on subdataset {}...\n'.format(i+1))
-            tmp_metric_list = []
-            for name, evaluator in evaluator_dict.items():  
-                logger.info('Evaluating {} ...'.format(name))
-                concept_metric_list = []
+        with self.get_arena() as arena:
+            for i in subdataset_idxs:
+                tokens = eval_tokens[i]
+                logger.info('Metric evaluation on subdataset {}...\n'.format(i+1))
+                eval_hash = self.get_eval_hash(origin_tokens, tokens)
+                tmp_metric_list = []
+                for name, evaluator in evaluator_dict.items():  
+                    logger.info('Evaluating {} ...'.format(name))
+                    concept_metric_list = []
                 
-                for j, concept_idx in enumerate(concept_idxs):
-                    concept = concepts[j]
-                    evaluator.update_concept(concept, concept_idx) 
-                    if 'itc' in name:
-                        if topic_tokens[i][j] is None:
-                            tmp_tokens, tmp_idxs, origin_df, origin_critical_idxs_tmp = evaluator.get_most_critical_tokens(tokens, concept, concept_idx)
-                            topic_tokens[i][j] = tmp_tokens
-                            topic_idxs[i][j] = tmp_idxs
-                            origin_dfs[i][j] = origin_df
-                            origin_critical_idxs[i][j] = origin_critical_idxs_tmp
-                        concept_metric = evaluator.get_metric(origin_tokens, topic_tokens[i][j], topic_idxs[i][j], origin_critical_idxs[i][j])
-                    elif 'replace-ablation' in name: 
-                        abl_str = name.replace('replace-ablation', 'ablation') + str(concept_idx)
-                        rep_str = name.replace('replace-ablation', 'replace') + str(concept_idx)
-                        tmp_acts = pre_concept_acts[abl_str]
-                        tmp_metrics = pre_metrics[rep_str] + pre_metrics[abl_str] # ablation metrics has been inverted
-                        concept_metric = evaluator.get_metric(tokens, tmp_metrics, tmp_acts)
-                    elif ('replace' in name) or ('ablation' in name):
-                        concept_metric, tmp_metrics, tmp_acts = evaluator.get_metric(tokens, return_metric_and_acts=True)
-                        pre_metrics[name + str(concept_idx)] = tmp_metrics
-                        pre_concept_acts[name + str(concept_idx)] = tmp_acts
-                    else:
-                        concept_metric = evaluator.get_metric(tokens)
-                    concept_metric_list.append(concept_metric)
-                tmp_metric_list.append(concept_metric_list)
-            metric_list.append(tmp_metric_list)
+                    for j, concept_idx in enumerate(concept_idxs):
+                        concept = concepts[j]
+                        concept_metric = self.load_cell(name, evaluator_names, concept, concept_idx, eval_hash)
+                        if concept_metric is not None:
+                            instrument.count('cached_cells')
+                            concept_metric_list.append(concept_metric)
+                            continue
+                        with instrument.timer('metric_evaluator/' + name):
+                            evaluator.update_concept(concept, concept_idx) 
+                            if 'itc' in name:
+                                if topic_tokens[i][j] is None:
+                                    tmp_tokens, tmp_idxs, origin_df, origin_critical_idxs_tmp = evaluator.get_most_critical_tokens(tokens, concept, concept_idx)
+                                    topic_tokens[i][j] = tmp_tokens
+                                    topic_idxs[i][j] = tmp_idxs
+                                    origin_dfs[i][j] = origin_df
+                                    origin_critical_idxs[i][j] = origin_critical_idxs_tmp
+                                concept_metric = evaluator.get_metric(origin_tokens, topic_tokens[i][j], topic_idxs[i][j], origin_critical_idxs[i][j])
+                            elif 'replace-ablation' in name: 
+                                abl_str = name.replace('replace-ablation', 'ablation') + str(concept_idx)
+                                rep_str = name.replace('replace-ablation', 'replace') + str(concept_idx)
+                                tmp_acts = arena.take(('acts', abl_str))
+                                tmp_metrics = arena.take(('metrics', rep_str)) + arena.take(('metrics', abl_str)) # ablation metrics has been inverted
+                                concept_metric = evaluator.get_metric(tokens, tmp_metrics, tmp_acts)
+                            elif ('replace' in name) or ('ablation' in name):
+                                concept_metric, tmp_metrics, tmp_acts = evaluator.get_metric(tokens, return_metric_and_acts=True)
+                                # only keep what the pending 'replace-ablation' evaluators will read
+                                refs = len(self.get_pending_dependents(name, evaluator_names, concept, concept_idx, eval_hash))
+                                arena.put(('metrics', name + str(concept_idx)), tmp_metrics, refs)
+                                if 'ablation' in name:
+                                    arena.put(('acts', name + str(concept_idx)), tmp_acts, refs)
+                            else:
+                                concept_metric = evaluator.get_metric(tokens)
+                        self.save_cell(name, concept, concept_idx, eval_hash, concept_metric)
+                        concept_metric_list.append(concept_metric)
+                    tmp_metric_list.append(concept_metric_list)
+                metric_list.append(tmp_metric_list)
         separate_metrics = torch.tensor(metric_list) # n_minibatch, n_metrics, n_concepts
-        separate_metrics = separate_metrics.permute(1,0,2) # n_metrics, n_minibatch, n_concepts
+        return separate_metrics.permute(1,0,2) # n_metrics, n_minibatch, n_concepts
+
+    @staticmethod
+    def consistency(separate_metrics):
+        """
+        J / (J - 1) * (integral_vars - separate_vars) / integral_vars over the ... * J * n_concepts metrics.
+        """
+        separate_vars_agg = torch.var(separate_metrics, dim=-1).sum(-1)
+        integral_vars = torch.var(separate_metrics.sum(-2), dim=-1)
+        J = separate_metrics.shape[-2]
+        return J / (J - 1) * (integral_vars - separate_vars_agg) / integral_vars
+
+    def bootstrap_consistency(self, separate_metrics, generator):
+        """
+        The consistency of the J * n_concepts metrics of one evaluator and its bootstrap confidence
+        interval, from `rc_bootstrap` resamplings of the sub-datasets with replacement.
+        """
+        J = separate_metrics.shape[0]
+        samples = torch.randint(0, J, (self.cfg['rc_bootstrap'], J), generator=generator)
+        bootstrap = self.consistency(separate_metrics.double()[samples]) # n_bootstrap
+        alpha = 1. - self.cfg['rc_ci_level']
+        low, high = torch.nanquantile(bootstrap, torch.tensor([alpha / 2, 1. - alpha / 2], dtype=torch.float64)).tolist()
+        return self.consistency(separate_metrics.double()).item(), low, high
+
+    @staticmethod
+    def get_required_names(active_names, evaluator_names):
+        """
+        The evaluators to run for the active ones, including the sources of the active 'replace-ablation' evaluators.
+        """
+        sources = [
+            source for name in active_names if 'replace-ablation' in name
+            for source in [name.replace('replace-ablation', 'ablation'), name.replace('replace-ablation', 'replace')]
+        ]
+        return [name for name in evaluator_names if name in active_names or name in sources]
+
+    def get_adaptive_metric(self, eval_tokens, evaluator_dict, concepts, concept_idxs):
+        """
+        Evaluates the sub-datasets one at a time in a random order. After each one the consistency of
+        every metric and its bootstrap confidence interval are updated, and a metric is no longer
+        evaluated once the interval is narrower than cfg['rc_ci_tolerance'].
+        """
+        evaluator_names = list(evaluator_dict.keys())
+        n_subdatasets = self.get_n_subdatasets(eval_tokens)
+        generator = torch.Generator().manual_seed(self.cfg['seed'])
+        order = torch.randperm(n_subdatasets, generator=generator).tolist()
+        rows = {name: [] for name in evaluator_names}
+        estimates = {name: (float('nan'), float('nan'), float('nan')) for name in evaluator_names}
+        active = list(evaluator_names)
+        for i in order:
+            names = self.get_required_names(active, evaluator_names)
+            separate_metrics = self.get_separate_metrics(
+                eval_tokens, 
+                {name: evaluator_dict[name] for name in names}, 
+                concepts, 
+                concept_idxs, 
+                subdataset_idxs=[i],
+            ) # n_names, 1, n_concepts
+            for k, name in enumerate(names):
+                if name in active:
+                    rows[name].append(separate_metrics[k, 0])
+            for name in list(active):
+                J = len(rows[name])
+                if J < 2:
+                    continue
+                estimates[name] = self.bootstrap_consistency(torch.stack(rows[name]), generator)
+                estimate, low, high = estimates[name]
+                logger.info('{}: consistency {:4f} [{:4f}, {:4f}] on {} sub-datasets'.format(name, estimate, low, high, J))
+                if J >= self.cfg['rc_min_subdatasets'] and high - low < self.cfg['rc_ci_tolerance']:
+                    active.remove(name)
+            instrument.count('rc/adaptive_subdatasets', len(names))
+            if len(active) == 0:
+                break
+        logger.info('Metric Consistency: \n{}'.format(
+            ' '.join(
+                ['{}:{:4f} (J={})'.format(name, estimates[name][0], len(rows[name])) for name in evaluator_names]
+                )
+            ))    
+        return torch.tensor([estimates[name][0] for name in evaluator_names])
+
+    def get_consistency(self, separate_metrics, evaluator_names):
+        """
+        Consistency of every metric across the sub-datasets, from the n_metrics * n_minibatch * n_concepts metrics.
+        """
         print('separate_metrics:\n',separate_metrics)
         separate_vars_agg = torch.var(separate_metrics, dim=-1)
         print('separate_vars:\n',separate_vars_agg)
@@ -86,7 +202,7 @@ class ReliabilityConsistencyEvaluator(nn.Module, BaseMetricEvaluator):
         integral_vars = torch.var(separate_metrics.sum(1), dim=-1) # n_metrics
         
         J = separate_metrics.shape[1] 
-        final_metrics = J / (J - 1) * (integral_vars - separate_vars_agg) / integral_vars # n_metrics
+        final_metrics = self.consistency(separate_metrics) # n_metrics
         print('J:', J)
         print('separate_vars_agg:', separate_vars_agg)
         print('integral_vars:', integral_vars)
@@ -2,6 +2,7 @@ from .base import BaseMetricEvaluator
 import torch
 import torch.nn as nn
 from logger import logger
+from instrument import instrument
 from audtorch.metrics.functional import pearsonr
 
 
@@ -30,7 +31,8 @@ class ReliabilityStabilityEvaluator(nn.Module, BaseMetricEvaluator):
             tmp_metric_list = []
             for name, evaluator in evaluator_dict.items():   
                 logger.info('Evaluating {} ...'.format(name))
-                metric = evaluator.get_metric(tokens)
+                with instrument.timer('metric_evaluator/' + name):
+                    metric = evaluator.get_metric(tokens)
                 tmp_metric_list.append(metric)
             metric_list.append(tmp_metric_list)
         metrics_1 = torch.tensor(metric_list).transpose(0,1) # n_metrics, n_iterations
@@ -41,7 +43,8 @@ class ReliabilityStabilityEvaluator(nn.Module, BaseMetricEvaluator):
             tmp_metric_list = []
             for name, evaluator in evaluator_dict.items():   
                 logger.info('Evaluating {} ...'.format(name))
-                metric = evaluator.get_metric(tokens)
+                with instrument.timer('metric_evaluator/' + name):
+                    metric = evaluator.get_metric(tokens)
                 tmp_metric_list.append(metric)
             metric_list.append(tmp_metric_list)
         metrics_2 = torch.tensor(metric_list).transpose(0,1) # n_metrics, n_iterations
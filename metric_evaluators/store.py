@@ -0,0 +1,64 @@
+import os
+import sqlite3
+import hashlib
+import torch
+
+
+def hash_tensors(*tensors):
+    """
+    Content hash of one or more tensors, used to identify concepts and evaluation sets.
+    """
+    h = hashlib.sha1()
+    for t in tensors:
+        if t is None:
+            continue
+        t = torch.as_tensor(t).detach().cpu()
+        if t.is_floating_point():
+            t = t.float()
+        h.update(str(tuple(t.shape)).encode())
+        h.update(t.contiguous().numpy().tobytes())
+    return h.hexdigest()
+
+
+class ResultStore:
+    """
+    A persistent store of per-concept metrics, keyed by (extractor, concept_idx, evaluator, eval_hash).
+    Every cell is committed as soon as it is written, so an interrupted run can be resumed
+    and only the missing cells are computed again.
+    """
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS metrics ('
+            'extractor TEXT, concept_idx INTEGER, evaluator TEXT, eval_hash TEXT, value REAL, '
+            'PRIMARY KEY (extractor, concept_idx, evaluator, eval_hash))'
+        )
+        self.conn.commit()
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM metrics').fetchone()[0]
+
+    def __contains__(self, key):
+        return self.get(*key) is not None
+
+    def get(self, extractor, concept_idx, evaluator, eval_hash):
+        row = self.conn.execute(
+            'SELECT value FROM metrics WHERE extractor=? AND concept_idx=? AND evaluator=? AND eval_hash=?',
+            (extractor, int(concept_idx), evaluator, eval_hash),
+        ).fetchone()
+        if row is None:
+            return None
+        # sqlite stores NaN as NULL
+        return float('nan') if row[0] is None else row[0]
+
+    def put(self, extractor, concept_idx, evaluator, eval_hash, value):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO metrics VALUES (?, ?, ?, ?, ?)',
+            (extractor, int(concept_idx), evaluator, eval_hash, float(value)),
+        )
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
@@ -2,6 +2,7 @@ from .base import BaseMetricEvaluator
 import torch
 import torch.nn as nn
 from logger import logger
+from instrument import instrument
 import numpy as np
 import datetime
 from scipy.stats import kendalltau, pearsonr
@@ -39,39 +40,50 @@ class ValidityRelevanceEvaluator(nn.Module, BaseMetricEvaluator):
         origin_dfs = [None for i in range(len(concept_idxs))]
         
         most_preferred_tokens = [None for i in range(len(concept_idxs))]
-        pre_metrics = dict()
-        pre_concept_acts = dict()
-        for name, evaluator in evaluator_dict.items():   
-            logger.info('Evaluating {} ...'.format(name))   
-            concept_metric_list = []    
-            for j, concept_idx in enumerate(concept_idxs):
-                concept = concepts[j]
-                evaluator.update_concept(concept, concept_idx) 
-                if 'itc' in name:
-                    if topic_tokens[j] is None:
-                        tmp_tokens, tmp_idxs, origin_df, origin_critical_idxs_tmp = evaluator.get_most_critical_tokens(eval_tokens, concept, concept_idx)
-                        topic_tokens[j] = tmp_tokens
-                        topic_idxs[j] = tmp_idxs
-                        origin_dfs[j] = origin_df
-                        origin_critical_idxs[j] = origin_critical_idxs_tmp
-                    concept_metric = evaluator.get_metric(origin_tokens, topic_tokens[j], topic_idxs[j], origin_critical_idxs[j])
-                elif 'replace-ablation' in name: 
-                    abl_str = name.replace('replace-ablation', 'ablation') + str(concept_idx)
-                    rep_str = name.replace('replace-ablation', 'replace') + str(concept_idx)
-                    tmp_acts = pre_concept_acts[abl_str]
-                    tmp_metrics = pre_metrics[rep_str] + pre_metrics[abl_str] # ablation metrics has been inverted
-                    concept_metric = evaluator.get_metric(eval_tokens, tmp_metrics, tmp_acts)
-                elif ('replace' in name) or ('ablation' in name):
-                    concept_metric, tmp_metrics, tmp_acts = evaluator.get_metric(eval_tokens, return_metric_and_acts=True)
-                    pre_metrics[name + str(concept_idx)] = tmp_metrics
-                    pre_concept_acts[name + str(concept_idx)] = tmp_acts
-                elif 'otc' in name:
-                    concept_metric, tmp_preferred_tokens = evaluator.get_metric(eval_tokens, return_tokens=True)
-                    most_preferred_tokens[j] = tmp_preferred_tokens
-                else:
-                    concept_metric = evaluator.get_metric(eval_tokens)
-                concept_metric_list.append(concept_metric)
-            metric_list.append(concept_metric_list)
+        evaluator_names = list(evaluator_dict.keys())
+        eval_hash = self.get_eval_hash(origin_tokens, eval_tokens)
+        with self.get_arena() as arena:
+            for name, evaluator in evaluator_dict.items():   
+                logger.info('Evaluating {} ...'.format(name))   
+                concept_metric_list = []    
+                for j, concept_idx in enumerate(concept_idxs):
+                    concept = concepts[j]
+                    concept_metric = self.load_cell(name, evaluator_names, concept, concept_idx, eval_hash)
+                    if concept_metric is not None:
+                        instrument.count('cached_cells')
+                        concept_metric_list.append(concept_metric)
+                        continue
+                    with instrument.timer('metric_evaluator/' + name):
+                        evaluator.update_concept(concept, concept_idx) 
+                        if 'itc' in name:
+                            if topic_tokens[j] is None:
+                                tmp_tokens, tmp_idxs, origin_df, origin_critical_idxs_tmp = evaluator.get_most_critical_tokens(eval_tokens, concept, concept_idx)
+                                topic_tokens[j] = tmp_tokens
+                                topic_idxs[j] = tmp_idxs
+                                origin_dfs[j] = origin_df
+                                origin_critical_idxs[j] = origin_critical_idxs_tmp
+                            concept_metric = evaluator.get_metric(origin_tokens, topic_tokens[j], topic_idxs[j], origin_critical_idxs[j])
+                        elif 'replace-ablation' in name: 
+                            abl_str = name.replace('replace-ablation', 'ablation') + str(concept_idx)
+                            rep_str = name.replace('replace-ablation', 'replace') + str(concept_idx)
+                            tmp_acts = arena.take(('acts', abl_str))
+                            tmp_metrics = arena.take(('metrics', rep_str)) + arena.take(('metrics', abl_str)) # ablation metrics has been inverted
+                            concept_metric = evaluator.get_metric(eval_tokens, tmp_metrics, tmp_acts)
+                        elif ('replace' in name) or ('ablation' in name):
+                            concept_metric, tmp_metrics, tmp_acts = evaluator.get_metric(eval_tokens, return_metric_and_acts=True)
+                            # only keep what the pending 'replace-ablation' evaluators will read
+                            refs = len(self.get_pending_dependents(name, evaluator_names, concept, concept_idx, eval_hash))
+                            arena.put(('metrics', name + str(concept_idx)), tmp_metrics, refs)
+                            if 'ablation' in name:
+                                arena.put(('acts', name + str(concept_idx)), tmp_acts, refs)
+                        elif 'otc' in name:
+                            concept_metric, tmp_preferred_tokens = evaluator.get_metric(eval_tokens, return_tokens=True)
+                            most_preferred_tokens[j] = tmp_preferred_tokens
+                        else:
+                            concept_metric = evaluator.get_metric(eval_tokens)
+                    self.save_cell(name, concept, concept_idx, eval_hash, concept_metric)
+                    concept_metric_list.append(concept_metric)
+                metric_list.append(concept_metric_list)
         metrics = torch.tensor(metric_list) # n_metrics, n_concepts 
         
         dtime = datetime.datetime.now().strftime('%Y-%m-%d %H-%M-%S')
@@ -1,12 +1,14 @@
-from .pythia_70m import Pythia70M
-from .llama_2_7b_chat import Llama2Chat7B
-from .gpt2_small import GPT2Small
-
-MODELS = {
-    Pythia70M.code(): Pythia70M,
-    Llama2Chat7B.code(): Llama2Chat7B,
-    GPT2Small.code(): GPT2Small,
-}
+from registry import LazyRegistry
+
+MODELS = LazyRegistry(__name__, {
+    'pythia-70m': '.pythia_70m:Pythia70M',
+    'llama-2-7b-chat': '.llama_2_7b_chat:Llama2Chat7B',
+    'gpt2-small': '.gpt2_small:GPT2Small',
+})
+
+
+def __getattr__(name):
+    return MODELS.get_class(name)
 
 
 def model_factory(cfg):
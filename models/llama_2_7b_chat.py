@@ -76,7 +76,7 @@ class Llama2Chat7B(BaseModel):
                                                         center_writing_weights=False, 
                                                         center_unembed=False, 
                                                         hf_model=hf_model, 
-                                                        tokenizer=tokenizer)
+                                                        tokenizer=self.tokenizer)
                 
                 self.tokenizer.add_special_tokens({'pad_token': '<unk>'})
                 self.model.tokenizer.add_special_tokens({'pad_token': '<unk>'})
@@ -0,0 +1,150 @@
+import queue
+import threading
+import contextlib
+from functools import partial
+import torch
+
+
+def get_layer_split(n_layers, n_stages):
+    """
+    The [start, end) layer range of every pipeline stage. Layers are split as transformer_lens places
+    them over `n_devices` (layer i on device i // (n_layers // n_devices)), so every stage runs on one
+    device; that placement is only contiguous per device when n_devices divides n_layers.
+    """
+    assert n_layers % n_stages == 0, 'The {} layers cannot be split evenly into {} pipeline stages, please choose a divisor of the number of layers.'.format(n_layers, n_stages)
+    layers_per_stage = n_layers // n_stages
+    return [(start, start + layers_per_stage) for start in range(0, n_layers, layers_per_stage)]
+
+
+def get_stage_of_hook(name, stages):
+    """
+    The stage that runs the hook point `name`: embeddings belong to the first stage,
+    `blocks.{i}.*` to the stage holding layer i, and the final layer norm / unembed to the last one.
+    """
+    if name.startswith('blocks.'):
+        layer = int(name.split('.')[1])
+        for s, (start, end) in enumerate(stages):
+            if start <= layer < end:
+                return s
+    if name.startswith('hook_embed') or name.startswith('hook_pos_embed') or name.startswith('hook_tokens'):
+        return 0
+    return len(stages) - 1
+
+
+def slice_hook(hook, rows, n_rows):
+    """
+    Restricts a hook to the micro-batch `rows`. A partial hook with an `activations` keyword
+    (one value per token of the full batch, as passed to `ablation_hook`) gets the matching slice.
+    """
+    if not isinstance(hook, partial) or 'activations' not in hook.keywords:
+        return hook
+    activations = hook.keywords['activations']
+    activations = activations.reshape(n_rows, -1, *activations.shape[1:])[rows].reshape(-1, *activations.shape[1:])
+    return partial(hook.func, *hook.args, **dict(hook.keywords, activations=activations))
+
+
+class PipelineRunner:
+    """
+    Micro-batch pipelining for a HookedTransformer split over several devices.
+    A batch is cut into `n_micro_batches` micro-batches; every stage (a contiguous range of layers)
+    runs on its own thread and passes the residual stream of a micro-batch on to the next stage,
+    so that stage s processes micro-batch m while stage s+1 processes micro-batch m-1.
+    On CPU the stages are simulated by threads on the same device.
+    """
+    def __init__(self, model, n_stages, n_micro_batches):
+        self.model = model
+        self.stages = get_layer_split(model.cfg.n_layers, n_stages)
+        self.n_micro_batches = n_micro_batches
+
+    @contextlib.contextmanager
+    def stage_hooks(self, hooks):
+        """
+        Adds `hooks` for the enclosed block only. Unlike `model.hooks`, which resets every hook of
+        its context level on exit, only the handles added here are removed, so concurrent stages
+        do not drop each other's hooks.
+        """
+        handles = []
+        for name, hook in hooks:
+            hook_point = self.model.mod_dict[name]
+            handles.append(hook_point.register_forward_hook(
+                lambda module, inputs, output, hook=hook: hook(output, hook=module)
+            ))
+        try:
+            yield
+        finally:
+            for handle in handles:
+                handle.remove()
+
+    def run_stage(self, s, x, tokens, hooks, **kwargs):
+        start, end = self.stages[s]
+        hooks = [(name, hook) for name, hook in hooks if get_stage_of_hook(name, self.stages) == s]
+        last = s == len(self.stages) - 1
+        with self.stage_hooks(hooks):
+            if s == 0 and last:
+                return self.model(tokens, **kwargs)
+            if s == 0:
+                return self.model(tokens, stop_at_layer=end)
+            if last:
+                return self.model(x, start_at_layer=start, tokens=tokens, **kwargs)
+            return self.model(x, start_at_layer=start, stop_at_layer=end, tokens=tokens)
+
+    def worker(self, s, inbox, outbox, grad_enabled, kwargs):
+        # grad mode is thread-local, follow the caller's
+        torch.set_grad_enabled(grad_enabled)
+        while True:
+            item = inbox.get()
+            if item is None or isinstance(item, BaseException):
+                outbox.put(item)
+                return
+            m, x, tokens, hooks = item
+            try:
+                x = self.run_stage(s, x, tokens, hooks, **kwargs)
+            except BaseException as e:
+                outbox.put(e)
+                # drain the inbox so that the upstream stages can finish
+                while inbox.get() is not None:
+                    pass
+                return
+            outbox.put((m, x, tokens, hooks))
+
+    def run_with_hooks(self, tokens, fwd_hooks=[], **kwargs):
+        """
+        Same as `model.run_with_hooks(tokens, fwd_hooks=fwd_hooks, **kwargs)` for the outputs that
+        are batched along the first dimension (logits, per-token loss).
+        """
+        n_rows = tokens.shape[0]
+        micro_batches = torch.arange(n_rows).chunk(self.n_micro_batches)
+        queues = [queue.Queue() for _ in range(len(self.stages) + 1)]
+        threads = [
+            threading.Thread(target=self.worker, args=(s, queues[s], queues[s + 1], torch.is_grad_enabled(), kwargs), daemon=True)
+            for s in range(len(self.stages))
+        ]
+        for thread in threads:
+            thread.start()
+        for m, rows in enumerate(micro_batches):
+            hooks = [(name, slice_hook(hook, rows, n_rows)) for name, hook in fwd_hooks]
+            queues[0].put((m, None, tokens[rows], hooks))
+        queues[0].put(None)
+
+        outputs = [None] * len(micro_batches)
+        while True:
+            item = queues[-1].get()
+            if item is None:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            m, x, _, _ = item
+            outputs[m] = x
+        for thread in threads:
+            thread.join()
+        return torch.cat(outputs, 0)
+
+
+def get_pipeline(cfg, model):
+    """
+    A PipelineRunner if cfg asks for micro-batch pipelining over more than one stage, else None.
+    """
+    n_stages = cfg['pipeline_stages'] if cfg['pipeline_stages'] > 0 else model.cfg.n_devices
+    if cfg['pipeline_micro_batches'] <= 1 or n_stages <= 1:
+        return None
+    return PipelineRunner(model, n_stages, cfg['pipeline_micro_batches'])
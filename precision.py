@@ -0,0 +1,108 @@
+import numpy as np
+import torch
+from logger import logger
+
+PRECISIONS = ['fp32', 'bf16', 'fp16', 'int8']
+DTYPES = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def get_compute_dtype(precision, device):
+    """
+    The dtype activations are computed in. int8 is weight-only: the weights are dequantized to
+    fp16 on GPU and to fp32 on CPU right before they are used.
+    """
+    assert precision in PRECISIONS, "Precision not supported yet. please choose from: {}.".format(PRECISIONS)
+    if precision == 'int8':
+        return torch.float16 if str(device).startswith('cuda') else torch.float32
+    return DTYPES[precision]
+
+
+class Int8Weights:
+    """
+    Weight-only int8 quantization of the `W_*` matrices of a module, with one absmax scale per
+    output channel (the last dimension, as in transformer_lens). The dequantized weights only
+    exist while the module runs its forward pass.
+    """
+    def __init__(self, module, names, dtype):
+        self.names = names
+        self.dtype = dtype
+        for name in names:
+            weight = module._parameters.pop(name).detach()
+            scale = weight.float().abs().amax(dim=tuple(range(weight.dim() - 1)), keepdim=True).clamp(min=1e-8) / 127.
+            module.register_buffer(name + '_int8', torch.round(weight.float() / scale).to(torch.int8))
+            module.register_buffer(name + '_scale', scale)
+        module.register_forward_pre_hook(self.dequantize)
+        module.register_forward_hook(self.release)
+
+    def dequantize(self, module, args):
+        for name in self.names:
+            setattr(module, name, getattr(module, name + '_int8').to(self.dtype) * getattr(module, name + '_scale').to(self.dtype))
+
+    def release(self, module, args, output):
+        for name in self.names:
+            delattr(module, name)
+
+
+def quantize_int8(model, dtype):
+    """
+    Quantizes the attention and MLP weights of every block. Embeddings and unembeddings are kept,
+    as the evaluators read them directly (e.g. `model.embed.W_E`).
+    """
+    n_params = 0
+    for block in model.blocks:
+        for module in [block.attn, block.mlp]:
+            names = [name for name, param in module.named_parameters(recurse=False) if name.startswith('W_') and param.dim() >= 2]
+            n_params += sum(module._parameters[name].numel() for name in names)
+            Int8Weights(module, names, dtype)
+    logger.info('Quantized {} weights to int8'.format(n_params))
+
+
+def apply_precision(model, extractor, precision, device):
+    """
+    Casts the interpreted model and the concept projections of the extractor to the evaluation precision.
+    """
+    dtype = get_compute_dtype(precision, device)
+    model.to(dtype)
+    if precision == 'int8':
+        quantize_int8(model, dtype)
+    model.cfg.dtype = dtype
+    extractor.set_dtype(dtype)
+    return dtype
+
+
+def get_metrics(evaluator_dict, tokens, concepts, concept_idxs):
+    metrics = {name: [] for name in evaluator_dict.keys()}
+    for concept, concept_idx in zip(concepts, concept_idxs):
+        for name, evaluator in evaluator_dict.items():
+            evaluator.update_concept(concept, concept_idx)
+            metrics[name].append(float(np.mean(evaluator.get_metric(tokens))))
+    return {name: np.array(values) for name, values in metrics.items()}
+
+
+def measure_precision_drift(model, extractor, evaluator_dict, tokens, concepts, concept_idxs, precision, device):
+    """
+    Computes the metrics of `concept_idxs` in fp32 (the model and the extractor are upcast first, e.g.
+    from a fp16 checkpoint), switches to `precision` and computes them again. Returns the per-evaluator
+    drift; the model stays at `precision`.
+    """
+    apply_precision(model, extractor, 'fp32', device)
+    reference = get_metrics(evaluator_dict, tokens, concepts.float(), concept_idxs)
+    dtype = apply_precision(model, extractor, precision, device)
+    reduced = get_metrics(evaluator_dict, tokens, concepts.to(dtype), concept_idxs)
+    report = dict()
+    for name in evaluator_dict.keys():
+        abs_diff = np.abs(reduced[name] - reference[name])
+        rel_diff = abs_diff / np.maximum(np.abs(reference[name]), 1e-8)
+        report[name] = {
+            'max_abs': float(np.nanmax(abs_diff)),
+            'mean_abs': float(np.nanmean(abs_diff)),
+            'max_rel': float(np.nanmax(rel_diff)),
+        }
+    return report
+
+
+def format_drift(report, precision):
+    lines = ['{:<40s} {:>12s} {:>12s} {:>12s}'.format('evaluator (' + precision + ')', 'max abs', 'mean abs', 'max rel')]
+    for name, drift in report.items():
+        lines.append('{:<40s} {:>12.3e} {:>12.3e} {:>12.3e}'.format(name, drift['max_abs'], drift['mean_abs'], drift['max_rel']))
+    return '\n'.join(lines)
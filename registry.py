@@ -0,0 +1,37 @@
+from importlib import import_module
+
+
+class LazyRegistry(dict):
+    """
+    Maps codes to 'module:ClassName' paths and only imports an implementation when it is requested,
+    so a run pays for the dependencies of the components it uses and nothing else. Like the plain
+    dicts it replaces, `[]`, `get`, `values` and `items` return the classes.
+    """
+    def __init__(self, package, entries):
+        super().__init__(entries)
+        self.package = package
+
+    def resolve(self, path):
+        module, name = path.split(':')
+        return getattr(import_module(module, self.package), name)
+
+    def __getitem__(self, code):
+        return self.resolve(super().__getitem__(code))
+
+    def get(self, code, default=None):
+        return self[code] if code in self else default
+
+    def values(self):
+        return [self.resolve(path) for path in super().values()]
+
+    def items(self):
+        return [(code, self.resolve(path)) for code, path in super().items()]
+
+    def get_class(self, name):
+        """
+        Resolves an implementation by its class name, used for lazy package attributes.
+        """
+        for path in super().values():
+            if path.split(':')[1] == name:
+                return self.resolve(path)
+        raise AttributeError("module '{}' has no attribute '{}'".format(self.package, name))
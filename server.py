@@ -0,0 +1,255 @@
+"""
+A long-lived evaluation server. The model, the extractor and an evaluation set are loaded once, and
+concepts are scored over a local HTTP API, e.g.
+
+    python server.py --load_extractor --extractor ae --load_path ./best_reconstruct
+    curl -X POST localhost:8765/score -d '{"concept_idxs": [0, 1], "evaluators": ["itc_uci", "ablation_loss"]}'
+"""
+import json
+import math
+import time
+import queue
+import argparse
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import torch
+import logging
+from logger import logger
+from utils import set_seed, arg_parse_update_cfg, process_cfg
+from config import cfg as default_cfg
+from instrument import instrument
+from models import model_factory
+from datasets_ import dataset_factory
+from dataloaders import dataloader_factory
+from extractors import extractor_factory
+from main import get_eval_tokens, build_evaluators
+
+
+class ScoreRequest:
+    def __init__(self, concept_idxs, evaluator_names):
+        self.concept_idxs = concept_idxs
+        self.evaluator_names = evaluator_names
+        self.future = Future()
+
+
+class EvaluationService:
+    """
+    Scores (concept, evaluator) cells for concurrent clients. A single scheduler thread owns the model:
+    it waits `batch_window_ms` after the first request for more to arrive and merges the missing cells of
+    all of them. The ablation loss / next_logit / pred_logit cells of an evaluator are scored together,
+    with the concepts stacked into the disturbed forward passes and the clean outputs computed once for
+    the evaluation set; the other cells are scored concept by concept, the itc evaluators of a concept
+    sharing its critical-token search. The scores are kept in an LRU cache.
+    """
+    def __init__(self, cfg, evaluator_dict, tokens, concepts):
+        self.cfg = cfg
+        self.evaluator_dict = evaluator_dict
+        self.tokens = tokens
+        self.concepts = concepts
+        self.cache = OrderedDict()
+        # evaluator name -> the clean outputs of `get_concepts_metric` on the evaluation set
+        self.clean = dict()
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self.schedule, daemon=True)
+        self.thread.start()
+
+    def submit(self, concept_idxs, evaluator_names):
+        for name in evaluator_names:
+            if name not in self.evaluator_dict:
+                raise KeyError('Unknown evaluator {}, please choose from: {}.'.format(name, list(self.evaluator_dict.keys())))
+        for concept_idx in concept_idxs:
+            if not 0 <= concept_idx < self.concepts.shape[0]:
+                raise IndexError('Concept index {} out of range [0, {}).'.format(concept_idx, self.concepts.shape[0]))
+        request = ScoreRequest(concept_idxs, evaluator_names)
+        self.requests.put(request)
+        return request.future
+
+    def next_batch(self):
+        requests = [self.requests.get()]
+        deadline = time.perf_counter() + self.cfg['batch_window_ms'] / 1000.
+        while len(requests) < self.cfg['max_batch_requests']:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                requests.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return requests
+
+    def schedule(self):
+        while True:
+            requests = self.next_batch()
+            try:
+                # the values of the batch are kept here, the cache may evict them before the responses are built
+                values = dict()
+                cells = OrderedDict()
+                for request in requests:
+                    for concept_idx in request.concept_idxs:
+                        for name in request.evaluator_names:
+                            if (name, concept_idx) in values:
+                                continue
+                            if (name, concept_idx) in self.cache:
+                                values[(name, concept_idx)] = self.get_cached(name, concept_idx)
+                            else:
+                                cells.setdefault(concept_idx, []).append(name)
+                instrument.count('server/requests', len(requests))
+                values.update(self.evaluate_cells(cells))
+                for request in requests:
+                    request.future.set_result({
+                        name: {str(concept_idx): self.to_json(values[(name, concept_idx)]) for concept_idx in request.concept_idxs}
+                        for name in request.evaluator_names
+                    })
+            except Exception as e:
+                logger.exception('Failed to evaluate a batch of {} requests'.format(len(requests)))
+                for request in requests:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+
+    def evaluate_cells(self, cells):
+        """
+        Evaluates and caches the cells {concept_idx: names}. Returns {(name, concept_idx): value}.
+        """
+        values = dict()
+        batched = OrderedDict()
+        for concept_idx, names in cells.items():
+            names = list(OrderedDict.fromkeys(names))
+            for name in names:
+                evaluator = self.evaluator_dict[name]
+                if evaluator.code() == 'faithfulness' and evaluator.can_batch_concepts():
+                    batched.setdefault(name, []).append(concept_idx)
+            names = [name for name in names if name not in batched]
+            if len(names) > 0:
+                values.update(self.evaluate_concept(concept_idx, names))
+        concept_acts = dict()
+        for name, concept_idxs in batched.items():
+            evaluator = self.evaluator_dict[name]
+            with instrument.timer('server/' + name):
+                if name not in self.clean:
+                    self.clean[name] = evaluator.get_clean_outputs(self.tokens)
+                for concept_idx in concept_idxs:
+                    if concept_idx not in concept_acts:
+                        concept_acts[concept_idx] = evaluator.get_concept_acts(self.tokens, self.concepts[concept_idx], concept_idx)
+                metrics = evaluator.get_concepts_metric(
+                    self.tokens,
+                    self.concepts[concept_idxs],
+                    torch.stack([concept_acts[concept_idx] for concept_idx in concept_idxs]),
+                    self.clean[name],
+                )
+            for concept_idx, metric in zip(concept_idxs, metrics):
+                values[(name, concept_idx)] = float(metric)
+                self.put_cached(name, concept_idx, float(metric))
+        return values
+
+    def evaluate_concept(self, concept_idx, names):
+        """
+        Evaluates and caches the cells of one concept. Returns {(name, concept_idx): value}.
+        """
+        values = dict()
+        concept = self.concepts[concept_idx]
+        topic = None
+        for name in names:
+            evaluator = self.evaluator_dict[name]
+            with instrument.timer('server/' + name):
+                evaluator.update_concept(concept, concept_idx)
+                if 'itc' in name:
+                    if topic is None:
+                        topic = evaluator.get_most_critical_tokens(self.tokens, concept, concept_idx)
+                    metric = evaluator.get_metric(self.tokens, topic[0], topic[1], topic[3])
+                else:
+                    metric = evaluator.get_metric(self.tokens)
+            values[(name, concept_idx)] = float(metric)
+            self.put_cached(name, concept_idx, float(metric))
+        return values
+
+    @staticmethod
+    def to_json(value):
+        return None if math.isnan(value) else value
+
+    def get_cached(self, name, concept_idx):
+        value = self.cache[(name, concept_idx)]
+        self.cache.move_to_end((name, concept_idx))
+        return value
+
+    def put_cached(self, name, concept_idx, value):
+        self.cache[(name, concept_idx)] = value
+        while len(self.cache) > self.cfg['server_cache_size']:
+            self.cache.popitem(last=False)
+
+
+def make_handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        def send_json(self, code, obj):
+            body = json.dumps(obj).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/health':
+                self.send_json(200, {'status': 'ok', 'cached_cells': len(service.cache)})
+            elif self.path == '/evaluators':
+                self.send_json(200, {'evaluators': list(service.evaluator_dict.keys()), 'n_concepts': service.concepts.shape[0]})
+            else:
+                self.send_json(404, {'error': 'Unknown path {}'.format(self.path)})
+
+        def do_POST(self):
+            if self.path != '/score':
+                self.send_json(404, {'error': 'Unknown path {}'.format(self.path)})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                future = service.submit(
+                    [int(i) for i in request['concept_idxs']],
+                    request.get('evaluators', list(service.evaluator_dict.keys())),
+                )
+            except (ValueError, KeyError, IndexError, TypeError) as e:
+                self.send_json(400, {'error': str(e)})
+                return
+            try:
+                self.send_json(200, {'scores': future.result()})
+            except Exception as e:
+                self.send_json(500, {'error': str(e)})
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    return Handler
+
+
+def main():
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO, force=True)
+    torch.set_default_dtype(torch.float32)
+
+    parser = argparse.ArgumentParser()
+    cfg, args = arg_parse_update_cfg(default_cfg, parser)
+    assert cfg['load_extractor'], "The server evaluates a saved extractor, please pass --load_extractor and --load_path."
+    set_seed(cfg['seed'])
+    instrument.configure(cfg)
+
+    model = model_factory(cfg)
+    cfg = process_cfg(cfg, model)
+    dataloader = dataloader_factory(cfg, dataset_factory(cfg), model)
+    extractor = extractor_factory(cfg, dataloader).load_from_file(dataloader, cfg['load_path'], cfg).to(cfg['device'])
+    tokens, _ = get_eval_tokens(dataloader, cfg['server_eval_batches'])
+    service = EvaluationService(cfg, build_evaluators(cfg, extractor, model), tokens, extractor.get_concepts())
+
+    server = ThreadingHTTPServer((cfg['server_host'], cfg['server_port']), make_handler(service))
+    logger.info('Serving on http://{}:{}'.format(cfg['server_host'], cfg['server_port']))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if instrument.enabled:
+            logger.info('Instrumentation summary:\n{}'.format(instrument.summary()))
+
+
+if __name__ == '__main__':
+    main()
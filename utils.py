@@ -1,6 +1,4 @@
-from transformer_lens import utils
 import torch
-import datasets
 import numpy as np
 import random
 import os
@@ -84,7 +82,26 @@ def run_with_cache_top1logit_bkwd(
             
     return model_out, cache_dict
     
+def to_numpy(*tensors):
+    """
+    Copies device tensors into pinned host memory with non-blocking copies, waits for all of them
+    at once and returns numpy arrays.
+    """
+    hosts = []
+    for tensor in tensors:
+        if tensor.device.type == 'cpu':
+            hosts.append(tensor)
+            continue
+        host = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+        host.copy_(tensor, non_blocking=True)
+        hosts.append(host)
+    if any(tensor.device.type == 'cuda' for tensor in tensors):
+        torch.cuda.synchronize()
+    arrays = [host.numpy() for host in hosts]
+    return arrays[0] if len(arrays) == 1 else arrays
+
 def load_dataset(data_dir, dataset_name, data_from_hf):
+    import datasets
     if data_from_hf:
         if not os.path.exists(data_dir + dataset_name + '.hf'):
             data = datasets.load_dataset(dataset_name, split="train", cache_dir=data_dir)
@@ -96,6 +113,7 @@ def load_dataset(data_dir, dataset_name, data_from_hf):
 
 
 def post_init_cfg(cfg):
+    from transformer_lens import utils
     cfg["model_batch_size"] = cfg["batch_size"] // cfg["seq_len"]
     cfg["buffer_size"] = cfg["batch_size"] * cfg["buffer_mult"]
     cfg["buffer_batches"] = cfg["buffer_size"] // cfg["seq_len"]
@@ -150,10 +168,47 @@ def process_cfg(cfg, model_to_interpret):
     cfg["num_batches"] = cfg["num_tokens"] // cfg["batch_size"] 
     cfg = post_init_cfg(cfg)
     
-    save_path = f"model_{cfg['model_to_interpret']}_layer_{cfg['layer']}_dictSize_{cfg['dict_size']}_site_{cfg['site']}"
-    save_dir = os.path.join(cfg['output_dir'], save_path)
-    os.makedirs(save_dir, exist_ok=True)
-    cfg['save_dir'] = save_dir
+    cfg['save_dir'] = get_save_dir(cfg)
     
     logger.info("Updated config")
     return cfg
+
+def get_save_dir(cfg):
+    save_path = f"model_{cfg['model_to_interpret']}_layer_{cfg['layer']}_dictSize_{cfg['dict_size']}_site_{cfg['site']}"
+    save_dir = os.path.join(cfg['output_dir'], save_path)
+    os.makedirs(save_dir, exist_ok=True)
+    return save_dir
+
+def get_harvest_sites(cfg, n_layers):
+    """
+    The (layer, site, act_name) of every activation the AE dataloader harvests in one forward pass, from the
+    comma-separated cfg['harvest_layers'] ('all' for every layer) and cfg['harvest_sites']. The configured
+    layer and site come first.
+    """
+    from transformer_lens import utils
+    sites = [(cfg['layer'], cfg['site'], cfg['act_name'])]
+    if cfg['name_only']:
+        return sites
+    if cfg['harvest_layers'] == 'all':
+        layers = list(range(n_layers))
+    elif cfg['harvest_layers'] == '':
+        layers = [cfg['layer']]
+    else:
+        layers = [int(layer) for layer in cfg['harvest_layers'].split(',')]
+    site_names = [cfg['site']] if cfg['harvest_sites'] == '' else [site.strip() for site in cfg['harvest_sites'].split(',')]
+    for layer in layers:
+        for site in site_names:
+            act_name = utils.get_act_name(site, layer, cfg['layer_type'])
+            if act_name not in [s[2] for s in sites]:
+                sites.append((layer, site, act_name))
+    return sites
+
+def get_site_cfg(cfg, layer, site, act_name):
+    """
+    cfg for an extractor of another harvested site, with its own activation size, dictionary size and save_dir.
+    """
+    site_cfg = dict(cfg, layer=layer, site=site, act_name=act_name)
+    site_cfg["act_size"] = cfg["d_mlp"] if site == 'mlp_post' else cfg["d_model"]
+    site_cfg["dict_size"] = site_cfg["act_size"] * cfg["dict_mult"]
+    site_cfg['save_dir'] = get_save_dir(site_cfg)
+    return site_cfg